@@ -98,23 +98,31 @@ from clab.util import profiler
 python -c "import ubelt._internal as a; a.autogen_init('clab', attrs=False)"
 """
 # <AUTOGEN_INIT>
-from clab import augment
-from clab import criterions
-from clab import early_stop
-from clab import fit_harness
-from clab import folder_structure
-from clab import hyperparams
-from clab import im_loaders
-from clab import inputs
-from clab import live
-from clab import metrics
-from clab import models
-from clab import nninit
-from clab import nnio
-from clab import preprocess
-from clab import tasks
-from clab import transforms
-from clab import util
-from clab import xpu_device
-
-XPU = xpu_device.XPU
+# Submodules are imported on first use (see clab.util.lazy_loader), so that
+# CLI invocations and spawned workers do not pay for torch, cv2, etc. up front
+from clab.util.lazy_loader import lazy_import
+submodules = [
+    'augment',
+    'criterions',
+    'early_stop',
+    'fit_harness',
+    'folder_structure',
+    'hyperparams',
+    'im_loaders',
+    'inputs',
+    'live',
+    'metrics',
+    'models',
+    'nninit',
+    'nnio',
+    'preprocess',
+    'tasks',
+    'telemetry',
+    'transforms',
+    'util',
+    'xpu_device',
+]
+__getattr__, __dir__, __all__ = lazy_import(__name__, submodules, {}, {
+    'XPU': ('xpu_device', 'XPU'),
+})
+del lazy_import, submodules
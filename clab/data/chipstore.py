@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+"""
+A packed on-disk format for datasets of fixed-shape chips.
+
+Instead of a directory of image files per modality, each modality (im, gt,
+and every aux channel) is stored as a single contiguous `.npy` array of shape
+[N, H, W(, C)] that is memory mapped when read. Reading a chip is a zero-copy
+slice of the mapped array, so there is no decode cost or file open per item
+and random access is O(1).
+
+A small `index.json` describes the store. It is written last, so a store
+without an index is incomplete and will be rebuilt.
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+import json
+import os
+import numpy as np
+import ubelt as ub
+from os.path import join, exists, basename
+from clab.util import imutil
+
+__all__ = ['ChipStore']
+
+
+class ChipStore(object):
+    """
+    Memory mapped arrays of fixed-shape chips, one per modality.
+
+    Args:
+        dpath (str): directory containing the store
+
+    Example:
+        >>> import tempfile
+        >>> from clab import inputs
+        >>> dpath = tempfile.mkdtemp()
+        >>> paths = {'im': [], 'gt': [], 'dsm': []}
+        >>> rng = np.random.RandomState(0)
+        >>> for i in range(5):
+        >>>     for k, shape in [('im', (8, 9, 3)), ('gt', (8, 9)), ('dsm', (8, 9))]:
+        >>>         fpath = join(ub.ensuredir((dpath, k)), 'chip{}.png'.format(i))
+        >>>         imutil.imwrite(fpath, rng.randint(0, 255, shape).astype(np.uint8))
+        >>>         paths[k].append(fpath)
+        >>> chipped = inputs.Inputs()
+        >>> chipped.im_paths, chipped.gt_paths = paths['im'], paths['gt']
+        >>> chipped.aux_paths = {'dsm': paths['dsm']}
+        >>> store = ChipStore.from_inputs(chipped, join(dpath, 'packed'))
+        >>> print(store)
+        <ChipStore(5 chips: dsm=(8, 9), gt=(8, 9), im=(8, 9, 3))>
+        >>> chip = store[3]
+        >>> assert np.all(chip['im'] == imutil.imread(paths['im'][3]))
+        >>> # chips are views into the mapped arrays
+        >>> assert np.shares_memory(chip['gt'], store.arrays['gt'])
+        >>> # the store is reused when it is up to date
+        >>> assert ChipStore.from_inputs(chipped, join(dpath, 'packed')).index == store.index
+        >>> # and rebuilt when a source file changes
+        >>> imutil.imwrite(paths['gt'][3], np.zeros((8, 9), dtype=np.uint8))
+        >>> os.utime(paths['gt'][3], (0, 0))
+        >>> store = ChipStore.from_inputs(chipped, join(dpath, 'packed'))
+        >>> assert np.all(store[3]['gt'] == 0)
+    """
+    def __init__(self, dpath):
+        self.dpath = dpath
+        with open(join(dpath, 'index.json'), 'r') as file:
+            self.index = json.load(file)
+        self.keys = sorted(self.index['shapes'].keys())
+        self._arrays = None
+
+    @classmethod
+    def from_inputs(cls, inputs, dpath, force=False):
+        """
+        Packs the chips of an `Inputs` object into a store in `dpath`.
+
+        If the store already exists and was built from the same files (with
+        the same sizes and modification times) it is reused.
+
+        Args:
+            inputs (clab.inputs.Inputs): chipped dataset where every chip of a
+                modality has the same shape.
+            dpath (str): output directory
+            force (bool): rebuild even if the store is up to date
+        """
+        sources = {k: list(v) for k, v in inputs.paths.items()}
+        stamps = {k: _file_stamps(v) for k, v in sources.items()}
+        index_fpath = join(dpath, 'index.json')
+        if not force and exists(index_fpath):
+            with open(index_fpath, 'r') as file:
+                index = json.load(file)
+            if index['sources'] == sources and index.get('stamps') == stamps:
+                return cls(dpath)
+
+        ub.ensuredir(dpath)
+        if exists(index_fpath):
+            os.remove(index_fpath)
+        n_chips = len(inputs)
+        index = {
+            'n_chips': n_chips,
+            'names': [basename(p) for p in next(iter(sources.values()))],
+            'shapes': {},
+            'dtypes': {},
+            'sources': sources,
+            'stamps': stamps,
+        }
+        for key in sorted(sources.keys()):
+            paths = sources[key]
+            arr = None
+            for ix, fpath in enumerate(ub.ProgIter(paths, label='pack ' + key)):
+                data = imutil.imread(fpath)
+                if arr is None:
+                    arr = np.lib.format.open_memmap(
+                        join(dpath, key + '.npy'), mode='w+',
+                        dtype=data.dtype, shape=(n_chips,) + data.shape)
+                if data.shape != arr.shape[1:]:
+                    raise ValueError(
+                        'chips must have the same shape, but {} has shape {} '
+                        'not {}'.format(fpath, data.shape, arr.shape[1:]))
+                arr[ix] = data
+            arr.flush()
+            index['shapes'][key] = list(arr.shape[1:])
+            index['dtypes'][key] = arr.dtype.str
+            del arr
+
+        # The index marks the store as complete
+        with open(index_fpath + '.tmp', 'w') as file:
+            json.dump(index, file)
+        os.rename(index_fpath + '.tmp', index_fpath)
+        return cls(dpath)
+
+    @property
+    def arrays(self):
+        """ dict of read-only memory mapped arrays (opened on first use) """
+        if self._arrays is None:
+            self._arrays = {
+                key: np.load(join(self.dpath, key + '.npy'), mmap_mode='r')
+                for key in self.keys
+            }
+        return self._arrays
+
+    def __len__(self):
+        return self.index['n_chips']
+
+    def __getitem__(self, index):
+        """
+        Returns:
+            dict: maps each modality to a read-only view of chip `index`
+        """
+        return {key: arr[index] for key, arr in self.arrays.items()}
+
+    def __getstate__(self):
+        # Do not pickle the mapped data (e.g. when sending to DataLoader
+        # workers). Each process maps the files on first use.
+        state = self.__dict__.copy()
+        state['_arrays'] = None
+        return state
+
+    def __repr__(self):
+        shapes = ', '.join('{}={}'.format(k, tuple(self.index['shapes'][k]))
+                           for k in self.keys)
+        return '<ChipStore({} chips: {})>'.format(len(self), shapes)
+
+
+def _file_stamps(paths):
+    """ [size, mtime_ns] of each file, to detect when a source changes """
+    stamps = []
+    for fpath in paths:
+        stat = os.stat(fpath)
+        stamps.append([stat.st_size, stat.st_mtime_ns])
+    return stamps
+
+
+if __name__ == '__main__':
+    r"""
+    CommandLine:
+        python -m clab.data.chipstore all
+    """
+    import xdoctest
+    xdoctest.doctest_module(__file__)
@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+"""
+Background batch prefetching for overlapping data loading with compute.
+
+The :class:`BatchPrefetcher` pulls batches from a loader in a background thread
+and keeps up to ``depth`` of them staged ahead of the consumer. A ``stage``
+function is applied to each batch in that thread, which is where the harness
+pins host memory and issues non-blocking host-to-device copies. While the
+loader is the bottleneck the time per step approaches max(load, compute)
+instead of load + compute.
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+import sys
+import threading
+import time
+import six
+import torch
+from six.moves import queue
+
+__all__ = ['BatchPrefetcher', 'pin_batch']
+
+
+# Sentinels used to communicate with the consumer
+_END = object()
+_ERROR = object()
+
+
+def pin_batch(batch):
+    """
+    Recursively copies every tensor in a (possibly nested) batch into pinned
+    (page-locked) host memory, so host-to-device copies can be non-blocking.
+
+    Args:
+        batch (Tensor | list | tuple | dict): collated batch structure
+
+    Returns:
+        the same structure with pinned tensors
+
+    Example:
+        >>> batch = [torch.rand(2, 3), [torch.rand(2), 'meta']]
+        >>> pinned = pin_batch(batch)
+        >>> assert pinned[1][1] == 'meta'
+        >>> if torch.cuda.is_available():
+        >>>     assert pinned[0].is_pinned()
+    """
+    if torch.is_tensor(batch):
+        if not torch.cuda.is_available() or batch.is_cuda:
+            return batch
+        if batch.is_pinned():
+            return batch
+        return batch.pin_memory()
+    elif isinstance(batch, tuple):
+        return tuple(pin_batch(item) for item in batch)
+    elif isinstance(batch, list):
+        return [pin_batch(item) for item in batch]
+    elif isinstance(batch, dict):
+        return batch.__class__((k, pin_batch(v)) for k, v in batch.items())
+    else:
+        return batch
+
+
+class BatchPrefetcher(object):
+    """
+    Iterates over a loader while a background thread keeps up to ``depth``
+    staged batches ready.
+
+    Args:
+        loader (iterable): usually a `torch.utils.data.DataLoader`
+        stage (callable, optional): applied to each batch in the background
+            thread (e.g. pinning and non-blocking device copies).
+        depth (int): maximum number of batches staged ahead of the consumer.
+
+    Attributes:
+        stall_time (float): total seconds the consumer spent waiting on the
+            background thread. Near zero means loading is hidden by compute.
+
+    Example:
+        >>> loader = [torch.full((2,), i) for i in range(5)]
+        >>> prefetcher = BatchPrefetcher(loader, stage=lambda b: b * 2, depth=2)
+        >>> result = [int(b[0]) for b in prefetcher]
+        >>> assert result == [0, 2, 4, 6, 8]
+        >>> assert prefetcher.stall_time >= 0
+
+    Example:
+        >>> # errors in the background thread are re-raised in the consumer
+        >>> import pytest
+        >>> def stage(b):
+        >>>     raise ValueError('bad batch')
+        >>> prefetcher = BatchPrefetcher([1, 2, 3], stage=stage)
+        >>> with pytest.raises(ValueError):
+        >>>     list(prefetcher)
+    """
+    def __init__(self, loader, stage=None, depth=2):
+        if depth < 1:
+            raise ValueError('prefetch depth must be positive not {}'.format(depth))
+        self.loader = loader
+        self.stage = stage
+        self.depth = depth
+        self.stall_time = 0.0
+        self._queue = None
+        self._thread = None
+        self._stop = threading.Event()
+
+    def __len__(self):
+        return len(self.loader)
+
+    def _worker(self, queue_):
+        try:
+            for batch in self.loader:
+                if self._stop.is_set():
+                    return
+                if self.stage is not None:
+                    batch = self.stage(batch)
+                if not self._put(queue_, batch):
+                    return
+        except Exception:
+            self._put(queue_, (_ERROR, sys.exc_info()))
+        else:
+            self._put(queue_, _END)
+
+    def _put(self, queue_, item):
+        # Poll so the thread can exit if the consumer closes us early
+        while not self._stop.is_set():
+            try:
+                queue_.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def start(self):
+        self.close()
+        self._stop.clear()
+        self.stall_time = 0.0
+        self._queue = queue.Queue(maxsize=self.depth)
+        self._thread = threading.Thread(target=self._worker,
+                                        args=(self._queue,),
+                                        name='BatchPrefetcher')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def close(self):
+        """ Stops the background thread and drops any staged batches """
+        if self._thread is not None:
+            self._stop.set()
+            while self._thread.is_alive():
+                try:
+                    self._queue.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            self._thread.join()
+            self._thread = None
+            self._queue = None
+
+    def __iter__(self):
+        self.start()
+        try:
+            while True:
+                tic = time.time()
+                item = self._queue.get()
+                self.stall_time += time.time() - tic
+                if item is _END:
+                    break
+                if isinstance(item, tuple) and len(item) == 2 and item[0] is _ERROR:
+                    six.reraise(*item[1])
+                yield item
+        finally:
+            self.close()
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
+
+
+if __name__ == '__main__':
+    r"""
+    CommandLine:
+        python -m clab.data.prefetch all
+    """
+    import xdoctest
+    xdoctest.doctest_module(__file__)
@@ -0,0 +1,135 @@
+"""
+Samplers for splitting a loader between the processes of a distributed group.
+"""
+import torch
+import torch.utils.data as torch_data
+import torch.utils.data.sampler as torch_sampler
+from clab import xpu_device
+
+
+class StridedBatchSampler(torch_sampler.Sampler):
+    """
+    Shards an arbitrary batch sampler between distributed processes by giving
+    each rank every `world_size`-th batch.
+
+    The wrapped sampler is iterated with the torch RNG seeded by `seed` and the
+    current epoch, so every rank sees the same sequence of batches (which is
+    required for custom samplers like `MultiScaleBatchSampler` that shuffle or
+    randomly choose scales). Each rank gets the same number of batches so
+    gradient all-reduces stay in lockstep.
+
+    Args:
+        batch_sampler (Sampler): sampler that yields lists of indices
+        rank (int): index of this process
+        world_size (int): number of processes
+        seed (int): base seed shared between ranks
+
+    Example:
+        >>> base = torch_sampler.BatchSampler(
+        >>>     torch_sampler.RandomSampler(range(20)), batch_size=3,
+        >>>     drop_last=False)
+        >>> shards = [StridedBatchSampler(base, rank, 3) for rank in range(3)]
+        >>> batches = [list(s) for s in shards]
+        >>> assert all(len(b) == len(shards[0]) == 2 for b in batches)
+        >>> flat = [idx for b in batches for batch in b for idx in batch]
+        >>> assert len(flat) == len(set(flat)) == 18
+        >>> # every rank reshuffles identically when the epoch changes
+        >>> for s in shards:
+        >>>     s.set_epoch(1)
+        >>> flat2 = [idx for s in shards for batch in s for idx in batch]
+        >>> assert len(set(flat2)) == 18 and flat2 != flat
+    """
+    def __init__(self, batch_sampler, rank=None, world_size=None, seed=0):
+        if rank is None:
+            rank = xpu_device.get_rank()
+        if world_size is None:
+            world_size = xpu_device.get_world_size()
+        self.batch_sampler = batch_sampler
+        self.rank = rank
+        self.world_size = world_size
+        self.seed = seed
+        self.epoch = 0
+        self.batch_size = getattr(batch_sampler, 'batch_size', None)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __len__(self):
+        return len(self.batch_sampler) // self.world_size
+
+    def __iter__(self):
+        with torch.random.fork_rng(devices=[]):
+            torch.manual_seed(self.seed + self.epoch)
+            batches = list(self.batch_sampler)
+        num = len(self)
+        for batch in batches[self.rank::self.world_size][:num]:
+            yield batch
+
+
+def shard_loader(loader, rank=None, world_size=None):
+    """
+    Creates a loader that only iterates over this rank's share of the data.
+
+    Standard loaders get a `DistributedSampler` (shuffled if the original
+    loader was shuffled). Loaders with a custom batch sampler are wrapped with
+    a `StridedBatchSampler`.
+
+    Args:
+        loader (torch.utils.data.DataLoader): loader over the full dataset
+        rank (int): index of this process. Defaults to the current rank.
+        world_size (int): number of processes. Defaults to the group size.
+
+    Returns:
+        torch.utils.data.DataLoader: loader over a single shard
+
+    Example:
+        >>> dset = torch_data.TensorDataset(torch.arange(10))
+        >>> loader = torch_data.DataLoader(dset, batch_size=2, shuffle=True)
+        >>> shards = [shard_loader(loader, rank, 2) for rank in range(2)]
+        >>> assert all(len(s) == 3 for s in shards)
+        >>> for s in shards:
+        >>>     s.batch_sampler.sampler.set_epoch(0)
+        >>> seen = [int(x) for s in shards for b in s for x in b[0]]
+        >>> assert set(seen) == set(range(10))
+        >>> # sharding is idempotent
+        >>> assert shard_loader(shards[0], 0, 2) is shards[0]
+    """
+    if rank is None:
+        rank = xpu_device.get_rank()
+    if world_size is None:
+        world_size = xpu_device.get_world_size()
+
+    batch_sampler = loader.batch_sampler
+    DistributedSampler = torch_data.distributed.DistributedSampler
+    if isinstance(batch_sampler, StridedBatchSampler) or isinstance(
+            getattr(batch_sampler, 'sampler', None), DistributedSampler):
+        # The loader is already sharded
+        return loader
+
+    if type(batch_sampler) is torch_sampler.BatchSampler:
+        shuffle = isinstance(batch_sampler.sampler, torch_sampler.RandomSampler)
+        sampler = DistributedSampler(
+            loader.dataset, num_replicas=world_size, rank=rank,
+            shuffle=shuffle)
+        new_batch_sampler = torch_sampler.BatchSampler(
+            sampler, batch_size=batch_sampler.batch_size,
+            drop_last=batch_sampler.drop_last)
+    else:
+        new_batch_sampler = StridedBatchSampler(batch_sampler, rank,
+                                                world_size)
+
+    new_loader = torch_data.DataLoader(
+        loader.dataset, batch_sampler=new_batch_sampler,
+        num_workers=loader.num_workers, collate_fn=loader.collate_fn,
+        pin_memory=loader.pin_memory,
+        worker_init_fn=loader.worker_init_fn)
+    return new_loader
+
+
+if __name__ == '__main__':
+    r"""
+    CommandLine:
+        python -m clab.data.sampler all
+    """
+    import xdoctest
+    xdoctest.doctest_module(__file__)
@@ -0,0 +1,294 @@
+# -*- coding: utf-8 -*-
+"""
+A bounded cache of decoded arrays (e.g. images) that is shared between the
+DataLoader worker processes of a dataset.
+
+Unlike `ub.memoize_method`, which grows without bound and keeps a separate copy
+of every image in every worker, the cache has a fixed byte budget and lives in
+shared memory, so an image decoded by one worker is a hit for all others.
+
+The budget is split into fixed-size slots that are evicted with the CLOCK
+algorithm (an approximation of LRU). Each slot holds one array. Arrays larger
+than a slot are not cached.
+
+Example:
+    >>> class Dataset(object):
+    >>>     def __init__(self):
+    >>>         self.image_cache = SharedArrayCache(max_bytes=2 ** 16,
+    >>>                                             slot_bytes=2 ** 12)
+    >>>         self.n_loads = 0
+    >>>     @cached_method('image_cache')
+    >>>     def _load_image(self, index):
+    >>>         self.n_loads += 1
+    >>>         return np.full((8, 8, 3), index, dtype=np.uint8)
+    >>> dset = Dataset()
+    >>> assert dset._load_image(3).sum() == 3 * 8 * 8 * 3
+    >>> assert dset._load_image(3).sum() == 3 * 8 * 8 * 3
+    >>> print(dset.n_loads, ub.repr2(dset.image_cache.stats(), nl=0))
+    1 {'hits': 1, 'misses': 1, 'hit_rate': 0.5, 'evictions': 0, 'skipped': 0, 'n_items': 1, 'max_bytes': 65536}
+    >>> # items added by other processes are hits in this one
+    >>> _demo_fill_in_subprocess(dset.image_cache, [5, 6])
+    >>> assert dset._load_image(6).sum() == 6 * 8 * 8 * 3
+    >>> assert dset.n_loads == 1
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+import functools
+import multiprocessing
+import numpy as np
+import torch
+import ubelt as ub
+
+__all__ = ['SharedArrayCache', 'cached_method']
+
+# Array types that can be stored (indexed by the stored dtype code)
+_DTYPES = [np.dtype(t) for t in [np.bool_, np.uint8, np.int8, np.uint16,
+                                 np.int16, np.uint32, np.int32, np.int64,
+                                 np.float16, np.float32, np.float64]]
+_MAX_NDIM = 4
+
+# Indices into the shared counters
+_HAND, _HITS, _MISSES, _EVICTIONS, _SKIPPED = range(5)
+
+
+class SharedArrayCache(object):
+    """
+    A CLOCK-evicted cache of numpy arrays keyed by non-negative integers (e.g.
+    dataset indices) and stored in shared memory.
+
+    The cache must be created before the DataLoader starts its workers.
+    Workers share the storage, the lock, and the hit / miss counters with the
+    main process, so `stats` reports the totals over all workers.
+
+    Args:
+        max_bytes (int): byte budget for the cached arrays
+        slot_bytes (int): size of a slot. Arrays larger than this are not
+            cached. Should be about the size of the largest array.
+
+    Example:
+        >>> cache = SharedArrayCache(max_bytes=240, slot_bytes=80)
+        >>> for key in [0, 1, 2]:
+        >>>     cache.put(key, np.full(10, key))
+        >>> # referencing 0 and 2 gives them a second chance
+        >>> assert cache.get(0)[0] == 0 and cache.get(2)[0] == 2
+        >>> cache.put(3, np.full(10, 3))
+        >>> assert cache.get(1) is None
+        >>> assert cache.get(3).tolist() == [3] * 10
+        >>> # arrays larger than a slot are not cached
+        >>> assert not cache.put(4, np.zeros(100))
+        >>> print(ub.repr2(cache.stats(), nl=0))
+        {'hits': 3, 'misses': 1, 'hit_rate': 0.75, 'evictions': 1, 'skipped': 1, 'n_items': 3, 'max_bytes': 240}
+    """
+    def __init__(self, max_bytes=2 ** 30, slot_bytes=2 ** 20):
+        # keep slots aligned for every dtype
+        slot_bytes = int(np.ceil(slot_bytes / 8)) * 8
+        n_slots = max(1, int(max_bytes // slot_bytes))
+        self.slot_bytes = slot_bytes
+        self.n_slots = n_slots
+        # A lock from the spawn context can be shared with workers started
+        # by any method (fork context locks refuse to be pickled)
+        self._lock = multiprocessing.get_context('spawn').Lock()
+        self._tensors = {
+            'data': torch.empty(n_slots, slot_bytes, dtype=torch.uint8),
+            'keys': torch.full((n_slots,), -1, dtype=torch.int64),
+            'shapes': torch.zeros(n_slots, _MAX_NDIM, dtype=torch.int64),
+            # the ndim, dtype code, and CLOCK reference bit of each slot
+            'info': torch.zeros(n_slots, 3, dtype=torch.int64),
+            'counters': torch.zeros(5, dtype=torch.int64),
+        }
+        for tensor in self._tensors.values():
+            tensor.share_memory_()
+        self._arrays = None
+
+    @property
+    def _views(self):
+        # numpy views of the shared tensors (created on first use in each
+        # process)
+        if self._arrays is None:
+            self._arrays = {key: tensor.numpy()
+                            for key, tensor in self._tensors.items()}
+        return self._arrays
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_arrays'] = None
+        return state
+
+    def __len__(self):
+        return int((self._views['keys'] != -1).sum())
+
+    def get(self, key, func=None):
+        """
+        Looks up the array stored under `key`.
+
+        Args:
+            key (int): non-negative integer key
+            func (callable): if specified and the key is missing, the array is
+                computed with `func()` and added to the cache.
+
+        Returns:
+            ndarray: a copy of the cached array (or the result of `func`).
+                None if the key is missing and `func` is not specified.
+        """
+        key = int(key)
+        views = self._views
+        with self._lock:
+            slot = self._find(key)
+            if slot is not None:
+                views['info'][slot, 2] = 1
+                views['counters'][_HITS] += 1
+                return self._read(slot)
+            views['counters'][_MISSES] += 1
+        if func is None:
+            return None
+        # compute outside of the lock so workers do not wait on each other
+        value = func()
+        self.put(key, value)
+        return value
+
+    def put(self, key, value):
+        """
+        Adds an array to the cache, evicting another one if necessary.
+
+        Returns:
+            bool: False if the array could not be cached
+        """
+        key = int(key)
+        if key < 0:
+            raise ValueError('keys must be non-negative')
+        views = self._views
+        value = np.ascontiguousarray(value)
+        if (value.nbytes > self.slot_bytes or value.ndim > _MAX_NDIM or
+                value.dtype not in _DTYPES):
+            with self._lock:
+                views['counters'][_SKIPPED] += 1
+            return False
+        with self._lock:
+            if self._find(key) is not None:
+                # another worker already added it
+                return True
+            slot = self._victim()
+            if views['keys'][slot] != -1:
+                views['counters'][_EVICTIONS] += 1
+            views['data'][slot, :value.nbytes] = value.reshape(-1).view(np.uint8)
+            views['shapes'][slot, :value.ndim] = value.shape
+            # the reference bit is only set when the array is used again
+            views['info'][slot] = [value.ndim, _DTYPES.index(value.dtype), 0]
+            views['keys'][slot] = key
+        return True
+
+    def clear(self):
+        with self._lock:
+            self._views['keys'][:] = -1
+            self._views['info'][:, 2] = 0
+
+    def stats(self):
+        """
+        Returns:
+            dict: hit / miss / eviction counts summed over all processes
+        """
+        counters = self._views['counters']
+        hits, misses = int(counters[_HITS]), int(counters[_MISSES])
+        total = hits + misses
+        stats = ub.odict([
+            ('hits', hits),
+            ('misses', misses),
+            ('hit_rate', hits / total if total else 0.0),
+            ('evictions', int(counters[_EVICTIONS])),
+            ('skipped', int(counters[_SKIPPED])),
+            ('n_items', len(self)),
+            ('max_bytes', self.n_slots * self.slot_bytes),
+        ])
+        return stats
+
+    def reset_stats(self):
+        with self._lock:
+            self._views['counters'][_HITS:] = 0
+
+    def _find(self, key):
+        slots = np.flatnonzero(self._views['keys'] == key)
+        return slots[0] if len(slots) else None
+
+    def _read(self, slot):
+        views = self._views
+        ndim, code = views['info'][slot, 0:2]
+        shape = tuple(views['shapes'][slot, :ndim])
+        dtype = _DTYPES[code]
+        nbytes = int(np.prod(shape)) * dtype.itemsize
+        return views['data'][slot, :nbytes].view(dtype).reshape(shape).copy()
+
+    def _victim(self):
+        """
+        Chooses the slot to write to. Empty slots are used first. Otherwise the
+        clock hand sweeps over the slots, clearing reference bits, until it
+        finds one that was not referenced since the last sweep.
+        """
+        views = self._views
+        keys = views['keys']
+        refs = views['info'][:, 2]
+        empty = np.flatnonzero(keys == -1)
+        if len(empty):
+            return empty[0]
+        hand = views['counters'][_HAND]
+        order = np.roll(np.arange(self.n_slots), -hand)
+        unrefs = np.flatnonzero(refs[order] == 0)
+        if len(unrefs):
+            k = unrefs[0]
+            refs[order[:k]] = 0
+        else:
+            # a full sweep clears every bit and stops where it started
+            k = 0
+            refs[:] = 0
+        slot = order[k]
+        views['counters'][_HAND] = (slot + 1) % self.n_slots
+        return slot
+
+
+def cached_method(attr):
+    """
+    Decorates a loader method `func(self, index)` so its results are stored in
+    the `SharedArrayCache` held in the `attr` attribute of the instance.
+    Datasets opt in by setting that attribute, if it is None the method is
+    called directly.
+
+    Example:
+        >>> class Dataset(object):
+        >>>     image_cache = None
+        >>>     @cached_method('image_cache')
+        >>>     def _load_image(self, index):
+        >>>         return np.arange(index)
+        >>> dset = Dataset()
+        >>> assert dset._load_image(3).tolist() == [0, 1, 2]
+        >>> dset.image_cache = SharedArrayCache(2 ** 10, 2 ** 8)
+        >>> assert dset._load_image(3).tolist() == [0, 1, 2]
+        >>> assert dset._load_image(3).tolist() == [0, 1, 2]
+        >>> assert dset.image_cache.stats()['hits'] == 1
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(self, index):
+            cache = getattr(self, attr, None)
+            if cache is None:
+                return func(self, index)
+            return cache.get(index, functools.partial(func, self, index))
+        return wrapper
+    return decorator
+
+
+def _demo_fill(cache, keys):
+    for key in keys:
+        cache.put(key, np.full((8, 8, 3), key, dtype=np.uint8))
+
+
+def _demo_fill_in_subprocess(cache, keys):
+    proc = multiprocessing.Process(target=_demo_fill, args=(cache, keys))
+    proc.start()
+    proc.join()
+
+
+if __name__ == '__main__':
+    r"""
+    CommandLine:
+        python -m clab.data.shmcache all
+    """
+    import xdoctest
+    xdoctest.doctest_module(__file__)
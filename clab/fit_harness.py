@@ -3,7 +3,6 @@ from __future__ import absolute_import, division, print_function, unicode_litera
 import parse
 import numpy as np
 import sys
-import shutil
 import tqdm
 import glob
 from os.path import join
@@ -20,6 +19,9 @@ import warnings
 from clab import metrics
 from clab import xpu_device
 from clab import monitor
+from clab import nnio
+from clab import telemetry
+from clab.data import sampler as data_sampler
 from clab import util  # NOQA
 from clab.util import profiler  # NOQA
 from clab import getLogger
@@ -73,12 +75,21 @@ class grad_context(object):
             return False
 
 
+class _NullContext(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
 class FitHarness(object):
     def __init__(harn, hyper=None, xpu='cpu', loaders=None, workdir=None,
                  nice=None, dry=False, max_keys=[], min_keys=['loss'],
                  max_iter=1000):
 
         harn.flog = None  # file logger
+        harn.tlogger = None  # tensorboard logger
 
         harn.datasets = None
         harn.loaders = None
@@ -105,9 +116,13 @@ class FitHarness(object):
         harn.main_prog = None
 
         harn._batch_metric_hooks = []
-        # harn._epoch_metric_hooks = []
-        harn._run_metrics = None
+        harn._epoch_metric_hooks = []
+        # metrics and scalars are converted and written in a background thread
+        harn.telemetry = telemetry.Telemetry(warn=harn.log)
+        # snapshots are written atomically in a background thread
+        harn.snapshot_writer = nnio.SnapshotWriter()
         harn._custom_run_batch = None
+        harn._batch_transform = None
 
         harn._epoch_callbacks = []
         harn._iter_callbacks = []
@@ -140,7 +155,26 @@ class FitHarness(object):
         harn.config = {
             'show_prog': True,
             'max_iter': max_iter,
+            # number of batches loaded / moved to the xpu in the background
+            # while the current batch is running. Set to 0 to disable.
+            'prefetch': 2,
+            # number of batches to accumulate gradients over before each
+            # optimizer step (effective batch size = accumulate * batch_size)
+            'accumulate': 1,
+            # autocast dtype for the forward pass and loss. Either 'fp32',
+            # 'bf16', or 'fp16' (fp16 uses a dynamic loss scaler)
+            'precision': 'fp32',
+            # drain metrics and write logs in a background thread, so the
+            # training loop never waits on the device to read a metric
+            'async_telemetry': True,
+            # write snapshots in a background thread (the state is copied to
+            # host memory on the training thread first)
+            'async_snapshot': True,
         }
+        # loss scaler for mixed precision training (created in initialize)
+        harn.scaler = None
+        # number of backward passes accumulated since the last optimizer step
+        harn._n_accum = 0
         harn.epoch = 0
         harn.bxs = {}
 
@@ -192,7 +226,17 @@ class FitHarness(object):
         if harn.train_dpath is None:
             harn.setup_dpath(harn.workdir)
 
-        use_file_logger = True
+        if xpu_device.is_distributed():
+            # Each process only iterates over its own shard of the data
+            harn.loaders = {
+                tag: data_sampler.shard_loader(loader)
+                for tag, loader in harn.loaders.items()
+            }
+
+        # Only the main process writes logs and snapshots
+        is_main = xpu_device.is_main_process()
+
+        use_file_logger = is_main
         if use_file_logger and harn.flog is None:
             flog_fname = 'fitlog_{}.log'.format(ub.timestamp())
             flog_fpath = join(harn.train_dpath, flog_fname)
@@ -206,13 +250,23 @@ class FitHarness(object):
             harn.flog = flog
             harn.debug('initialized file logger')
 
-        if tensorboard_logger:
+        if tensorboard_logger and is_main:
             train_base = os.path.dirname(harn.nice_dpath or harn.train_dpath)
             harn.log('dont forget to start: tensorboard --logdir ' + train_base)
             harn.log('Initializing tensorboard')
             harn.tlogger = tensorboard_logger.Logger(harn.train_dpath,
                                                      flush_secs=2)
 
+        sinks = []
+        if harn.tlogger:
+            sinks.append(harn.tlogger)
+        if is_main:
+            sinks.append(telemetry.FileSink(
+                join(harn.train_dpath, 'telemetry.jsonl')))
+        harn.telemetry.sinks = sinks
+        harn.telemetry.background = harn.config['async_telemetry']
+        harn.snapshot_writer.background = harn.config['async_snapshot']
+
         if harn.dry:
             harn.log('Dry run of training harness. xpu={}'.format(harn.xpu))
             harn.optimizer = None
@@ -254,6 +308,8 @@ class FitHarness(object):
 
             harn.log('Make optimizer')
             harn.optimizer = harn.hyper.make_optimizer(harn.model.parameters())
+            harn.scaler = harn._make_scaler()
+            harn._n_accum = 0
 
             if harn.hyper.scheduler_cls:
                 harn.log('Make scheduler')
@@ -263,15 +319,9 @@ class FitHarness(object):
             harn.log('There are {} existing snapshots'.format(len(prev_states)))
             if prev_states and not ub.argflag('--reset'):
                 harn.log('Loading previous states')
-                # Ignore corrupted snapshots
-                for load_path in reversed(prev_states):
-                    try:
-                        harn.load_snapshot(load_path)
-                    except RuntimeError:
-                        harn.log('Failed to load {}. Skiping.'.format(load_path))
-                    else:
-                        needs_init = False
-                        break
+                # Snapshots are written atomically, so the last one is complete
+                harn.load_snapshot(prev_states[-1])
+                needs_init = False
                 for i, group in enumerate(harn.optimizer.param_groups):
                     if 'initial_lr' not in group:
                         raise KeyError("param 'initial_lr' is not specified "
@@ -365,10 +415,9 @@ class FitHarness(object):
                     raise ValueError('need a validataion dataset to use ReduceLROnPlateau')
 
         # Keep track of moving metric averages across epochs
-        harn._run_metrics = {
-            tag: metrics.WindowedMovingAve(window=len(loader))
-            for tag, loader in harn.loaders.items()
-        }
+        for tag, loader in harn.loaders.items():
+            harn.telemetry.set_average(
+                tag + ' iter', metrics.WindowedMovingAve(window=len(loader)))
 
         # if harn.scheduler:
         #     # prestep scheduler?
@@ -403,19 +452,19 @@ class FitHarness(object):
                         harn.run_epoch(test_loader, tag='test', learn=False)
 
                 if improved:
-                    save_path = harn.save_snapshot()
+                    # Link the best snapshot into the main directory
+                    best_path = join(harn.train_dpath, 'best_snapshot.pt')
+                    save_path = harn.save_snapshot(best_path=best_path)
                     if save_path:
                         harn.debug('New best_snapshot {}'.format(save_path))
-                        # Copy the best snapshot the the main directory
-                        best_path = join(harn.train_dpath, 'best_snapshot.pt')
-                        shutil.copy2(save_path, best_path)
                 else:
                     # TODO: allow monitor to clean up old snapshots
                     if harn.check_interval('snapshot', harn.epoch):
                         save_path = harn.save_snapshot()
 
                 if harn.check_interval('cleanup', harn.epoch):
-                    harn.cleanup_snapshots()
+                    if xpu_device.is_main_process():
+                        harn.cleanup_snapshots()
 
                 harn.main_prog.update(1)
 
@@ -433,6 +482,10 @@ class FitHarness(object):
             harn.log('An {} error occurred in the train loop'.format(type(ex)))
             harn._close_prog()
             raise
+        finally:
+            # write out any pending scalars and snapshots
+            harn.telemetry.close()
+            harn.snapshot_writer.close()
 
         harn.log('\n\n\n')
         harn.log('Training completed')
@@ -548,11 +601,11 @@ class FitHarness(object):
         harn.debug(' * loader.batch_size = {}'.format(loader.batch_size))
 
         harn.current_tag = tag
+        harn._set_loader_epoch(loader)
 
-        # Use exponentially weighted or windowed moving averages across epochs
-        iter_moving_metrics = harn._run_metrics[tag]
-        # Use simple moving average within an epoch
-        epoch_moving_metrics = metrics.CumMovingAve()
+        # Use simple moving average within an epoch (and the windowed moving
+        # averages across epochs registered in `run`)
+        harn.telemetry.set_average(tag + ' epoch', metrics.CumMovingAve())
 
         # train batch
         if not harn.dry:
@@ -573,29 +626,36 @@ class FitHarness(object):
         # labels?
         # accumulated = []
         with grad_context(learn):
-            batch_iter = iter(loader)
+            batch_iter = harn._make_batch_iter(loader)
+            stall_time = 0.0
             for bx in range(len(loader)):
-                batch = next(batch_iter)
+                # Time spent blocked on data is time the xpu sits idle
+                tic = time.time()
+                inputs, labels = next(batch_iter)
+                stall_time += time.time() - tic
 
                 harn.bxs[tag] = bx
-                inputs, labels = harn._standardize_batch(batch)
 
-                # Core learning / backprop
-                outputs, loss = harn.run_batch(inputs, labels, learn=learn)
+                # Core learning / backprop (the last batch of the epoch
+                # applies any partially accumulated gradients)
+                outputs, loss = harn.run_batch(
+                    inputs, labels, learn=learn, flush=bx == len(loader) - 1)
 
                 # Measure train accuracy and other informative metrics
                 cur_metrics = harn._call_batch_metric_hooks(outputs, labels,
                                                             loss)
 
-                # Accumulate measures
-                epoch_moving_metrics.update(cur_metrics)
-                iter_moving_metrics.update(cur_metrics)
+                # Accumulate measures (without waiting on the xpu)
+                harn.telemetry.record([tag + ' iter', tag + ' epoch'],
+                                      cur_metrics)
 
                 # display_train training info
                 if harn.check_interval('display_' + tag, bx):
-                    ave_metrics = iter_moving_metrics.average()
+                    # Only shows the metrics drained so far, the interval
+                    # controls the refresh rate and never forces a sync
+                    ave_metrics = harn.telemetry.average(tag + ' iter')
 
-                    msg = harn.batch_msg({'loss': ave_metrics['loss']},
+                    msg = harn.batch_msg({'loss': ave_metrics.get('loss', -1)},
                                          loader.batch_sampler.batch_size)
                     prog.set_description(tag + ' ' + msg)
 
@@ -613,11 +673,29 @@ class FitHarness(object):
                 # Call custom hooks on each iteration
                 for hook in harn._iter_callbacks:
                     hook(harn, tag, loader, bx, inputs, labels, outputs, loss)
+            batch_iter.close()
+
+        if learn and not harn.dry:
+            # Apply any gradients left over from a partial accumulation
+            harn._step_optimizer()
 
         prog.close()
 
+        harn.log_value(tag + ' epoch stall_time', stall_time, harn.epoch)
+
         # Record a true average for the entire batch
-        epoch_metrics = epoch_moving_metrics.average()
+        harn.telemetry.flush()
+        epoch_metrics = harn.telemetry.average(tag + ' epoch')
+        # Average over all processes so each makes the same monitor decisions
+        epoch_metrics = harn._reduce_metrics(epoch_metrics)
+
+        if not harn.dry:
+            for hook in harn._epoch_metric_hooks:
+                _custom_dict = hook(harn, tag)
+                isect = set(_custom_dict).intersection(set(epoch_metrics))
+                if isect:
+                    raise Exception('Conflicting metric hooks: {}'.format(isect))
+                epoch_metrics.update(_custom_dict)
 
         for key, value in epoch_metrics.items():
             harn.log_value(tag + ' epoch ' + key, value, harn.epoch)
@@ -628,7 +706,78 @@ class FitHarness(object):
 
         return epoch_metrics
 
-    def _standardize_batch(harn, batch):
+    def _set_loader_epoch(harn, loader):
+        """
+        Distributed samplers need the epoch to shuffle consistently across
+        processes.
+        """
+        batch_sampler = getattr(loader, 'batch_sampler', None)
+        for sampler in [batch_sampler, getattr(batch_sampler, 'sampler', None)]:
+            if hasattr(sampler, 'set_epoch'):
+                sampler.set_epoch(harn.epoch)
+
+    def _reduce_metrics(harn, metrics_dict):
+        """
+        Averages scalar metrics over all distributed processes
+
+        Example:
+            >>> harn = FitHarness(loaders={})
+            >>> harn._reduce_metrics({'loss': 1.5})
+            {'loss': 1.5}
+        """
+        if not xpu_device.is_distributed():
+            return metrics_dict
+        keys = sorted(metrics_dict.keys())
+        values = torch.DoubleTensor([float(metrics_dict[k]) for k in keys])
+        values = harn.xpu.move(values)
+        torch.distributed.all_reduce(values)
+        values = values.cpu() / xpu_device.get_world_size()
+        return ub.odict(zip(keys, values.tolist()))
+
+    def _make_batch_iter(harn, loader):
+        """
+        Returns a generator of standardized (inputs, labels) batches.
+
+        If `harn.config['prefetch']` is positive, batches are loaded, pinned,
+        and copied to the xpu in a background thread that stays that many
+        batches ahead of the training loop.
+
+        Example:
+            >>> harn = FitHarness(loaders={})
+            >>> loader = [(torch.rand(2, 3), torch.rand(2))] * 3
+            >>> batch_iter = harn._make_batch_iter(loader)
+            >>> inputs, labels = next(batch_iter)
+            >>> assert len(inputs) == 1 and len(labels) == 1
+            >>> assert len(list(batch_iter)) == 2
+            >>> # batches can be transformed after they are on the xpu
+            >>> @harn.set_batch_transform
+            >>> def double(harn, inputs, labels):
+            >>>     return [inputs[0] * 2], labels
+            >>> inputs, labels = next(harn._make_batch_iter(loader))
+            >>> assert torch.all(inputs[0] == loader[0][0] * 2)
+        """
+        depth = harn.config.get('prefetch', 0)
+        if depth:
+            from clab.data import prefetch
+            if harn.xpu.is_gpu():
+                def _stage(batch):
+                    batch = prefetch.pin_batch(batch)
+                    return harn._prepare_batch(batch, non_blocking=True)
+            else:
+                _stage = harn._prepare_batch
+            return iter(prefetch.BatchPrefetcher(loader, stage=_stage,
+                                                 depth=depth))
+        else:
+            return (harn._prepare_batch(batch) for batch in loader)
+
+    def _prepare_batch(harn, batch, non_blocking=False):
+        """ standardizes a batch and applies the custom batch transform """
+        inputs, labels = harn._standardize_batch(batch, non_blocking)
+        if harn._batch_transform is not None:
+            inputs, labels = harn._batch_transform(harn, inputs, labels)
+        return inputs, labels
+
+    def _standardize_batch(harn, batch, non_blocking=False):
         """ ensure batch is in a standardized structure """
         batch_inputs, batch_labels = batch
 
@@ -644,11 +793,13 @@ class FitHarness(object):
             # Handle cases when labels are unstructured
             if isinstance(data, list):
                 # handle one level of nesting
-                return [harn.xpu.variable(d) for d in data]
+                return [harn.xpu.variable(d, non_blocking=non_blocking)
+                        for d in data]
             else:
-                return harn.xpu.variable(data)
+                return harn.xpu.variable(data, non_blocking=non_blocking)
 
-        inputs = [harn.xpu.variable(d) for d in batch_inputs]
+        inputs = [harn.xpu.variable(d, non_blocking=non_blocking)
+                  for d in batch_inputs]
         labels = [_tovar(d) for d in batch_labels]
 
         return (inputs, labels)
@@ -662,28 +813,155 @@ class FitHarness(object):
             print('bx = {!r}'.format(bx))
             if bx >= index:
                 break
-        return harn._standardize_batch(batch)
+        return harn._prepare_batch(batch)
 
     @profiler.profile
-    def run_batch(harn, inputs, labels, learn=False):
+    def run_batch(harn, inputs, labels, learn=False, flush=False):
         """
         Batch with weight updates
 
+        Args:
+            flush (bool): if True the optimizer steps after this batch, even
+                if fewer than `accumulate` batches were accumulated (e.g. at
+                the end of an epoch). Distributed gradients are all-reduced
+                on every batch that steps.
+
         https://github.com/meetshah1995/pytorch-semseg/blob/master/train.py
+
+        Example:
+            >>> import contextlib
+            >>> class Model(torch.nn.Linear):
+            >>>     unsynced = []
+            >>>     @contextlib.contextmanager
+            >>>     def no_sync(self):  # records batches that skip all-reduce
+            >>>         self.unsynced.append(harn._n_accum)
+            >>>         yield
+            >>> harn = FitHarness(loaders={})
+            >>> harn.config['accumulate'] = 2
+            >>> harn.model = Model(3, 1, bias=False)
+            >>> harn.optimizer = torch.optim.SGD(harn.model.parameters(), lr=1)
+            >>> harn.set_batch_runner(
+            >>>     lambda harn, inputs, labels: (None, harn.model(inputs[0]).sum()))
+            >>> # an epoch of 3 batches: a full group and a leftover batch
+            >>> xs = [torch.rand(4, 3) for _ in range(3)]
+            >>> for bx, x in enumerate(xs):
+            >>>     before = harn.model.weight.data.clone()
+            >>>     harn.run_batch([x], [None], learn=True, flush=bx == len(xs) - 1)
+            >>> # only the first batch skips the all-reduce
+            >>> assert harn.model.unsynced == [0]
+            >>> assert harn._n_accum == 0
+            >>> # the leftover batch is not down-weighted by the group size
+            >>> step = before - harn.model.weight.data
+            >>> assert torch.allclose(step, xs[-1].sum(dim=0, keepdim=True))
         """
-        # Run custom forward pass with loss computation, fallback to default
-        if harn._custom_run_batch is None:
-            outputs, loss = harn._default_run_batch(harn, inputs, labels)
-        else:
-            outputs, loss = harn._custom_run_batch(harn, inputs, labels)
+        accumulate = harn.config.get('accumulate', 1)
+        sync_context = _NullContext()
+        if learn and not flush and harn._n_accum + 1 < accumulate:
+            # Only all-reduce distributed gradients on the stepping batch
+            if hasattr(harn.model, 'no_sync'):
+                sync_context = harn.model.no_sync()
+
+        with sync_context:
+            # Run custom forward pass with loss computation, fallback to default
+            with harn._autocast():
+                if harn._custom_run_batch is None:
+                    outputs, loss = harn._default_run_batch(harn, inputs, labels)
+                else:
+                    outputs, loss = harn._custom_run_batch(harn, inputs, labels)
+
+            # Backprop and learn
+            if learn and not harn.dry:
+                if harn._n_accum == 0:
+                    harn.optimizer.zero_grad()
+                # Average gradients over the accumulated batches
+                step_loss = loss / accumulate if accumulate > 1 else loss
+                if harn.scaler is not None:
+                    step_loss = harn.scaler.scale(step_loss)
+                step_loss.backward()
+                harn._n_accum += 1
+
+        if learn and not harn.dry and (flush or harn._n_accum >= accumulate):
+            harn._step_optimizer()
 
-        # Backprop and learn
-        if learn and not harn.dry:
-            harn.optimizer.zero_grad()
-            loss.backward()
+        return outputs, loss
+
+    def _step_optimizer(harn):
+        """
+        Applies the accumulated gradients (if any) and resets the accumulator
+        """
+        if harn._n_accum == 0:
+            return
+        accumulate = harn.config.get('accumulate', 1)
+        if harn._n_accum < accumulate:
+            # The losses were divided by `accumulate`, rescale a partial group
+            # so it is the average over the batches it actually has.
+            factor = accumulate / harn._n_accum
+            for group in harn.optimizer.param_groups:
+                for param in group['params']:
+                    if param.grad is not None:
+                        param.grad.data.mul_(factor)
+        if harn.scaler is not None:
+            # the scaler skips the step if the gradients overflowed
+            harn.scaler.step(harn.optimizer)
+            harn.scaler.update()
+        else:
             harn.optimizer.step()
+        harn._n_accum = 0
+
+    def _autocast_dtype(harn):
+        precision = harn.config.get('precision', 'fp32')
+        lookup = {
+            'fp32': None, 'float32': None,
+            'bf16': 'bfloat16', 'bfloat16': 'bfloat16',
+            'fp16': 'float16', 'float16': 'float16',
+        }
+        if precision not in lookup:
+            raise KeyError('unknown precision={!r}'.format(precision))
+        dtype_name = lookup[precision]
+        if dtype_name is None:
+            return None
+        if not hasattr(torch, 'autocast'):
+            raise RuntimeError('precision={} requires torch.autocast'.format(
+                precision))
+        if dtype_name == 'float16' and not harn.xpu.is_gpu():
+            raise ValueError('fp16 autocast requires a gpu, use bf16 on cpu')
+        return getattr(torch, dtype_name)
+
+    def _autocast(harn):
+        """
+        Context for the forward pass and loss computation. This is a no-op
+        unless `harn.config['precision']` requests reduced precision.
+
+        Example:
+            >>> harn = FitHarness(loaders={})
+            >>> harn.config['precision'] = 'bf16'
+            >>> model = torch.nn.Linear(3, 2)
+            >>> with harn._autocast():
+            >>>     out = model(torch.rand(4, 3))
+            >>> assert out.dtype == torch.bfloat16
+        """
+        dtype = harn._autocast_dtype()
+        if dtype is None:
+            return _NullContext()
+        device_type = 'cuda' if harn.xpu.is_gpu() else 'cpu'
+        return torch.autocast(device_type, dtype=dtype)
 
-        return outputs, loss
+    def _make_scaler(harn):
+        """
+        Creates a dynamic loss scaler if the precision requires one.
+
+        Gradients computed in bfloat16 have the same exponent range as fp32,
+        so the scaler is only enabled for fp16.
+        """
+        dtype = harn._autocast_dtype()
+        if dtype is None:
+            return None
+        enabled = dtype == torch.float16
+        device_type = 'cuda' if harn.xpu.is_gpu() else 'cpu'
+        if hasattr(torch, 'amp') and hasattr(torch.amp, 'GradScaler'):
+            return torch.amp.GradScaler(device_type, enabled=enabled)
+        else:
+            return torch.cuda.amp.GradScaler(enabled=enabled)
 
     def _default_run_batch(harn, harn_, inputs, labels):
         # What happens when there are multiple criterions?
@@ -732,6 +1010,19 @@ class FitHarness(object):
         harn._custom_run_batch = func
         return func
 
+    def set_batch_transform(harn, func):
+        """
+        Define a transform applied to each batch after it is moved to the
+        xpu (e.g. resizing all images of a batch at once on the GPU instead of
+        one at a time in the loader workers).
+
+        Args:
+            func : accepts 3 args (harn, inputs, labels) and returns the new
+                (inputs, labels).
+        """
+        harn._batch_transform = func
+        return func
+
     def add_batch_metric_hook(harn, hook):
         """
         Adds a hook to measure performance after each batch iteration
@@ -742,6 +1033,7 @@ class FitHarness(object):
         These scalars will be summarized by a moving average over all batches
         """
         harn._batch_metric_hooks.append(hook)
+        return hook
 
     def add_epoch_callback(harn, hook):
         """
@@ -758,29 +1050,26 @@ class FitHarness(object):
         """
         harn._iter_callbacks.append(hook)
 
-    # def add_epoch_metric_hook(harn, hook):
-    #     """
-    #     Adds a hook to measure performance after each epoch
+    def add_epoch_metric_hook(harn, hook):
+        """
+        Adds a hook to measure performance after each epoch
 
-    #     The hook should take arguments
-    #     (harn, accumulated) and return a dictionary of scalar metrics
+        The hook should take arguments (harn, tag) and return a dictionary of
+        scalar metrics for the epoch that just finished (e.g. the summary of a
+        `clab.metrics.ConfusionAccumulator` updated by a batch metric hook).
 
-    #     by default `accumulated` is a list of outputs and labels gathered over
-    #     all batches with each item representing the result of a batch.
-    #     """
-    #     harn._epoch_metric_hooks.append(hook)
+        These scalars are logged and monitored like the batch metric averages,
+        but they are not averaged over distributed processes, so the hook
+        should reduce its own state.
+        """
+        harn._epoch_metric_hooks.append(hook)
+        return hook
 
     def _call_batch_metric_hooks(harn, output, label, loss):
-        loss_sum = loss.data.sum()
-        inf = float("inf")
-        if loss_sum == inf or loss_sum == -inf:
-            harn.log("WARNING: received an inf loss, setting loss value to 0")
-            loss_value = 0
-        else:
-            loss_value = loss_sum
-
+        # Non-finite values (e.g. an inf loss) are logged and replaced by 0
+        # when the telemetry thread reads them
         metrics_dict = {
-            'loss': loss_value,
+            'loss': loss.data.sum(),
         }
         if not harn.dry:
             for custom_metrics in harn._batch_metric_hooks:
@@ -812,6 +1101,7 @@ class FitHarness(object):
         """
         load_path = join(harn.snapshot_dpath,
                          '_epoch_{:08d}.pt'.format(epoch))
+        harn.snapshot_writer.wait()
         snapshot = harn.xpu.load(load_path)
 
         print('\n\n\n\n')
@@ -826,6 +1116,7 @@ class FitHarness(object):
         Sets the harness to its state just after an epoch finished
         """
         harn.log('Loading previous state: {}'.format(load_path))
+        harn.snapshot_writer.wait()
         snapshot = harn.xpu.load(load_path)
         # the snapshot holds the previous epoch, so add one to move to current
         harn.epoch = snapshot['epoch'] + 1
@@ -842,10 +1133,26 @@ class FitHarness(object):
         if 'optimizer_state_dict' in snapshot:
             harn.optimizer.load_state_dict(snapshot['optimizer_state_dict'])
             harn.debug('loaded optimizer_state_dict')
+
+        if snapshot.get('scaler_state_dict') and harn.scaler is not None:
+            harn.scaler.load_state_dict(snapshot['scaler_state_dict'])
+            harn.debug('loaded scaler_state_dict')
         harn.log('Resuming training...')
 
-    def save_snapshot(harn):
-        # save snapshot
+    def save_snapshot(harn, best_path=None):
+        """
+        Starts writing a snapshot of the current epoch (see
+        `nnio.SnapshotWriter`). The file appears once it is complete.
+
+        Args:
+            best_path (str): if specified, this path is linked to the snapshot
+
+        Returns:
+            str: the path the snapshot is written to
+        """
+        if not xpu_device.is_main_process():
+            # all processes have the same weights, so only one needs to save
+            return None
         ub.ensuredir(harn.snapshot_dpath)
         save_path = join(harn.snapshot_dpath, '_epoch_{:08d}.pt'.format(harn.epoch))
         if harn.dry:
@@ -867,14 +1174,17 @@ class FitHarness(object):
                 'model_state_dict': harn.model.state_dict(),
                 'optimizer_state_dict': harn.optimizer.state_dict(),
                 'monitor_state_dict': harn.monitor.state_dict(),
+                'scaler_state_dict': (None if harn.scaler is None else
+                                      harn.scaler.state_dict()),
             }
-            torch.save(snapshot, save_path)
-            harn.debug('Snapshot saved to {}'.format(save_path))
+            harn.snapshot_writer.save(snapshot, save_path, link_fpath=best_path)
+            harn.debug('Snapshot saving to {}'.format(save_path))
             return save_path
 
     def log(harn, msg):
         harn.debug(msg)
-        print(msg)
+        if xpu_device.is_main_process():
+            print(msg)
 
     def debug(harn, msg):
         if harn.flog:
@@ -883,9 +1193,11 @@ class FitHarness(object):
             harn.flog.debug(msg)
 
     def log_value(harn, key, value, n_iter):
-        if harn.tlogger:
-            harn.tlogger.log_value(key, value, n_iter)
-        harn.debug('log_value({}, {}, {}'.format(key, value, n_iter))
+        """
+        Writes a scalar to tensorboard and `telemetry.jsonl` (asynchronously,
+        tensors are read in the telemetry thread)
+        """
+        harn.telemetry.log_value(key, value, n_iter)
 
     def log_histogram(harn, key, value, n_iter):
         if harn.tlogger:
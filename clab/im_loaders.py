@@ -14,6 +14,15 @@ import numpy as np
 
 def np_loader(fpath, colorspace=None):
     im_in = imutil.imread(fpath)
+    return np_convert(im_in, colorspace)
+
+
+def np_convert(im_in, colorspace=None):
+    """
+    Converts raw image data (as returned by `imutil.imread`) the same way as
+    `np_loader`. Used for data that is already in memory (e.g. chips of a
+    `clab.data.chipstore.ChipStore`).
+    """
     if colorspace is not None:
         cv_255 = im_in  # Assume we read a (bgr) byte image
         cv_01 = cv_255.astype(np.float32) / 255.0
@@ -144,6 +153,9 @@ def pil_image_to_float_tensor(pic):
 
 
 def numpy_image_to_float_tensor(im):
+    if not im.flags.writeable:
+        # e.g. memory mapped chips, which torch warns about wrapping
+        im = im.astype(np.float32)
     return torch.from_numpy(util.atleast_nd(im, n=3).transpose(2, 0, 1)).float()
 
 
@@ -174,6 +186,19 @@ def pil_label_to_long_tensor(pic):
 
 
 def numpy_label_to_long_tensor(gt):
+    """
+    Example:
+        >>> import warnings
+        >>> gt = np.arange(6, dtype=np.uint8).reshape(2, 3)
+        >>> gt.flags.writeable = False
+        >>> with warnings.catch_warnings():
+        >>>     warnings.simplefilter('error')
+        >>>     tensor = numpy_label_to_long_tensor(gt)
+        >>> assert tensor.dtype == torch.int64 and tensor.shape == (2, 3)
+    """
+    if not gt.flags.writeable:
+        # e.g. memory mapped chips, which torch warns about wrapping
+        gt = gt.astype(np.int64)
     return torch.from_numpy(gt).long()
 
 
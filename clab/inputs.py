@@ -2,6 +2,7 @@
 from __future__ import absolute_import, division, print_function
 from os.path import basename, abspath, join, exists
 import json
+import multiprocessing
 import numpy as np
 import six
 import pandas as pd
@@ -437,8 +438,19 @@ class Inputs(ub.NiceRepr):
                                                  ub.compressuser(self.input_fpath)))
 
     def prepare_center_stats(self, task, nan_value=-32767.0, colorspace='RGB',
-                             with_im=False, stride=1):
+                             with_im=False, stride=1, workers=None):
         """
+        Computes intensity statistics used to center the data.
+
+        The statistics are computed over chunks of images in a process pool
+        and the partial results are merged. The merged partial statistics are
+        cached together with the images they cover, so when images are added
+        to a split only the new images are processed.
+
+        Args:
+            workers (int): number of processes. Defaults to the number of CPUs.
+                If 0, stats are computed in the main process.
+
         Ignore:
             >>> from clab.sseg_train import *
             >>> #task = get_task('urban_mapper_3d')
@@ -455,8 +467,9 @@ class Inputs(ub.NiceRepr):
         import pickle
         import copy
         from clab.util import jsonutil
-        from clab.transforms import NaNInputer
-        from clab import im_loaders
+
+        if workers is None:
+            workers = multiprocessing.cpu_count()
 
         self.prepare_input()
         fpath = join(self.input_dpath, 'center_stats{}.pkl'.format(colorspace))
@@ -465,49 +478,14 @@ class Inputs(ub.NiceRepr):
 
         if not exists(fpath):
             print('Need to compute intensity stats')
-            im_paths = self.im_paths
-
-            class IntensityStats(object):
-                def __init__(p):
-                    p.run = util.RunningStats()
-                    p.scalar_internals = util.InternalRunningStats()
-                    p.channel_internals = util.InternalRunningStats(axis=(0, 1))
-
-                def update(p, im):
-                    p.run.update(im)
-                    p.scalar_internals.update(im)
-                    p.channel_internals.update(im)
-
-                def info(p):
-                    image_simple_info = {
-                        'desc': 'statistics about the per channel/entire intensity averaged across the dataset',
-                        'channel': p.run.simple(axis=(0, 1)),
-                        'image': p.run.simple(),
-                    }
-
-                    image_detail_info = {
-                        'desc': 'statistics about the per pixel intensity averaged across the dataset',
-                        'pixel': p.run.detail(),
-                    }
-
-                    image_internal_info = {
-                        'desc': 'statistics about the average internal mean/med/mad/std intensity within an image',
-                        'image': p.scalar_internals.info(),
-                        'channel': p.channel_internals.info(),
-                    }
-
-                    return {
-                        'simple': image_simple_info,
-                        'detail': image_detail_info,
-                        'internal': image_internal_info,
-                    }
+            cache_dpath = ub.ensuredir((self.base_dpath or self.input_dpath,
+                                        'center_partials'))
 
             if with_im:
-                run_im = IntensityStats()
-                im_paths = im_paths[::stride]
-                for path in ub.ProgIter(im_paths, label='computing mean image', verbose=1):
-                    im = im_loaders.np_loader(path, colorspace=colorspace)
-                    run_im.update(im)
+                records = [(p,) for p in self.im_paths[::stride]]
+                config = ('im', colorspace)
+                run_im = _cached_intensity_stats(cache_dpath, records, config,
+                                                 workers)
                 im_info = run_im.info()
                 im_info['colorspace'] = colorspace
             else:
@@ -515,18 +493,11 @@ class Inputs(ub.NiceRepr):
 
             if self.aux_paths:
                 # nan_value = -32767.0
-                nan_inputer = NaNInputer(fill='median', nan_value=nan_value)
-                run_aux = IntensityStats()
-                prog = ub.ProgIter(label='aux stats', verbose=1)
-
-                paths_list = list(zip(*self.aux_paths.values()))[::stride]
-
-                for aux_paths in prog(paths_list):
-                    aux = np.dstack([im_loaders.np_loader(path) for path in aux_paths])
-                    aux = nan_inputer(aux)
-                    run_aux.update(aux)
-
                 aux_channel_names = list(self.aux_paths.keys())
+                records = list(zip(*self.aux_paths.values()))[::stride]
+                config = ('aux', nan_value, aux_channel_names)
+                run_aux = _cached_intensity_stats(cache_dpath, records, config,
+                                                  workers)
                 aux_info = run_aux.info()
                 aux_info['channel_names'] = aux_channel_names
             else:
@@ -558,9 +529,15 @@ class Inputs(ub.NiceRepr):
             info = pickle.load(file)
         return info
 
-    def prepare_gtstats(self, task, force=False):
+    def prepare_gtstats(self, task, force=False, workers=None, chips=None):
         """
         Caches stats like class frequency to disk, before we start training
+
+        Args:
+            workers (int): number of processes used to count labels. Defaults
+                to the number of CPUs.
+            chips (clab.data.chipstore.ChipStore): if specified, labels are
+                counted directly from the packed `gt` array of the store.
         """
         self.prepare_input()
         gtstats_fpath = join(self.input_dpath, 'gtstats_v1.json')
@@ -570,37 +547,56 @@ class Inputs(ub.NiceRepr):
         else:
             self.prepare_images()
             gt_paths = self.paths['gt']
-            gtstats = self._compute_gt_info(gt_paths, task)
+            gtstats = self._compute_gt_info(gt_paths, task, workers=workers,
+                                            chips=chips)
             # pretty writing of json stats
             json_text = (json.dumps(json.loads(gtstats.to_json()), indent=4))
             ub.writeto(gtstats_fpath, json_text)
         self.gtstats = gtstats
         return self.gtstats
 
-    def _compute_gt_info(self, gt_paths, task):
-        # self.imdir  = expanduser('~/store/segnet-exact/SegNet-Tutorial/CamVid/train')
-        # self.gtdir  = expanduser('~/store/segnet-exact/SegNet-Tutorial/CamVid/trainannot')
-        # def insert_empty_rows(df, new_index, fill_value=np.nan):
-        #     # TODO: Is there a better way to do this? Maybe inplace?
-        #     # shape = (len(new_index), len(df.columns))
-        #     # data = np.full(shape, fill_value=fill_value)
-        #     fill = pd.DataFrame(fill_value, index=new_index, columns=df.columns)
-        #     return pd.concat([df, fill])
-        # new_index = pxlfreq.index.difference(gtstats.index).astype(np.int64)
-        # if len(new_index) > 0:
-        #     # Expand the dataframe to capture all classes
-        #     gtstats = insert_empty_rows(gtstats, new_index, fill_value=0)
-        index = pd.Index(task.labels, name='labels')
-        gtstats = pd.DataFrame(0, index=index, columns=['pxlfreq', 'imfreq'],
-                               dtype=np.int)
+    def _compute_gt_info(self, gt_paths, task, workers=None, chips=None):
+        """
+        Example:
+            >>> import tempfile
+            >>> from clab.util import imutil
+            >>> from clab.data.chipstore import ChipStore
+            >>> class Task(object):
+            >>>     labels = np.arange(4)
+            >>>     classnames = ['a', 'b', 'c', 'd']
+            >>> dpath = tempfile.mkdtemp()
+            >>> rng = np.random.RandomState(0)
+            >>> self = Inputs()
+            >>> self.base_dpath = dpath
+            >>> self.gt_paths = []
+            >>> for i in range(5):
+            >>>     fpath = join(dpath, 'gt{}.png'.format(i))
+            >>>     imutil.imwrite(fpath, rng.randint(0, 3, (6, 7)).astype(np.uint8))
+            >>>     self.gt_paths.append(fpath)
+            >>> gtstats = self._compute_gt_info(self.gt_paths, Task, workers=0)
+            >>> freqs = gtstats[['pxlfreq', 'imfreq']].values.T.tolist()
+            >>> assert freqs == [[77, 66, 67, 0], [5, 5, 5, 0]]
+            >>> chips = ChipStore.from_inputs(self, join(dpath, 'packed'))
+            >>> gtstats2 = self._compute_gt_info(self.gt_paths, Task, chips=chips)
+            >>> assert gtstats.equals(gtstats2)
+        """
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        n_labels = int(np.max(task.labels)) + 1
+        if chips is not None:
+            counts = _chip_label_counts(chips.arrays['gt'], n_labels)
+        else:
+            cache_fpath = join(self.base_dpath or self.input_dpath,
+                               'gt_counts_{}.npz'.format(n_labels))
+            counts = _cached_label_counts(cache_fpath, gt_paths, n_labels,
+                                          workers)
+        counts = counts[:, task.labels]
 
-        for path in ub.ProgIter(gt_paths, label='computing class weights', verbose=1):
-            y_true = util.imread(path).ravel()
-            pxlfreq = pd.value_counts(y_true)
-            gtstats.pxlfreq.loc[pxlfreq.index] += pxlfreq
-            gtstats.imfreq.loc[pxlfreq.index] += 1
-        gtstats.pxlfreq = pd.to_numeric(gtstats.pxlfreq)
-        gtstats.imfreq = pd.to_numeric(gtstats.imfreq)
+        index = pd.Index(task.labels, name='labels')
+        gtstats = pd.DataFrame({
+            'pxlfreq': counts.sum(axis=0),
+            'imfreq': (counts > 0).sum(axis=0),
+        }, index=index, columns=['pxlfreq', 'imfreq'])
 
         gtstats['classname'] = list(ub.take(task.classnames, gtstats.index))
         gtstats['mf_weight'] = gtstats.pxlfreq.median() / gtstats.pxlfreq
@@ -615,3 +611,258 @@ class Inputs(ub.NiceRepr):
 
     def align(self, other):
         return fnameutil.align_paths(self.im_paths, other)
+
+
+class IntensityStats(object):
+    """
+    Per pixel, per channel, and image-internal intensity statistics of a set
+    of images. Stats of disjoint sets of images can be combined with `merge`.
+    """
+    def __init__(p):
+        p.run = util.RunningStats()
+        p.scalar_internals = util.InternalRunningStats()
+        p.channel_internals = util.InternalRunningStats(axis=(0, 1))
+
+    def update(p, im):
+        p.run.update(im)
+        p.scalar_internals.update(im)
+        p.channel_internals.update(im)
+
+    def merge(p, other):
+        p.run.merge(other.run)
+        p.scalar_internals.merge(other.scalar_internals)
+        p.channel_internals.merge(other.channel_internals)
+        return p
+
+    def info(p):
+        image_simple_info = {
+            'desc': 'statistics about the per channel/entire intensity averaged across the dataset',
+            'channel': p.run.simple(axis=(0, 1)),
+            'image': p.run.simple(),
+        }
+
+        image_detail_info = {
+            'desc': 'statistics about the per pixel intensity averaged across the dataset',
+            'pixel': p.run.detail(),
+        }
+
+        image_internal_info = {
+            'desc': 'statistics about the average internal mean/med/mad/std intensity within an image',
+            'image': p.scalar_internals.info(),
+            'channel': p.channel_internals.info(),
+        }
+
+        return {
+            'simple': image_simple_info,
+            'detail': image_detail_info,
+            'internal': image_internal_info,
+        }
+
+
+def _intensity_stats_job(job):
+    """
+    Computes the IntensityStats of a chunk of records. A record is a tuple of
+    paths that are stacked into a single image. For 'im' configs the record
+    is a single image loaded in the configured colorspace, for 'aux' configs
+    the channels are stacked and their nans are imputed.
+    """
+    from clab.transforms import NaNInputer
+    from clab import im_loaders
+    records, config = job
+    stats = IntensityStats()
+    if config[0] == 'im':
+        colorspace = config[1]
+        for (path,) in records:
+            im = im_loaders.np_loader(path, colorspace=colorspace)
+            stats.update(im)
+    else:
+        nan_value = config[1]
+        nan_inputer = NaNInputer(fill='median', nan_value=nan_value)
+        for paths in records:
+            aux = np.dstack([im_loaders.np_loader(path) for path in paths])
+            aux = nan_inputer(aux)
+            stats.update(aux)
+    return stats
+
+
+def _cached_intensity_stats(cache_dpath, records, config, workers=0):
+    """
+    Computes the IntensityStats of all records, starting from the largest
+    cached partial result that covers a subset of them.
+
+    Each cached partial is a pickle with a json sidecar listing the records it
+    covers. The sidecar is written last and marks the partial as complete.
+
+    Example:
+        >>> import tempfile
+        >>> from clab.util import imutil
+        >>> dpath = tempfile.mkdtemp()
+        >>> rng = np.random.RandomState(0)
+        >>> records = []
+        >>> for i in range(6):
+        >>>     fpath = join(dpath, 'im{}.png'.format(i))
+        >>>     imutil.imwrite(fpath, rng.randint(0, 255, (5, 6, 3)).astype(np.uint8))
+        >>>     records.append((fpath,))
+        >>> cache_dpath = ub.ensuredir((dpath, 'cache'))
+        >>> config = ('im', 'RGB')
+        >>> part = _cached_intensity_stats(cache_dpath, records[:4], config)
+        >>> # only the two new images are processed here
+        >>> full = _cached_intensity_stats(cache_dpath, records, config)
+        >>> serial = _intensity_stats_job((records, config))
+        >>> a, b = full.info()['simple']['channel'], serial.info()['simple']['channel']
+        >>> assert full.run.n == 6
+        >>> assert all(np.allclose(a[k], b[k]) for k in a.keys())
+    """
+    import glob
+    import pickle
+    cfgstr = ub.hash_data(config)[:16]
+    record_set = set(records)
+
+    best_fpath, best_done = None, set()
+    for meta_fpath in glob.glob(join(cache_dpath, cfgstr + '_*.json')):
+        with open(meta_fpath, 'r') as file:
+            done = set(map(tuple, json.load(file)))
+        if len(done) > len(best_done) and done.issubset(record_set):
+            best_fpath, best_done = meta_fpath, done
+
+    if best_fpath is not None:
+        with open(best_fpath[:-len('.json')] + '.pkl', 'rb') as file:
+            stats = pickle.load(file)
+        todo = [r for r in records if r not in best_done]
+        print('reusing cached stats of {}/{} images'.format(
+            len(best_done), len(records)))
+    else:
+        stats = IntensityStats()
+        todo = list(records)
+
+    if todo:
+        # A few chunks per worker balances the pool while keeping the number
+        # of (image sized) partial results sent between processes low.
+        for part in _map_chunks(_intensity_stats_job, todo, config, workers,
+                                n_chunks=max(1, workers) * 4,
+                                label='intensity stats'):
+            stats.merge(part)
+
+        cache_fpath = join(cache_dpath, cfgstr + '_' + ub.hash_data(
+            sorted(records))[:16])
+        with open(cache_fpath + '.pkl', 'wb') as file:
+            pickle.dump(stats, file)
+        ub.writeto(cache_fpath + '.json', json.dumps(sorted(records)))
+    return stats
+
+
+def _map_chunks(func, items, config, workers=0, n_chunks=None, label=None):
+    """
+    Calls `func((chunk, config))` on contiguous chunks of `items` in a process
+    pool and yields the results in order.
+
+    Args:
+        func (callable): module level function (so it can be pickled)
+        items (list): items to split into chunks
+        config (object): extra argument passed with each chunk
+        workers (int): number of processes. If 0, runs in this process.
+        n_chunks (int): number of chunks. Defaults to 16 per worker.
+    """
+    if n_chunks is None:
+        n_chunks = max(1, workers) * 16
+    n_chunks = max(1, min(len(items), n_chunks))
+    bounds = np.linspace(0, len(items), n_chunks + 1).astype(int)
+    jobs = [(items[a:b], config) for a, b in zip(bounds[:-1], bounds[1:])]
+    prog = ub.ProgIter(total=len(items), label=label, verbose=1)
+    prog.begin()
+    if workers == 0 or len(jobs) == 1:
+        pool = None
+        results = map(func, jobs)
+    else:
+        pool = multiprocessing.Pool(min(workers, len(jobs)))
+        results = pool.imap(func, jobs)
+    try:
+        for job, result in zip(jobs, results):
+            prog.step(len(job[0]))
+            yield result
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+    prog.end()
+
+
+def _hash_files_job(job):
+    paths, hasher = job
+    return [ub.hash_file(path, hasher=hasher) for path in paths]
+
+
+def _label_counts_job(job):
+    """
+    Returns:
+        ndarray: [len(paths), n_labels] pixel count of each label per image.
+            Labels outside of [0, n_labels) are not counted.
+    """
+    paths, n_labels = job
+    counts = np.empty((len(paths), n_labels), dtype=np.int64)
+    for ix, path in enumerate(paths):
+        y_true = util.imread(path).ravel()
+        counts[ix] = np.bincount(y_true, minlength=n_labels)[:n_labels]
+    return counts
+
+
+def _chip_label_counts(gt_array, n_labels, batch_size=256):
+    """
+    Counts the labels of each chip in a packed [N, H, W] label array. Each
+    batch of chips is counted with a single bincount by offsetting the labels
+    of the i-th chip by `i * n_labels`.
+
+    Example:
+        >>> gt_array = np.array([[[0, 1], [1, 5]], [[2, 2], [2, 2]]])
+        >>> _chip_label_counts(gt_array, n_labels=3).tolist()
+        [[1, 2, 0], [0, 0, 4]]
+    """
+    n_chips = len(gt_array)
+    counts = np.empty((n_chips, n_labels), dtype=np.int64)
+    for start in range(0, n_chips, batch_size):
+        batch = np.asarray(gt_array[start:start + batch_size])
+        batch = batch.reshape(len(batch), -1).astype(np.int64)
+        # labels that are out of range go to a discarded extra bin
+        batch[(batch < 0) | (batch >= n_labels)] = n_labels
+        batch += np.arange(len(batch))[:, None] * (n_labels + 1)
+        flat = np.bincount(batch.ravel(), minlength=len(batch) * (n_labels + 1))
+        counts[start:start + len(batch)] = flat.reshape(-1, n_labels + 1)[:, :n_labels]
+    return counts
+
+
+def _cached_label_counts(cache_fpath, gt_paths, n_labels, workers=0):
+    """
+    Returns the per-image label counts of `gt_paths`. Counts are cached by
+    file content hash, so only new or changed label images are read.
+    """
+    import os
+    hasher = 'sha1'
+    gt_paths = list(gt_paths)
+    hashes = [h for part in _map_chunks(_hash_files_job, gt_paths, hasher,
+                                        workers, label='hashing labels')
+              for h in part]
+
+    cached = {}
+    if exists(cache_fpath):
+        data = np.load(cache_fpath)
+        cached = dict(zip(data['hashes'].tolist(), data['counts']))
+
+    new_idxs = sorted({h: ix for ix, h in enumerate(hashes)
+                       if h not in cached}.values())
+    if new_idxs:
+        new_paths = [gt_paths[ix] for ix in new_idxs]
+        new_counts = np.vstack(list(_map_chunks(
+            _label_counts_job, new_paths, n_labels, workers,
+            label='computing class weights')))
+        for ix, row in zip(new_idxs, new_counts):
+            cached[hashes[ix]] = row
+        # atomically rewrite the cache
+        tmp_fpath = cache_fpath + '.tmp'
+        with open(tmp_fpath, 'wb') as file:
+            np.savez(file, hashes=np.array(list(cached.keys())),
+                     counts=np.array(list(cached.values()), dtype=np.int64))
+        os.rename(tmp_fpath, cache_fpath)
+
+    counts = np.array([cached[h] for h in hashes], dtype=np.int64)
+    counts = counts.reshape(len(hashes), n_labels)
+    return counts
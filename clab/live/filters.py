@@ -1,5 +1,6 @@
-import cv2
+import warnings
 import numpy as np
+from clab.live import instance_labeling
 
 
 # def mask(mask, k=3, n_iter=2):
@@ -10,6 +11,9 @@ import numpy as np
 
 def watershed_filter(mask, dist_thresh=5, topology=None, demo_mode=False):
     """
+    Splits touching objects in a mask (see
+    `clab.live.instance_labeling.InstanceLabeler.watershed_filter`)
+
     References:
         https://docs.opencv.org/trunk/d3/db4/tutorial_py_watershed.html
 
@@ -67,75 +71,12 @@ def watershed_filter(mask, dist_thresh=5, topology=None, demo_mode=False):
         # pt.imshow(task.instance_colorize(cc_labels))
 
     """
-    # Apply watershed to NN results
-    # https://docs.opencv.org/trunk/d3/db4/tutorial_py_watershed.html
-    # Finding sure foreground area
-
-    dist_fg = cv2.distanceTransform(mask, cv2.DIST_L2, maskSize=3)
-
-    sure_fg = (dist_fg > dist_thresh)
-    # prob_fg = dist_fg / dist_fg.max()
-    # sure_fg = (prob_fg > thresh)
-
-    # Finding unknown region
-    # unknown = mask - sure_fg
-
-    # Marker labeling, mark the region of unknown with zero
-    n_seeds, seed_ccs = cv2.connectedComponents(sure_fg.astype(np.uint8))
-    # print('n_seeds = {!r}'.format(n_seeds))
-    # Mark the unknown places with 0
-    # seeds[unknown.astype(np.bool)] = 0
-
-    # Note, anything that is not part of the foreground will be filled in by
-    # the watershed. We don't want to use it for segmentation, we are only
-    # using it to find the boundararies at which two seed objects meet.
-
-    if topology is None:
-        topology = np.dstack([mask, mask, mask])
-
-    markers = seed_ccs.copy() if demo_mode else seed_ccs
-    markers = cv2.watershed(topology, markers)
-    # -1 indicates boundaries between objects
-    boundaries = (markers == -1)
-
-    # Remove all locations that were not part of the original mask
-    mask_markers = markers.copy() if demo_mode else markers
-    mask_markers[mask == 0] = 0
-
-    # If our initial segmentation is pretty tight, removing the background will
-    # hurt us. We find and remove only the boundaries that separate two
-    # non-background regions.
-    locs = np.where(boundaries)
-    shape = mask_markers.shape
-
-    high = [np.minimum(locs[i] + 1, shape[i] - 1) for i in range(2)]
-    low  = [np.maximum(locs[i] - 1, 0) for i in range(2)]
-
-    # high = [locs[i] + 1 for i in range(2)]
-    # low  = [locs[i] - 1 for i in range(2)]
-    # high_boundry = [high[i] >= shape[i] for i in range(2)]
-    # low_boundry  = [low[i] <= 0 for i in range(2)]
-
-    neighors8 = np.hstack([
-        # important to use 8-cc here
-        mask_markers[(high[0], locs[1])][:, None],
-        mask_markers[( low[0], locs[1])][:, None],
-        mask_markers[(locs[0], high[1])][:, None],
-        mask_markers[(locs[0],  low[1])][:, None],
-        mask_markers[(high[0], high[1])][:, None],
-        mask_markers[( low[0],  low[1])][:, None],
-        mask_markers[( low[0], high[1])][:, None],
-        mask_markers[(high[0],  low[1])][:, None],
-    ])
-    non_seed_labels = {-1, 0}
-    # Find boundaries that are adjacent to multiple different seed labels
-    on_boundry = [len(s - non_seed_labels) > 1 for s in map(set, neighors8)]
-    separator_locs = [x.compress(on_boundry) for x in locs]
-
-    # Simply remove the multi-object boundaries from the mask
-    filtered = mask.copy()
-    filtered[separator_locs] = 0
-    return filtered
+    if demo_mode:
+        warnings.warn('demo_mode no longer does anything and will be removed',
+                      DeprecationWarning)
+    labeler = instance_labeling.default_labeler()
+    return labeler.watershed_filter(mask, dist_thresh=dist_thresh,
+                                    topology=topology)
 
 
 def crf_posterior(img, log_probs, **kwargs):
@@ -10,14 +10,11 @@ import torch  # NOQA
 import torchvision  # NOQA
 import tqdm  # NOQA
 import ubelt as ub
-from bayes_opt import BayesianOptimization
-import pandas as pd
 from clab import preprocess
 from clab import util
 from clab.live import fit_harn2
 from clab.live import unet2
 from clab.live import unet3
-from clab.live.urban_metrics import instance_fscore
 from clab.live.urban_pred import seeded_instance_label_from_probs
 from clab.tasks.urban_mapper_3d import UrbanMapper3D
 from clab import criterions
@@ -25,6 +22,7 @@ from clab import hyperparams
 from clab import im_loaders
 from clab import metrics
 from clab import models
+from clab import stitching
 from clab import transforms
 from clab import xpu_device
 from clab.transforms import (ImageCenterScale, DTMCenterScale, ZipTransforms)
@@ -361,16 +359,13 @@ class UrbanDataset(torch.utils.data.Dataset):
         # return class_weights
 
 
-def _make_scorable_objective(arch_to_paths, arches, train_data_path):
+def _make_postproc_search(arch_to_paths, arches, train_data_path, **kw):
     """
-    Makes objective evaluation function that caches loaded data
+    Loads the probabilities of the ensemble into a parallel search over the
+    post-processing parameters.
     """
+    from clab.live.postproc_search import PostprocTiles, PostprocSearch
 
-    @ub.memoize
-    def memo_read_arr(fpath):
-        return util.read_arr(fpath)
-
-    @ub.memoize
     def gt_info_from_path(pred_fpath):
         # Hack to read UrbanMapper specific data
         gtl_fname = ub.augpath(basename(pred_fpath), suffix='_GTL', ext='.tif')
@@ -386,65 +381,13 @@ def _make_scorable_objective(arch_to_paths, arches, train_data_path):
         uncertain = (gtl == 65)
         return gti, uncertain, dsm
 
-    # Search for good hyperparams for this config (boost if more than 2)
-    def preload():
-        n_paths = len(arch_to_paths[arches[0]]['probs'])
-        for ix in tqdm.trange(n_paths, leave=True, desc='preload'):
-            path = arch_to_paths[arches[0]]['probs'][ix]
-            gt_info_from_path(path)
-
-            for arch in arches:
-                memo_read_arr(arch_to_paths[arch]['probs'][ix])
-                memo_read_arr(arch_to_paths[arch]['probs1'][ix])
-
-    def seeded_objective(**params):
-        # CONVERT PROBABILITIES TO INSTANCE PREDICTIONS
-
-        alpha = params.pop('alpha', .88)
-
-        fscores = []
-        # params = {'mask_thresh': 0.7664, 'min_seed_size': 48.5327, 'min_size': 61.8757, 'seed_thresh': 0.4090}
-        n_paths = len(arch_to_paths[arches[0]]['probs'])
-        for ix in tqdm.trange(n_paths, leave=False, desc='eval objective'):
-            path = arch_to_paths[arches[0]]['probs'][ix]
-
-            gti, uncertain, dsm = gt_info_from_path(path)
-
-            probs_m1 = memo_read_arr(arch_to_paths['unet2']['probs'][ix])
-            probs1_m1 = memo_read_arr(arch_to_paths['unet2']['probs1'][ix])
-
-            probs_m2 = memo_read_arr(arch_to_paths['dense_unet']['probs'][ix])
-            probs1_m2 = memo_read_arr(arch_to_paths['dense_unet']['probs1'][ix])
-
-            probs = (alpha * probs_m1 + (1 - alpha) * probs_m2)
-            probs1 = (alpha * probs1_m1 + (1 - alpha) * probs1_m2)
-
-            INNER_BUILDING_ID = 1
-            BUILDING_ID = 1
-
-            seed_prob = probs[:, :, INNER_BUILDING_ID]
-            mask_prob = probs1[:, :, BUILDING_ID]
-
-            pred = seeded_instance_label_from_probs(seed_prob, mask_prob,
-                                                    **params)
-
-            scores = instance_fscore(gti, uncertain, dsm, pred)
-
-            fscore = scores[0]
-            fscores.append(fscore)
-        mean_fscore = np.mean(fscores)
-        return mean_fscore
-    return preload, seeded_objective
-
-
-def optimize_postproc_params(arch_to_paths, arches, train_data_path):
-    def bo_best(self):
-        return {'max_val': self.Y.max(),
-                'max_params': dict(zip(self.keys, self.X[self.Y.argmax()]))}
-
-    preload, seeded_objective = _make_scorable_objective(arch_to_paths, arches,
-                                                         train_data_path)
-    preload()  # read datas into memory
+    INNER_BUILDING_ID = 1
+    BUILDING_ID = 1
+    tiles = PostprocTiles.from_paths(
+        [arch_to_paths[arch]['probs'] for arch in arches],
+        [arch_to_paths[arch]['probs1'] for arch in arches],
+        gt_info_from_path, seed_channel=INNER_BUILDING_ID,
+        mask_channel=BUILDING_ID)
 
     seeded_bounds = {
         'mask_thresh': (.4, .9),
@@ -453,8 +396,12 @@ def optimize_postproc_params(arch_to_paths, arches, train_data_path):
         'min_size': (0, 100),
         'alpha': (0.0, 1.0),
     }
+    return PostprocSearch(tiles, seeded_bounds, **kw)
+
+
+def optimize_postproc_params(arch_to_paths, arches, train_data_path):
+    search = _make_postproc_search(arch_to_paths, arches, train_data_path)
 
-    seeded_bo = BayesianOptimization(seeded_objective, seeded_bounds)
     cand_params = [
         {'mask_thresh': 0.9000, 'min_seed_size': 100.0000, 'min_size': 100.0000, 'seed_thresh': 0.4000},
         {'mask_thresh': 0.8367, 'seed_thresh': 0.4549, 'min_seed_size': 97, 'min_size': 33},  # 'max_val': 0.8708
@@ -470,37 +417,20 @@ def optimize_postproc_params(arch_to_paths, arches, train_data_path):
     for p in cand_params:
         p['alpha'] = .88
     n_init = 2 if DEBUG else 40
-
-    seeded_bo.explore(pd.DataFrame(cand_params).to_dict(orient='list'))
-
-    # Basically just using this package for random search.
-    # The BO doesnt seem to help much
-    seeded_bo.plog.print_header(initialization=True)
-    seeded_bo.init(n_init)
-    print('seeded ' + ub.repr2(bo_best(seeded_bo), nl=0, precision=4))
-
-    gp_params = {"alpha": 1e-5, "n_restarts_optimizer": 2}
-
-    n_iter = 2 if DEBUG else 10
-    for kappa in [10, 5, 1]:
-        seeded_bo.maximize(n_iter=n_iter, acq='ucb', kappa=kappa, **gp_params)
-
-    best_res = bo_best(seeded_bo)
+    n_rounds = 2 if DEBUG else 30
+
+    with search:
+        best_res = search.maximize(cand_params, n_init=n_init,
+                                   n_rounds=n_rounds)
+        max_params = best_res['max_params']
+
+        # search for a good alpha
+        alpha_params = [dict(max_params, alpha=alpha)
+                        for alpha in np.linspace(0, 1, 50)]
+        search.evaluate(alpha_params)
+        best_res = search.best()
     print('seeded ' + ub.repr2(best_res, nl=0, precision=4))
-
-    max_params = best_res['max_params']
-    max_value = best_res['max_val']
-
-    # search for a good alpha
-    # TODO: improve bayes_opt package to handle this
-    for alpha in tqdm.tqdm(np.linspace(0, 1, 50), desc='opt alpha'):
-        params = max_params.copy()
-        params['alpha'] = alpha
-        val = seeded_objective(**params)
-        if val > max_value:
-            max_value = val
-            max_params = params
-    return max_value, max_params
+    return best_res['max_val'], best_res['max_params']
 
 
 class UrbanPredictHarness(object):
@@ -560,63 +490,6 @@ class UrbanPredictHarness(object):
             pharn.model.__class__.__name__, pharn.xpu))
         pharn.model.train(False)
 
-        # Hack in the restitching here to not have to deal with expensive IO
-        def _extract_part_grid(paths):
-            # hack to use filenames to extract upper left locations of tiles in
-            # the larger image.
-            rc_locs = [[int(x) for x in basename(p).split('.')[0].split('_')[-2:]]
-                       for p in paths]
-            return rc_locs
-
-        def stitch_tiles_avew(rc_locs, tiles):
-            """
-            Recombine parts back into an entire image
-
-            Example:
-                >>> rc_locs = [(0, 0), (0, 5), (0, 10)]
-                >>> tiles = [np.ones((1, 7, 3)) + i for i in range(len(rc_locs))]
-                >>> tiles = [np.ones((1, 7)) + i for i in range(len(rc_locs))]
-            """
-            shapes = [t.shape[0:2] for t in tiles]
-            n_channels = 1 if len(tiles[0].shape) == 2 else tiles[0].shape[2]
-            bboxes = np.array([
-                (r, c, r + h, c + w)
-                for ((r, c), (h, w)) in zip(rc_locs, shapes)
-            ])
-            stiched_wh = tuple(bboxes.T[2:4].max(axis=1))
-            stiched_shape = stiched_wh
-            if n_channels > 1:
-                stiched_shape = stiched_wh + (n_channels,)
-            sums = np.zeros(stiched_shape)
-            nums = np.zeros(stiched_wh)
-
-            # assume all shapes are the same
-            h, w = shapes[0]
-            weight = np.ones((h, w) )
-            # Weight borders less than center
-            # should really use receptive fields for this calculation
-            # but this should be fine.
-            weight[:h // 4]  = .25
-            weight[-h // 4:] = .25
-            weight[:w // 4]  = .25
-            weight[-w // 4:] = .25
-            weight3c = weight
-            if n_channels > 1:
-                weight3c = weight[:, :, None]
-
-            # Assume we are not in log-space here, so the weighted average
-            # formula does not need any exponentiation.
-            for bbox, tile in zip(bboxes, tiles):
-                r1, c1, r2, c2 = bbox
-                sums[r1:r2, c1:c2] += (tile * weight3c)
-                nums[r1:r2, c1:c2] += weight
-
-            if len(sums.shape) == 2:
-                stiched = sums / nums
-            else:
-                stiched = sums / nums[:, :, None]
-            return stiched
-
         groupids = [basename(p).split('_part')[0]
                     for p in pharn.dataset.inputs.dump_im_names]
         grouped_indices = ub.group_items(range(len(groupids)), groupids)
@@ -654,11 +527,9 @@ class UrbanPredictHarness(object):
 
                     grouped_probs[suffix].append(probs)
 
-            rc_locs = _extract_part_grid(ub.take(pharn.dataset.inputs.dump_im_names, groupxs))
+            rc_locs = stitching.extract_part_grid(ub.take(pharn.dataset.inputs.dump_im_names, groupxs))
             for suffix, tiles in grouped_probs.items():
-                # from clab.profiler import profile_onthefly
-                # profile_onthefly(stitch_tiles_ave)(rc_locs, tiles, weighted=True)
-                stitched = stitch_tiles_avew(rc_locs, tiles)
+                stitched = stitching.stitch_tiles(rc_locs, tiles, blend='avew')
 
                 dpath = ub.ensuredir(join(output_dpath, 'probs' + suffix))
                 fpath = join(dpath, key + '.h5')
@@ -1111,9 +982,9 @@ def test(train_data_path, test_data_path, output_file):
                                          max_epochs, 'eval')
 
     if vali_check:
-        preload, objective =  _make_scorable_objective(arch_to_paths, arches,
-                                                       train_data_path)
-        score = objective(**max_params)
+        with _make_postproc_search(arch_to_paths, arches,
+                                   train_data_path) as search:
+            score = search.evaluate([max_params])[0]
         print('checked score = {!r}'.format(score))
 
     alpha = max_params.pop('alpha')
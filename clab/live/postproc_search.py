@@ -0,0 +1,570 @@
+# -*- coding: utf-8 -*-
+"""
+Parallel search for the parameters of `seeded_instance_label_from_probs`.
+
+Every evaluation of a candidate runs the instance labeling and
+`instance_fscore` on every tile, so a serial search over hundreds of
+candidates takes hours. :class:`PostprocSearch` parallelizes it:
+
+    * :class:`PostprocTiles` reads the probability maps once, keeps only the
+      seed / mask channels, and stores them in shared memory, so the workers
+      do not hold their own copies.
+
+    * Each worker process owns a fixed subset of the tiles and evaluates every
+      candidate of a round on them. Rounds propose several candidates at once
+      (random samples and perturbations of the best candidate so far).
+
+    * The labeling stages (`seed_stage`, `watershed_stage`, `min_size_stage`)
+      are cached per tile by the parameters they depend on. Because a worker
+      always sees the same tiles, candidates that only change e.g. `min_size`
+      reuse the seeds and watershed computed for earlier candidates.
+
+CommandLine:
+    python -m clab.live.postproc_search all
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+import collections
+import math
+import multiprocessing
+import traceback
+import numpy as np
+import torch
+import ubelt as ub
+from clab.live.urban_metrics import instance_fscore
+from clab.live.urban_pred import seed_stage, watershed_stage, min_size_stage
+
+__all__ = ['PostprocTiles', 'StageCache', 'PostprocSearch']
+
+
+# Parameters that only change the result at integer values
+_INT_PARAMS = {'inner_k', 'outer_k'}
+# Sizes are compared as `area < min_size`, so ceil(min_size) is equivalent
+_SIZE_PARAMS = {'min_seed_size', 'min_size'}
+
+# Groups of parameters that are perturbed together (ordered by stage)
+_PARAM_GROUPS = [
+    ('alpha',),
+    ('seed_thresh', 'min_seed_size', 'inner_k'),
+    ('mask_thresh', 'outer_k'),
+    ('min_size',),
+]
+
+
+class PostprocTiles(object):
+    """
+    The probability maps and ground truth of the tiles used to score
+    post-processing parameters, held in shared memory.
+
+    Args:
+        seed_probs (List[ndarray]): per tile, the seed probabilities of each
+            model in the ensemble stacked into a [n_models, H, W] array
+        mask_probs (List[ndarray]): the mask probabilities in the same format
+        gtis (List[ndarray]): ground truth instance labels of each tile
+        uncertains (List[ndarray]): uncertain ground truth pixels
+        dsms (List[ndarray]): digital surface models (used to find no-data
+            pixels)
+
+    Example:
+        >>> tiles = _demo_tiles(n_tiles=2, size=64)
+        >>> print(tiles)
+        <PostprocTiles(2 tiles, 2 models)>
+        >>> tile = tiles[1]
+        >>> assert tile['seed_probs'].dtype == np.float32
+        >>> assert tile['seed_probs'].shape == (2, 64, 64)
+        >>> assert tiles._tensors['seed_probs'][1].is_shared()
+    """
+    def __init__(self, seed_probs, mask_probs, gtis, uncertains, dsms):
+        def _shared(arrs, dtype):
+            return [torch.from_numpy(np.ascontiguousarray(arr, dtype=dtype)
+                                     ).share_memory_()
+                    for arr in arrs]
+        self._tensors = {
+            'seed_probs': _shared(seed_probs, np.float32),
+            'mask_probs': _shared(mask_probs, np.float32),
+            'gti': _shared(gtis, np.int32),
+            'uncertain': _shared(uncertains, np.uint8),
+            'dsm': _shared(dsms, np.float32),
+        }
+        self.n_models = self._tensors['seed_probs'][0].shape[0]
+        self._arrays = None
+
+    @classmethod
+    def from_paths(cls, probs_paths, probs1_paths, gt_info, seed_channel=1,
+                   mask_channel=1):
+        """
+        Reads the stitched probability maps of one or more models.
+
+        Args:
+            probs_paths (List[List[str]]): for each model, the paths to the
+                probabilities that contain the seed channel
+            probs1_paths (List[List[str]]): for each model, the paths to the
+                probabilities that contain the mask channel
+            gt_info (callable): maps a path in `probs_paths[0]` to a tuple
+                `(gti, uncertain, dsm)`
+            seed_channel (int): channel of the seed probabilities
+            mask_channel (int): channel of the mask probabilities
+        """
+        from clab import util
+        seed_probs, mask_probs, gtis, uncertains, dsms = [], [], [], [], []
+        n_tiles = len(probs_paths[0])
+        for ix in ub.ProgIter(range(n_tiles), label='load tiles'):
+            # Only keep the channels that are used (as float32)
+            seed_probs.append(np.stack([
+                util.read_arr(paths[ix])[:, :, seed_channel]
+                for paths in probs_paths]).astype(np.float32))
+            mask_probs.append(np.stack([
+                util.read_arr(paths[ix])[:, :, mask_channel]
+                for paths in probs1_paths]).astype(np.float32))
+            gti, uncertain, dsm = gt_info(probs_paths[0][ix])[0:3]
+            gtis.append(gti)
+            uncertains.append(uncertain)
+            dsms.append(dsm)
+        return cls(seed_probs, mask_probs, gtis, uncertains, dsms)
+
+    @property
+    def _views(self):
+        # numpy views of the shared tensors (created on first use in each
+        # process)
+        if self._arrays is None:
+            self._arrays = {key: [t.numpy() for t in tensors]
+                            for key, tensors in self._tensors.items()}
+        return self._arrays
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_arrays'] = None
+        return state
+
+    def __len__(self):
+        return len(self._tensors['gti'])
+
+    def __getitem__(self, index):
+        """
+        Returns:
+            dict: numpy views of the arrays of a tile
+        """
+        return {key: arrs[index] for key, arrs in self._views.items()}
+
+    def __repr__(self):
+        return '<PostprocTiles({} tiles, {} models)>'.format(len(self),
+                                                             self.n_models)
+
+
+class StageCache(object):
+    """
+    A least-recently-used cache of stage results (arrays or tuples of
+    arrays) with a byte budget.
+
+    Args:
+        max_bytes (int): maximum size of the cached arrays
+
+    Example:
+        >>> cache = StageCache(max_bytes=200)
+        >>> for key in ['a', 'b', 'a', 'c', 'b']:
+        >>>     _ = cache.get(key, lambda: np.zeros(10))
+        >>> print(list(cache.items.keys()))
+        ['c', 'b']
+        >>> print(cache.hits, cache.misses, cache.nbytes)
+        1 4 160
+    """
+    def __init__(self, max_bytes=2 ** 31):
+        self.max_bytes = max_bytes
+        self.items = collections.OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, func):
+        """
+        Returns the result cached under `key`, or computes and caches
+        `func()`. Callers must not modify the returned value.
+        """
+        try:
+            value, nbytes = self.items.pop(key)
+        except KeyError:
+            self.misses += 1
+            value = func()
+            nbytes = sum(arr.nbytes for arr in _arrays_of(value))
+            self.nbytes += nbytes
+        else:
+            self.hits += 1
+        self.items[key] = (value, nbytes)
+        while self.nbytes > self.max_bytes and len(self.items) > 1:
+            self.nbytes -= self.items.popitem(last=False)[1][1]
+        return value
+
+
+def _arrays_of(value):
+    if isinstance(value, np.ndarray):
+        return [value]
+    return [v for v in value if isinstance(v, np.ndarray)]
+
+
+def canonical_params(params, resolution=None):
+    """
+    Maps post-processing parameters to an equivalent (hashable) form, so
+    candidates with the same effect share cached results.
+
+    Args:
+        params (dict): keyword arguments for
+            `seeded_instance_label_from_probs` and the ensemble weight `alpha`
+        resolution (dict): rounds parameters to a multiple of these steps
+
+    Returns:
+        ub.odict: canonical parameters (sorted by key)
+
+    Example:
+        >>> params = {'seed_thresh': .40912, 'min_size': 61.87, 'post_k': 3}
+        >>> print(ub.repr2(canonical_params(params, {'seed_thresh': .01}), nl=0))
+        {'min_size': 62, 'seed_thresh': 0.41}
+    """
+    resolution = resolution or {}
+    canon = ub.odict()
+    for key in sorted(params.keys()):
+        value = params[key]
+        if key == 'post_k':
+            # post_k does not change the labeling
+            continue
+        if key in _SIZE_PARAMS:
+            value = int(math.ceil(value))
+        elif key in _INT_PARAMS:
+            value = int(round(value))
+        else:
+            value = float(value)
+            if key in resolution:
+                step = resolution[key]
+                value = round(round(value / step) * step, 10)
+        canon[key] = value
+    return canon
+
+
+def evaluate_tile(tile, ix, params, cache):
+    """
+    Computes the instance F-score of one tile, reusing the cached stages that
+    only depend on parameters shared with earlier candidates.
+
+    Args:
+        tile (dict): a tile of `PostprocTiles`
+        ix (int): index of the tile (part of the cache keys)
+        params (dict): canonical parameters
+        cache (StageCache): the stage cache
+
+    Returns:
+        float: F-score
+
+    Example:
+        >>> from clab.live.urban_pred import seeded_instance_label_from_probs
+        >>> tiles = _demo_tiles(n_tiles=1, size=128, n_models=1)
+        >>> tile = tiles[0]
+        >>> params = {'seed_thresh': .6, 'mask_thresh': .4, 'min_seed_size': 10, 'min_size': 20}
+        >>> cache = StageCache()
+        >>> fscore = evaluate_tile(tile, 0, params, cache)
+        >>> pred = seeded_instance_label_from_probs(tile['seed_probs'][0], tile['mask_probs'][0], **params)
+        >>> assert fscore == instance_fscore(tile['gti'], tile['uncertain'], tile['dsm'], pred)[0]
+        >>> # only the last stage is recomputed when min_size changes
+        >>> _ = evaluate_tile(tile, 0, dict(params, min_size=30), cache)
+        >>> print(cache.hits, cache.misses)
+        1 2
+    """
+    alpha = params.get('alpha', .88)
+    weights = _ensemble_weights(alpha, len(tile['seed_probs']))
+
+    def blend(probs):
+        if len(weights) == 1:
+            return probs[0]
+        return np.tensordot(weights, probs, axes=1)
+
+    seed_key = (ix, alpha, params.get('seed_thresh', .4),
+                params.get('inner_k', 0), params.get('min_seed_size', 0))
+    ws_key = seed_key + (params.get('mask_thresh', .6),
+                         params.get('outer_k', 0))
+
+    def _seed():
+        seed = blend(tile['seed_probs']) > seed_key[2]
+        return seed_stage(seed, inner_k=seed_key[3],
+                          min_seed_size=seed_key[4])
+
+    def _watershed():
+        seed, seed_ccs = cache.get(('seed',) + seed_key, _seed)
+        mask = blend(tile['mask_probs']) > ws_key[5]
+        return watershed_stage(seed, seed_ccs, mask, outer_k=ws_key[6])
+
+    pred_ccs = cache.get(('watershed',) + ws_key, _watershed)
+    pred = min_size_stage(pred_ccs.copy(), min_size=params.get('min_size', 0))
+    return instance_fscore(tile['gti'], tile['uncertain'], tile['dsm'],
+                           pred)[0]
+
+
+def _ensemble_weights(alpha, n_models):
+    if n_models == 1:
+        return np.array([1.0], dtype=np.float32)
+    elif n_models == 2:
+        return np.array([alpha, 1 - alpha], dtype=np.float32)
+    else:
+        return np.full(n_models, 1 / n_models, dtype=np.float32)
+
+
+def _worker(tiles, tile_ixs, cache_bytes, in_queue, out_queue):
+    import cv2
+    # The workers already use every core
+    cv2.setNumThreads(1)
+    torch.set_num_threads(1)
+    cache = StageCache(cache_bytes)
+    while True:
+        task = in_queue.get()
+        if task is None:
+            break
+        try:
+            scores = np.array([[evaluate_tile(tiles[ix], ix, params, cache)
+                                for ix in tile_ixs]
+                               for params in task], dtype=np.float64)
+            out_queue.put(('scores', tile_ixs, scores,
+                           (cache.hits, cache.misses)))
+        except Exception:
+            out_queue.put(('error', traceback.format_exc()))
+
+
+class PostprocSearch(object):
+    """
+    Maximizes the mean instance F-score of the tiles over the
+    post-processing parameters.
+
+    Args:
+        tiles (PostprocTiles): tiles to score candidates on
+        bounds (Dict[str, Tuple[float, float]]): search ranges of the
+            parameters
+        workers (int): number of worker processes. If 0 candidates are
+            evaluated in this process. Defaults to the number of cpus.
+        cache_bytes (int): size of the stage cache of each worker
+        resolution (dict): parameters are rounded to a multiple of these
+            steps, so nearby candidates can share cached stages
+        seed (int): random seed for the proposals
+
+    Example:
+        >>> tiles = _demo_tiles(n_tiles=3, size=96)
+        >>> bounds = {'mask_thresh': (.4, .9), 'seed_thresh': (.4, .9),
+        >>>           'min_seed_size': (0, 100), 'min_size': (0, 100),
+        >>>           'alpha': (0, 1)}
+        >>> with PostprocSearch(tiles, bounds, workers=2) as search:
+        >>>     scores = search.evaluate([{'mask_thresh': .5, 'seed_thresh': .7}])
+        >>>     best = search.maximize(n_init=4, n_rounds=2, round_size=4)
+        >>> print(len(search.history))
+        13
+        >>> assert best['max_val'] >= scores[0]
+        >>> # workers give the same scores as the serial evaluation
+        >>> with PostprocSearch(tiles, bounds, workers=0) as serial:
+        >>>     assert np.allclose(serial.evaluate(search.history_params()),
+        >>>                        search.history_values())
+    """
+    def __init__(self, tiles, bounds, workers=None, cache_bytes=2 ** 31,
+                 resolution=None, seed=0):
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        if resolution is None:
+            resolution = {'mask_thresh': .005, 'seed_thresh': .005,
+                          'alpha': .01}
+        self.tiles = tiles
+        self.bounds = bounds
+        self.workers = min(workers, len(tiles))
+        self.cache_bytes = cache_bytes
+        self.resolution = resolution
+        self.rng = np.random.RandomState(seed)
+        # list of (canonical params, mean fscore) of every evaluation
+        self.history = []
+        self._cache = None
+        self._procs = []
+        self._in_queues = []
+        self._out_queue = None
+        self._hits_misses = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _start(self):
+        if self.workers == 0:
+            self._cache = StageCache(self.cache_bytes)
+            return
+        self._out_queue = multiprocessing.Queue()
+        for rank in range(self.workers):
+            tile_ixs = list(range(rank, len(self.tiles), self.workers))
+            in_queue = multiprocessing.Queue()
+            proc = multiprocessing.Process(
+                target=_worker, args=(self.tiles, tile_ixs, self.cache_bytes,
+                                      in_queue, self._out_queue))
+            proc.daemon = True
+            proc.start()
+            self._procs.append(proc)
+            self._in_queues.append(in_queue)
+
+    def close(self):
+        """ Stops the worker processes """
+        for in_queue in self._in_queues:
+            in_queue.put(None)
+        for proc in self._procs:
+            proc.join()
+        self._procs = []
+        self._in_queues = []
+        self._cache = None
+
+    def evaluate(self, param_list):
+        """
+        Computes the mean F-score of each candidate over all tiles.
+
+        Candidates are evaluated concurrently (every worker scores all of them
+        on its tiles). Candidates that were already evaluated are not
+        recomputed.
+
+        Returns:
+            ndarray: mean F-score of each candidate
+        """
+        if self._cache is None and not self._procs:
+            self._start()
+        canons = [canonical_params(p, self.resolution) for p in param_list]
+        known = {tuple(p.items()): v for p, v in self.history}
+        todo = list(ub.unique(tuple(p.items()) for p in canons
+                              if tuple(p.items()) not in known))
+        if todo:
+            todo_params = [dict(items) for items in todo]
+            scores = np.empty((len(todo), len(self.tiles)))
+            if self.workers == 0:
+                for i, params in enumerate(todo_params):
+                    for ix in range(len(self.tiles)):
+                        scores[i, ix] = evaluate_tile(self.tiles[ix], ix,
+                                                      params, self._cache)
+            else:
+                for in_queue in self._in_queues:
+                    in_queue.put(todo_params)
+                for _ in self._in_queues:
+                    result = self._out_queue.get()
+                    if result[0] == 'error':
+                        self.close()
+                        raise RuntimeError('A worker failed:\n' + result[1])
+                    _, tile_ixs, tile_scores, hits_misses = result
+                    scores[:, tile_ixs] = tile_scores
+                    self._hits_misses[tile_ixs[0]] = hits_misses
+            for items, value in zip(todo, scores.mean(axis=1)):
+                known[items] = value
+                self.history.append((ub.odict(items), value))
+        return np.array([known[tuple(p.items())] for p in canons])
+
+    def cache_stats(self):
+        """
+        Returns:
+            dict: stage cache hits and misses summed over the workers
+        """
+        if self.workers == 0:
+            counts = [(self._cache.hits, self._cache.misses)] if self._cache else []
+        else:
+            counts = list(self._hits_misses.values())
+        return {'hits': sum(c[0] for c in counts),
+                'misses': sum(c[1] for c in counts)}
+
+    def history_params(self):
+        return [dict(params) for params, _ in self.history]
+
+    def history_values(self):
+        return np.array([value for _, value in self.history])
+
+    def best(self):
+        """
+        Returns:
+            dict: the best value and parameters evaluated so far
+        """
+        if not self.history:
+            return None
+        params, value = max(self.history, key=lambda t: t[1])
+        return {'max_val': value, 'max_params': dict(params)}
+
+    def propose(self, n):
+        """
+        Proposes candidates for a round. Half are sampled uniformly from the
+        bounds. The others perturb one group of parameters of the best
+        candidate, so they share its cached early stages.
+        """
+        best = self.best()
+        cands = []
+        for i in range(n):
+            if best is None or i % 2 == 0:
+                cand = {key: self.rng.uniform(lo, hi)
+                        for key, (lo, hi) in self.bounds.items()}
+            else:
+                groups = [[key for key in group if key in self.bounds]
+                          for group in _PARAM_GROUPS]
+                groups = [group for group in groups if group]
+                group = groups[self.rng.randint(len(groups))]
+                cand = dict(best['max_params'])
+                for key in group:
+                    lo, hi = self.bounds[key]
+                    value = cand.get(key, (lo + hi) / 2)
+                    value += self.rng.randn() * (hi - lo) * .1
+                    cand[key] = float(np.clip(value, lo, hi))
+            cands.append(cand)
+        return cands
+
+    def maximize(self, init_params=None, n_init=40, n_rounds=10,
+                 round_size=None, verbose=1):
+        """
+        Runs the search.
+
+        Args:
+            init_params (List[dict]): known good candidates evaluated first
+            n_init (int): number of random candidates evaluated first
+            n_rounds (int): number of rounds of proposals
+            round_size (int): number of candidates per round (defaults to
+                twice the number of workers)
+
+        Returns:
+            dict: the best value and parameters
+        """
+        if round_size is None:
+            round_size = max(2 * self.workers, 4)
+        init_params = list(init_params or [])
+        self.evaluate(init_params + self.propose(n_init))
+        for round_ix in range(n_rounds):
+            if verbose:
+                print('round {}: {}'.format(round_ix, ub.repr2(
+                    self.best(), nl=0, precision=4)))
+            self.evaluate(self.propose(round_size))
+        best = self.best()
+        if verbose:
+            print('best: ' + ub.repr2(best, nl=0, precision=4))
+            print('cache: ' + ub.repr2(self.cache_stats(), nl=0))
+        return best
+
+
+def _demo_tiles(n_tiles=2, size=128, n_models=2, seed=0):
+    """ Random buildings with noisy probability maps """
+    import cv2
+    rng = np.random.RandomState(seed)
+    seed_probs, mask_probs, gtis, uncertains, dsms = [], [], [], [], []
+    for _ in range(n_tiles):
+        mask = np.zeros((size, size), dtype=np.uint8)
+        inner = np.zeros((size, size), dtype=np.uint8)
+        for _ in range(size // 16):
+            r, c = rng.randint(0, size - 8, 2)
+            h, w = rng.randint(6, 24, 2)
+            mask[r:r + h, c:c + w] = 1
+            inner[r + 2:r + h - 2, c + 2:c + w - 2] = 1
+        gti = cv2.connectedComponents(mask, connectivity=4)[1]
+        seed_probs.append(np.stack([
+            np.clip(inner + rng.randn(size, size) * .3, 0, 1)
+            for _ in range(n_models)]))
+        mask_probs.append(np.stack([
+            np.clip(mask + rng.randn(size, size) * .3, 0, 1)
+            for _ in range(n_models)]))
+        gtis.append(gti)
+        uncertains.append(np.zeros((size, size), dtype=bool))
+        dsms.append(np.zeros((size, size), dtype=np.float32))
+    return PostprocTiles(seed_probs, mask_probs, gtis, uncertains, dsms)
+
+
+if __name__ == '__main__':
+    r"""
+    CommandLine:
+        python -m clab.live.postproc_search all
+    """
+    import xdoctest
+    xdoctest.doctest_module(__file__)
@@ -521,13 +521,19 @@ def task_fit(taskname):
         train_hyper_id=hyper.hyper_id(),
         suffix='_' + hyper.other_id())
 
+    # Accumulate confusions on the xpu and only compute metrics once per epoch
+    accumulators = {
+        tag: metrics.ConfusionAccumulator(
+            n_classes=n_classes, ignore_label=datasets['train'].ignore_label)
+        for tag in datasets.keys()
+    }
+
     def custom_metrics(harn, output, label):
-        ignore_label = datasets['train'].ignore_label
-        labels = datasets['train'].task.labels
+        accumulators[harn.current_tag].update(output, label)
+        return {}
 
-        metrics_dict = metrics._sseg_metrics(output, label, labels=labels,
-                                             ignore_label=ignore_label)
-        return metrics_dict
+    def custom_epoch_metrics(harn, tag):
+        return accumulators[tag].summary(reset=True)
 
     print('arch = {!r}'.format(arch))
     dry = ub.argflag('--dry')
@@ -554,6 +560,7 @@ def task_fit(taskname):
         batch_size=batch_size,
     )
     harn.add_batch_metric_hook(custom_metrics)
+    harn.add_epoch_metric_hook(custom_epoch_metrics)
 
     # HACK
     # im = datasets['train'][0][0]
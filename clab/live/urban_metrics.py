@@ -1,5 +1,4 @@
 import numpy as np
-from clab import util
 import ubelt as ub
 
 
@@ -66,108 +65,105 @@ def instance_fscore(gti, uncertain, dsm, pred, info=False):
     instance_fscore_ = dynamic_profile(instance_fscore)
     fscore = instance_fscore_(gti, uncertain, dsm, pred)
     instance_fscore_.profile.profile.print_stats()
-    """
-    def _bbox(arr):
-        # r1, c1, r2, c2
-        return np.hstack([arr.min(axis=0), arr.max(axis=0)])
-
-    def cc_locs(ccs):
-        rc_locs = np.where(ccs > 0)
-        rc_ids = ccs[rc_locs]
-        rc_arr = np.ascontiguousarray(np.vstack(rc_locs).T)
-        unique_labels, groupxs = util.group_indices(rc_ids)
-        grouped_arrs = util.apply_grouping(rc_arr, groupxs, axis=0)
-        id_to_rc = ub.odict(zip(unique_labels, grouped_arrs))
-        return id_to_rc, unique_labels, groupxs, rc_arr
-
-    (true_rcs_arr, group_true_labels,
-     true_groupxs, true_rc_arr) = cc_locs(gti)
-
-    (pred_rcs_arr, group_pred_labels,
-     pred_groupxs, pred_rc_arr) = cc_locs(pred)
 
+    Example:
+        >>> gti = np.zeros((64, 64), dtype=np.int32)
+        >>> gti[2:20, 2:20] = 1
+        >>> gti[30:50, 30:50] = 2
+        >>> gti[0:5, 40:45] = 3  # small and on the border, so uncertain
+        >>> pred = np.zeros_like(gti)
+        >>> pred[3:21, 2:20] = 7   # matches 1
+        >>> pred[30:38, 30:50] = 8  # 27 of the 39 anti-diagonals of 2
+        >>> pred[55:60, 55:60] = 9  # matches nothing
+        >>> uncertain = np.zeros(gti.shape, dtype=bool)
+        >>> dsm = np.zeros(gti.shape)
+        >>> scores, infod = instance_fscore(gti, uncertain, dsm, pred, info=True)
+        >>> print(ub.repr2(scores, precision=3, nl=0))
+        (0.800, 0.667, 1.000)
+        >>> assert [tp[0:2] for tp in infod['tp']] == [(7, 1), (8, 2)]
+        >>> assert infod['fp'] == [9] and infod['fn'] == set()
+        >>> assert infod['uncertain'] == {3}
+    """
     DSM_NAN = -32767
     MIN_SIZE = 100
     MIN_IOU = 0.45
-    # H, W = pred.shape[0:2]
+    H, W = gti.shape[0:2]
+
+    true_ids, true_px, true_idx = _foreground_labels(gti)
+    pred_ids, pred_px, pred_idx = _foreground_labels(pred)
+    n_true, n_pred = len(true_ids), len(pred_ids)
+    true_r, true_c = np.divmod(true_px, W)
+    pred_r, pred_c = np.divmod(pred_px, W)
 
     # --- Find uncertain truth ---
     # any gt-building explicitly labeled in the GTL is uncertain
-    uncertain_labels = set(np.unique(gti[uncertain.astype(np.bool)]))
+    uncertain_labels = set(np.unique(gti[uncertain.astype(bool)]))
     # Any gt-building less than 100px or at the boundary is uncertain.
-    for label, rc_arr in true_rcs_arr.items():
-        if len(rc_arr) < MIN_SIZE:
-            rc_arr = np.array(list(rc_arr))
-            if (np.any(rc_arr == 0) or np.any(rc_arr == 2047)):
-                uncertain_labels.add(label)
-            else:
-                rc_loc = tuple(rc_arr.T)
-                is_invisible = (dsm[rc_loc] == DSM_NAN)
-                if np.any(is_invisible):
-                    invisible_rc = rc_arr.compress(is_invisible, axis=0)
-                    invisible_rc_set = set(map(tuple, invisible_rc))
-                    # Remove invisible pixels
-                    remain_rc_set = list(set(map(tuple, rc_arr)).difference(invisible_rc_set))
-                    true_rcs_arr[label] = np.array(remain_rc_set)
-                    uncertain_labels.add(label)
-
-    def make_int_coords(rc_arr, unique_labels, groupxs):
-        # using nums instead of tuples gives the intersection a modest speedup
-        rc_int = rc_arr.T[0] + pred.shape[0] + rc_arr.T[1]
-        id_to_rc_int = ub.odict(zip(unique_labels,
-                                    map(set, util.apply_grouping(rc_int, groupxs))))
-        return id_to_rc_int
+    is_small = np.bincount(true_idx, minlength=n_true) < MIN_SIZE
+    on_boundary = ((true_r == 0) | (true_r == 2047) |
+                   (true_c == 0) | (true_c == 2047))
+    is_invisible = (dsm.ravel()[true_px] == DSM_NAN)
+    n_boundary = np.bincount(true_idx[on_boundary], minlength=n_true)
+    n_invisible = np.bincount(true_idx[is_invisible], minlength=n_true)
+    uncertain_labels.update(
+        true_ids[is_small & ((n_boundary > 0) | (n_invisible > 0))])
+    # The invisible pixels of a small building away from the boundary are
+    # removed from its bounding box (if none are visible the box is empty and
+    # matches nothing, where the set-based version raised a ValueError)
+    is_trimmed = is_small & (n_boundary == 0) & (n_invisible > 0)
+    visible = ~(is_invisible & is_trimmed[true_idx])
 
     # Make intersection a bit faster by filtering via bbox fist
-    true_rcs_bbox = ub.map_vals(_bbox, true_rcs_arr)
-    pred_rcs_bbox = ub.map_vals(_bbox, pred_rcs_arr)
-
-    true_bboxes = np.array(list(true_rcs_bbox.values()))
-    pred_bboxes = np.array(list(pred_rcs_bbox.values()))
-
-    candidate_matches = {}
-    for plabel, pb in zip(group_pred_labels, pred_bboxes):
-        irc1 = np.maximum(pb[0:2], true_bboxes[:, 0:2])
-        irc2 = np.minimum(pb[2:4], true_bboxes[:, 2:4])
-        irc1 = np.minimum(irc1, irc2, out=irc1)
-        isect_area = np.prod(np.abs(irc2 - irc1), axis=1)
-        tlabels = list(ub.take(group_true_labels, np.where(isect_area)[0]))
-        candidate_matches[plabel] = set(tlabels)
-
-    # using nums instead of tuples gives the intersection a modest speedup
-    pred_rcs_ = make_int_coords(pred_rc_arr, group_pred_labels, pred_groupxs)
-    true_rcs_ = make_int_coords(true_rc_arr, group_true_labels, true_groupxs)
+    true_r1, true_r2 = _extent(true_idx[visible], true_r[visible], n_true, H)
+    true_c1, true_c2 = _extent(true_idx[visible], true_c[visible], n_true, W)
+    pred_r1, pred_r2 = _extent(pred_idx, pred_r, n_pred, H)
+    pred_c1, pred_c2 = _extent(pred_idx, pred_c, n_pred, W)
+
+    # A pixel is keyed by `r + H + c`, so each instance is compared by the
+    # set of anti-diagonals it touches (one occupancy row per instance).
+    true_keys = _occupancy(true_idx, true_r + true_c, n_true, H + W - 1)
+    pred_keys = _occupancy(pred_idx, pred_r + pred_c, n_pred, H + W - 1)
+    true_n_keys = true_keys.sum(axis=1)
+    pred_n_keys = pred_keys.sum(axis=1)
+    true_lookup = dict(zip(true_ids.tolist(), range(n_true)))
 
     # Greedy matching
-    unused_true_rcs = true_rcs_.copy()
     FP = TP = FN = 0
-    unused_true_keys = set(unused_true_rcs.keys())
+    unused_true_keys = set(true_ids.tolist())
 
     assignment = []
     fp_labels = []
     fn_labels = []
     tp_labels = []
 
-    for pred_label, pred_rc_set in pred_rcs_.items():
+    for j, pred_label in enumerate(pred_ids.tolist()):
 
         best_score = (-np.inf, -np.inf)
         best_label = None
 
         # Only check unused true labels that intersect with the predicted bbox
-        true_cand = candidate_matches[pred_label] & unused_true_keys
-        for true_label in true_cand:
-            true_rc_set = unused_true_rcs[true_label]
-            n_isect = len(pred_rc_set.intersection(true_rc_set))
-            iou = n_isect / (len(true_rc_set) + len(pred_rc_set) - n_isect)
-            if iou > MIN_IOU:
-                score = (iou, -true_label)
-                if score > best_score:
-                    best_score = score
-                    best_label = true_label
+        # (bboxes are inclusive, so ones that share only an edge are skipped)
+        bbox_isect = (
+            (np.minimum(true_r2, pred_r2[j]) > np.maximum(true_r1, pred_r1[j])) &
+            (np.minimum(true_c2, pred_c2[j]) > np.maximum(true_c1, pred_c1[j])))
+        true_cand = set(true_ids[bbox_isect].tolist()) & unused_true_keys
+        if true_cand:
+            cand_labels = list(true_cand)
+            cand_idx = [true_lookup[label] for label in cand_labels]
+            n_isects = np.count_nonzero(
+                true_keys[cand_idx] & pred_keys[j], axis=1)
+            ious = n_isects / (true_n_keys[cand_idx] + pred_n_keys[j] - n_isects)
+            for true_label, iou in zip(cand_labels, ious):
+                if iou > MIN_IOU:
+                    score = (iou, -true_label)
+                    if score > best_score:
+                        best_score = score
+                        best_label = true_label
 
         if best_label is not None:
             assignment.append((pred_label, best_label, best_score[0]))
             unused_true_keys.remove(best_label)
+            # NOTE: this checks the last candidate visited, not best_label
             if true_label not in uncertain_labels:
                 TP += 1
                 tp_labels.append((pred_label, best_label, best_score[0]))
@@ -175,12 +171,6 @@ def instance_fscore(gti, uncertain, dsm, pred, info=False):
             FP += 1
             fp_labels.append(pred_label)
 
-    # Had two bugs:
-    # * used wrong variable to count false negs (all true were labeled as FN)
-    #   (massivly increasing FN)
-    # * Certain true building as marked as uncertain, but I was checking
-    #   against the pred labels instead (possibly decreasing/increasing TP)
-
     fn_labels = unused_true_keys - uncertain_labels  # NOQA
     FN = len(fn_labels)
 
@@ -203,3 +193,253 @@ def instance_fscore(gti, uncertain, dsm, pred, info=False):
         return (f_score, precision, recall), infod
 
     return (f_score, precision, recall)
+
+
+def _compact_labels(labels):
+    """
+    Returns:
+        Tuple[ndarray, ndarray, ndarray]: the sorted unique labels, the index
+            of each pixel's label into them (flattened), and the label areas
+    """
+    flat = np.asarray(labels).ravel()
+    if len(flat) and flat.min() < 0:
+        ids, idx = np.unique(flat, return_inverse=True)
+        return ids, idx.ravel(), np.bincount(idx.ravel())
+    # Non-negative labels avoid the sort in np.unique
+    counts = np.bincount(flat)
+    ids = np.flatnonzero(counts)
+    if len(ids) == len(counts):
+        # already compact (e.g. connected components)
+        return ids, flat, counts
+    lookup = np.zeros(len(counts), dtype=np.intp)
+    lookup[ids] = np.arange(len(ids))
+    return ids, lookup[flat], counts[ids]
+
+def _foreground_labels(labels):
+    """
+    Returns:
+        Tuple[ndarray, ndarray, ndarray]: the sorted positive labels, the flat
+            positions of their pixels, and the index of each of those pixels'
+            label into the sorted labels
+    """
+    flat = np.asarray(labels).ravel()
+    px = np.flatnonzero(flat > 0)
+    ids, idx, _ = _compact_labels(flat[px])
+    return ids, px, idx
+
+
+def _occupancy(idx, bins, n_labels, n_bins):
+    """ occupancy[i, b] is True if label index i has a pixel in bin b """
+    occupancy = np.zeros((n_labels, n_bins), dtype=bool)
+    occupancy[idx, bins] = True
+    return occupancy
+
+
+def _extent(idx, coords, n_labels, size):
+    """ inclusive min / max coordinate per label index (max is -1 if empty) """
+    occupancy = _occupancy(idx, coords, n_labels, size)
+    lo = occupancy.argmax(axis=1)
+    hi = size - 1 - occupancy[:, ::-1].argmax(axis=1)
+    hi[~occupancy.any(axis=1)] = -1
+    return lo, hi
+
+
+def _demo_instance_tile(seed=0, size=2048, n_buildings=300):
+    """ random gti, uncertain, dsm, and pred instance labels for testing """
+    import cv2
+    rng = np.random.RandomState(seed)
+    true_mask = np.zeros((size, size), dtype=np.uint8)
+    pred_mask = np.zeros((size, size), dtype=np.uint8)
+    for _ in range(n_buildings):
+        r, c = rng.randint(0, size, 2)
+        h, w = rng.randint(4, 80, 2)
+        true_mask[r:r + h, c:c + w] = 1
+        if rng.rand() > .2:
+            dr, dc = rng.randint(-10, 10, 2)
+            r, c = max(r + dr, 0), max(c + dc, 0)
+            pred_mask[r:r + h + rng.randint(-3, 3), c:c + w] = 1
+    _, gti = cv2.connectedComponents(true_mask, connectivity=4)
+    _, pred = cv2.connectedComponents(pred_mask, connectivity=4)
+    uncertain = np.zeros((size, size), dtype=bool)
+    uncertain[rng.randint(0, size, 200), rng.randint(0, size, 200)] = True
+    dsm = rng.rand(size, size)
+    dsm[rng.rand(size, size) < .001] = -32767
+    return gti, uncertain, dsm, pred
+
+
+def benchmark_instance_fscore(n_tiles=3):
+    """
+    Compares `instance_fscore` with the implementation it replaced, which
+    matched instances by intersecting python sets of pixel keys.
+
+    Example:
+        >>> # xdoc: +REQUIRES(--bench)
+        >>> benchmark_instance_fscore()
+    """
+    def _set_instance_fscore(gti, uncertain, dsm, pred, info=False):
+        # The implementation this replaced, unmodified (including the
+        # `r + H + c` pixel key and the `true_label` check), except that
+        # `np.bool`, which numpy 1.24 removed, is spelled `bool`.
+        from clab import util
+
+        def _bbox(arr):
+            # r1, c1, r2, c2
+            return np.hstack([arr.min(axis=0), arr.max(axis=0)])
+
+        def cc_locs(ccs):
+            rc_locs = np.where(ccs > 0)
+            rc_ids = ccs[rc_locs]
+            rc_arr = np.ascontiguousarray(np.vstack(rc_locs).T)
+            unique_labels, groupxs = util.group_indices(rc_ids)
+            grouped_arrs = util.apply_grouping(rc_arr, groupxs, axis=0)
+            id_to_rc = ub.odict(zip(unique_labels, grouped_arrs))
+            return id_to_rc, unique_labels, groupxs, rc_arr
+
+        (true_rcs_arr, group_true_labels,
+         true_groupxs, true_rc_arr) = cc_locs(gti)
+
+        (pred_rcs_arr, group_pred_labels,
+         pred_groupxs, pred_rc_arr) = cc_locs(pred)
+
+        DSM_NAN = -32767
+        MIN_SIZE = 100
+        MIN_IOU = 0.45
+        # H, W = pred.shape[0:2]
+
+        # --- Find uncertain truth ---
+        # any gt-building explicitly labeled in the GTL is uncertain
+        uncertain_labels = set(np.unique(gti[uncertain.astype(bool)]))
+        # Any gt-building less than 100px or at the boundary is uncertain.
+        for label, rc_arr in true_rcs_arr.items():
+            if len(rc_arr) < MIN_SIZE:
+                rc_arr = np.array(list(rc_arr))
+                if (np.any(rc_arr == 0) or np.any(rc_arr == 2047)):
+                    uncertain_labels.add(label)
+                else:
+                    rc_loc = tuple(rc_arr.T)
+                    is_invisible = (dsm[rc_loc] == DSM_NAN)
+                    if np.any(is_invisible):
+                        invisible_rc = rc_arr.compress(is_invisible, axis=0)
+                        invisible_rc_set = set(map(tuple, invisible_rc))
+                        # Remove invisible pixels
+                        remain_rc_set = list(set(map(tuple, rc_arr)).difference(invisible_rc_set))
+                        true_rcs_arr[label] = np.array(remain_rc_set)
+                        uncertain_labels.add(label)
+
+        def make_int_coords(rc_arr, unique_labels, groupxs):
+            # using nums instead of tuples gives the intersection a modest speedup
+            rc_int = rc_arr.T[0] + pred.shape[0] + rc_arr.T[1]
+            id_to_rc_int = ub.odict(zip(unique_labels,
+                                        map(set, util.apply_grouping(rc_int, groupxs))))
+            return id_to_rc_int
+
+        # Make intersection a bit faster by filtering via bbox fist
+        true_rcs_bbox = ub.map_vals(_bbox, true_rcs_arr)
+        pred_rcs_bbox = ub.map_vals(_bbox, pred_rcs_arr)
+
+        true_bboxes = np.array(list(true_rcs_bbox.values()))
+        pred_bboxes = np.array(list(pred_rcs_bbox.values()))
+
+        candidate_matches = {}
+        for plabel, pb in zip(group_pred_labels, pred_bboxes):
+            irc1 = np.maximum(pb[0:2], true_bboxes[:, 0:2])
+            irc2 = np.minimum(pb[2:4], true_bboxes[:, 2:4])
+            irc1 = np.minimum(irc1, irc2, out=irc1)
+            isect_area = np.prod(np.abs(irc2 - irc1), axis=1)
+            tlabels = list(ub.take(group_true_labels, np.where(isect_area)[0]))
+            candidate_matches[plabel] = set(tlabels)
+
+        # using nums instead of tuples gives the intersection a modest speedup
+        pred_rcs_ = make_int_coords(pred_rc_arr, group_pred_labels, pred_groupxs)
+        true_rcs_ = make_int_coords(true_rc_arr, group_true_labels, true_groupxs)
+
+        # Greedy matching
+        unused_true_rcs = true_rcs_.copy()
+        FP = TP = FN = 0
+        unused_true_keys = set(unused_true_rcs.keys())
+
+        assignment = []
+        fp_labels = []
+        fn_labels = []
+        tp_labels = []
+
+        for pred_label, pred_rc_set in pred_rcs_.items():
+
+            best_score = (-np.inf, -np.inf)
+            best_label = None
+
+            # Only check unused true labels that intersect with the predicted bbox
+            true_cand = candidate_matches[pred_label] & unused_true_keys
+            for true_label in true_cand:
+                true_rc_set = unused_true_rcs[true_label]
+                n_isect = len(pred_rc_set.intersection(true_rc_set))
+                iou = n_isect / (len(true_rc_set) + len(pred_rc_set) - n_isect)
+                if iou > MIN_IOU:
+                    score = (iou, -true_label)
+                    if score > best_score:
+                        best_score = score
+                        best_label = true_label
+
+            if best_label is not None:
+                assignment.append((pred_label, best_label, best_score[0]))
+                unused_true_keys.remove(best_label)
+                if true_label not in uncertain_labels:
+                    TP += 1
+                    tp_labels.append((pred_label, best_label, best_score[0]))
+            else:
+                FP += 1
+                fp_labels.append(pred_label)
+
+        # Had two bugs:
+        # * used wrong variable to count false negs (all true were labeled as FN)
+        #   (massivly increasing FN)
+        # * Certain true building as marked as uncertain, but I was checking
+        #   against the pred labels instead (possibly decreasing/increasing TP)
+
+        fn_labels = unused_true_keys - uncertain_labels  # NOQA
+        FN = len(fn_labels)
+
+        precision = TP / (TP + FP) if TP > 0 else 0
+        recall = TP / (TP + FN) if TP > 0 else 0
+        if precision > 0 and recall > 0:
+            f_score = 2 * precision * recall / (precision + recall)
+        else:
+            f_score = 0
+
+        # They multiply by 1e6, but lets not do that.
+        if info:
+            infod = {
+                'assign': assignment,
+                'tp': tp_labels,
+                'fp': fp_labels,
+                'fn': fn_labels,
+                'uncertain': uncertain_labels,
+            }
+            return (f_score, precision, recall), infod
+
+        return (f_score, precision, recall)
+
+    for seed in range(n_tiles):
+        args = _demo_instance_tile(seed)
+        ti = ub.Timerit(1, bestof=1, verbose=0)
+        for timer in ti.reset('sets'):
+            with timer:
+                old_scores, old_info = _set_instance_fscore(*args, info=True)
+        t_old = ti.min()
+        for timer in ti.reset('occupancy'):
+            with timer:
+                new_scores, new_info = instance_fscore(*args, info=True)
+        t_new = ti.min()
+        assert old_scores == new_scores, (old_scores, new_scores)
+        assert old_info == new_info
+        print('tile {}: sets {:.3f}s, occupancy {:.3f}s, scores = {}'.format(
+            seed, t_old, t_new, ub.repr2(new_scores, precision=4, nl=0)))
+
+
+if __name__ == '__main__':
+    r"""
+    CommandLine:
+        python -m clab.live.urban_metrics all
+    """
+    import xdoctest
+    xdoctest.doctest_module(__file__)
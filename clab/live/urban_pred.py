@@ -49,7 +49,9 @@ from os.path import join, splitext, basename  # NOQA
 from clab import util
 from clab import xpu_device
 from clab import models
+from clab import stitching
 from clab.util import imutil
+from clab.live import instance_labeling
 from clab.live.urban_metrics import instance_fscore
 from clab.fit_harness import get_snapshot
 
@@ -349,16 +351,11 @@ def eval_internal_testset():
         pharn._blend_full_probs(task, 'probs1', npy_fpaths=paths['probs1'])
 
     # draw_failures()
-    seeded_bo = hypersearch_probs(task, paths)
-    print('seeded ' + ub.repr2(bo_best(seeded_bo), nl=0, precision=4))
+    search = hypersearch_probs(task, paths)
+    print('seeded ' + ub.repr2(search.best(), nl=0, precision=4))
     print(arch)
 
 
-def bo_best(self):
-    return {'max_val': self.Y.max(),
-            'max_params': dict(zip(self.keys, self.X[self.Y.argmax()]))}
-
-
 def check_ensemble():
     model1 = '/home/local/KHQ/jon.crall/data/work/urban_mapper2/test/input_26400-sotwptrx/solver_52200-fqljkqlk_unet2_ybypbjtw_smvuzfkv_a=1,c=RGB,n_ch=6,n_cl=4/_epoch_00000000/stitched'
 
@@ -392,61 +389,14 @@ def check_ensemble():
         uncertain = (gtl == 65)
         return gti, uncertain, dsm, bgr
 
-    @ub.memoize
-    def memo_read_arr(fpath):
-        return util.read_arr(fpath)
-
-    def preload():
-        import tqdm
-        n_paths = len(paths_m2['probs'])
-        for ix in tqdm.trange(n_paths, leave=True, desc='preload'):
-            gti, uncertain, dsm, bgr = gt_info_from_path(paths_m1['probs'][ix])
-
-            memo_read_arr(paths_m1['probs'][ix])
-            memo_read_arr(paths_m1['probs1'][ix])
-
-            memo_read_arr(paths_m2['probs'][ix])
-            memo_read_arr(paths_m2['probs1'][ix])
-
-    preload()  # read datas into memory
-
-    def seeded_objective(**params):
-        # CONVERT PROBABILITIES TO INSTANCE PREDICTIONS
-        import tqdm
-
-        alpha = params.pop('alpha', .88)
-
-        fscores = []
-        # params = {'mask_thresh': 0.7664, 'min_seed_size': 48.5327, 'min_size': 61.8757, 'seed_thresh': 0.4090}
-        n_paths = len(paths_m2['probs'])
-        for ix in tqdm.trange(n_paths, leave=False, desc='eval objective'):
-
-            gti, uncertain, dsm, bgr = gt_info_from_path(paths_m1['probs'][ix])
-
-            probs_m1 = memo_read_arr(paths_m1['probs'][ix])
-            probs1_m1 = memo_read_arr(paths_m1['probs1'][ix])
-
-            probs_m2 = memo_read_arr(paths_m2['probs'][ix])
-            probs1_m2 = memo_read_arr(paths_m2['probs1'][ix])
-
-            probs = (alpha * probs_m1 + (1 - alpha) * probs_m2)
-            probs1 = (alpha * probs1_m1 + (1 - alpha) * probs1_m2)
-
-            INNER_BUILDING_ID = 1
-            BUILDING_ID = 1
-
-            seed_prob = probs[:, :, INNER_BUILDING_ID]
-            mask_prob = probs1[:, :, BUILDING_ID]
-
-            pred = seeded_instance_label_from_probs(seed_prob, mask_prob,
-                                                    **params)
-
-            scores = instance_fscore(gti, uncertain, dsm, pred)
-
-            fscore = scores[0]
-            fscores.append(fscore)
-        mean_fscore = np.mean(fscores)
-        return mean_fscore
+    from clab.live.postproc_search import PostprocTiles, PostprocSearch
+    INNER_BUILDING_ID = 1
+    BUILDING_ID = 1
+    tiles = PostprocTiles.from_paths(
+        [paths_m1['probs'], paths_m2['probs']],
+        [paths_m1['probs1'], paths_m2['probs1']],
+        gt_info_from_path, seed_channel=INNER_BUILDING_ID,
+        mask_channel=BUILDING_ID)
 
     seeded_bounds = {
         'mask_thresh': (.4, .9),
@@ -456,9 +406,6 @@ def check_ensemble():
         'alpha': (.80, 1.0),
     }
 
-    from bayes_opt import BayesianOptimization
-    seeded_bo = BayesianOptimization(seeded_objective, seeded_bounds)
-    import pandas as pd
     cand_params = [
         {'mask_thresh': 0.9000, 'min_seed_size': 100.0000, 'min_size': 100.0000, 'seed_thresh': 0.4000},
         {'mask_thresh': 0.8367, 'seed_thresh': 0.4549, 'min_seed_size': 97, 'min_size': 33},  # 'max_val': 0.8708
@@ -473,24 +420,10 @@ def check_ensemble():
     ]
     for p in cand_params:
         p['alpha'] = .88
-    n_init = 20
-
-    seeded_bo.explore(pd.DataFrame(cand_params).to_dict(orient='list'))
-
-    # Basically just using this package for random search.
-    # The BO doesnt seem to help much
-    seeded_bo.plog.print_header(initialization=True)
-    seeded_bo.init(n_init)
-    print('seeded ' + ub.repr2(bo_best(seeded_bo), nl=0, precision=4))
 
-    gp_params = {"alpha": 1e-5, "n_restarts_optimizer": 2}
-
-    n_iter = n_init // 4
-    for kappa in [10, 5, 1]:
-        seeded_bo.maximize(n_iter=n_iter, acq='ucb', kappa=kappa, **gp_params)
-
-    print('seeded ' + ub.repr2(bo_best(seeded_bo), nl=0, precision=4))
-    return seeded_bo
+    with PostprocSearch(tiles, seeded_bounds) as search:
+        search.maximize(cand_params, n_init=20, n_rounds=15)
+    return search
 
 
 def hypersearch_probs(task, paths):
@@ -515,60 +448,15 @@ def hypersearch_probs(task, paths):
         uncertain = (gtl == 65)
         return gti, uncertain, dsm, bgr
 
-    # https://github.com/fmfn/BayesianOptimization
-    # https://github.com/fmfn/BayesianOptimization/blob/master/examples/usage.py
-    # https://github.com/fmfn/BayesianOptimization/blob/master/examples/exploitation%20vs%20exploration.ipynb
-    sub0 = prob_paths
-    sub1 = prob1_paths
-
     # subx = [0, 1, 2, 3, 4, 5]
     # subx = [2, 4, 5, 9, 10, 14, 17, 18, 20, 30, 33, 39, 61, 71, 72, 73, 75, 81, 84]
     # subx = [0, 1]
-    # sub0 = list(ub.take(prob_paths, subx))
-    # sub1 = list(ub.take(prob1_paths, subx))
-    # pip install bayesian-optimization
-    from bayes_opt import BayesianOptimization
-
-    @ub.memoize
-    def memo_read_arr(fpath):
-        return util.read_arr(fpath)
-
-    def preload():
-        import tqdm
-        n_paths = len(paths['probs'])
-        for ix in tqdm.trange(n_paths, leave=True, desc='preload'):
-            gti, uncertain, dsm, bgr = gt_info_from_path(paths['probs'][ix])
-
-            memo_read_arr(paths['probs'][ix])
-            memo_read_arr(paths['probs1'][ix])
-
-    def seeded_objective(**params):
-        # CONVERT PROBABILITIES TO INSTANCE PREDICTIONS
-        fscores = []
-        import tqdm
-        for path, path1 in tqdm.tqdm(list(zip(sub0, sub1)), desc='calc objective', leave=False):
-            gti, uncertain, dsm, bgr = gt_info_from_path(path)
-
-            probs = memo_read_arr(path)
-            seed_prob = probs[:, :, task.classname_to_id['inner_building']]
-
-            probs1 = memo_read_arr(path1)
-            # from clab.live.filters import crf_posterior
-            # Doesnt help
-            # if use_crf:
-            #     probs1 = crf_posterior(bgr[:, :, ::-1], np.log(probs1).transpose(2, 0, 1)).transpose(1, 2, 0)
-
-            mask_prob = probs1[:, :, 1]
-
-            pred = seeded_instance_label_from_probs(seed_prob, mask_prob,
-                                                    **params)
-
-            scores = instance_fscore(gti, uncertain, dsm, pred)
-            fscore = scores[0]
-            fscores.append(fscore)
-        mean_fscore = np.mean(fscores)
-        return mean_fscore
-    # params = {'mask_thresh': 0.7664, 'min_seed_size': 48.5327, 'min_size': 61.8757, 'seed_thresh': 0.4090}
+    # prob_paths = list(ub.take(prob_paths, subx))
+    # prob1_paths = list(ub.take(prob1_paths, subx))
+    from clab.live.postproc_search import PostprocTiles, PostprocSearch
+    tiles = PostprocTiles.from_paths(
+        [prob_paths], [prob1_paths], gt_info_from_path,
+        seed_channel=task.classname_to_id['inner_building'], mask_channel=1)
 
     seeded_bounds = {
         'mask_thresh': (.4, .9),
@@ -576,9 +464,6 @@ def hypersearch_probs(task, paths):
         'min_seed_size': (0, 100),
         'min_size': (0, 100),
     }
-    n_init = 10
-    seeded_bo = BayesianOptimization(seeded_objective, seeded_bounds)
-    import pandas as pd
     cand_params = [
         {'mask_thresh': 0.9000, 'min_seed_size': 100.0000, 'min_size': 100.0000, 'seed_thresh': 0.4000},
         {'mask_thresh': 0.8367, 'seed_thresh': 0.4549, 'min_seed_size': 97, 'min_size': 33},  # 'max_val': 0.8708
@@ -593,27 +478,9 @@ def hypersearch_probs(task, paths):
         {'mask_thresh': 0.7870, 'min_seed_size': 85.1641, 'min_size': 64.0634, 'seed_thresh': 0.4320},
     ]
 
-    # for params in cand_params:
-    #     print('---')
-    #     print(seeded_objective(**params, use_crf=False))
-    #     print(seeded_objective(**params, use_crf=True))
-
-    seeded_bo.explore(pd.DataFrame(cand_params).to_dict(orient='list'))
-
-    # Basically just using this package for random search.
-    # The BO doesnt seem to help much (due to int constraints?)
-    seeded_bo.plog.print_header(initialization=True)
-    seeded_bo.init(n_init)
-    print('seeded ' + ub.repr2(bo_best(seeded_bo), nl=0, precision=4))
-
-    gp_params = {"alpha": 1e-5, "n_restarts_optimizer": 2}
-
-    n_iter = n_init // 2
-    for kappa in [10, 5, 1]:
-        seeded_bo.maximize(n_iter=n_iter, acq='ucb', kappa=kappa, **gp_params)
-
-    print('seeded ' + ub.repr2(bo_best(seeded_bo), nl=0, precision=4))
-    return seeded_bo
+    with PostprocSearch(tiles, seeded_bounds) as search:
+        search.maximize(cand_params, n_init=10, n_rounds=15)
+    return search
 
 
 def draw_failures(task, paths):
@@ -734,6 +601,8 @@ class PredictHarness(object):
         pharn.xpu = xpu_device.XPU.from_argv()
         pharn.model = None
         pharn.test_dump_dpath = None
+        # maximum amount of input data predicted at once
+        pharn.max_batch_bytes = 2 ** 26
 
     def load_normalize_center(pharn, train_dpath):
         info_dpath = join(train_dpath, 'train_info.json')
@@ -850,127 +719,128 @@ class PredictHarness(object):
 
                 util.imwrite(c_fpath, draw_img)
 
-    # from clab.profiler import profile_onthefly
-    # @profile_onthefly
+    def _load_part(pharn, ix):
+        if pharn.dataset.with_gt:
+            inputs_ = pharn.dataset[ix][0]
+        else:
+            inputs_ = pharn.dataset[ix]
+        if not isinstance(inputs_, (list, tuple)):
+            inputs_ = [inputs_]
+        return list(inputs_)
+
+    def _part_batches(pharn, grouped_indices):
+        """
+        Loads the parts of each full image in batches of at most
+        `pharn.max_batch_bytes` of input data.
+
+        Yields:
+            tuple: (key, rc_locs, inputs, is_last) where rc_locs are the upper
+                left locations of the batched parts in the full image `key`
+                and is_last is True for the final batch of each image.
+        """
+        batch_size = None
+        for key, groupxs in grouped_indices.items():
+            names = ub.take(pharn.dataset.inputs.dump_im_names, groupxs)
+            rc_locs = stitching.extract_part_grid(names)
+            batch = []
+            for count, ix in enumerate(groupxs, start=1):
+                parts = pharn._load_part(ix)
+                if batch_size is None:
+                    nbytes = sum(p.nelement() * p.element_size() for p in parts)
+                    batch_size = max(1, pharn.max_batch_bytes // nbytes)
+                batch.append(parts)
+                if len(batch) == batch_size or count == len(groupxs):
+                    inputs_ = [torch.stack(p) for p in zip(*batch)]
+                    batch_locs = rc_locs[count - len(batch):count]
+                    yield key, batch_locs, inputs_, count == len(groupxs)
+                    batch = []
+
     def run(pharn):
+        """
+        Predicts all parts in the dataset and stitches the probabilities of
+        each output head back into full images.
+
+        The parts of each image are predicted in batches while the next batch
+        is loaded in a background thread. Weighted probabilities are
+        accumulated directly into a float32 canvas for the full image and the
+        stitched image is written in the background while the next image is
+        predicted, so memory is proportional to the size of an image rather
+        than the total size of its parts.
+        """
+        from clab.data import prefetch
+        import threading
+        import tqdm
         print('Preparing to predict {} on {}'.format(pharn.model.__class__.__name__, pharn.xpu))
         pharn.model.train(False)
 
-        # Hack in the restitching here to not have to deal with expensive IO
-        def _extract_part_grid(paths):
-            # hack to use filenames to extract upper left locations of tiles in
-            # the larger image.
-            rc_locs = [[int(x) for x in basename(p).split('.')[0].split('_')[-2:]]
-                       for p in paths]
-            return rc_locs
-
-        def stitch_tiles_avew(rc_locs, tiles):
-            """
-            Recombine parts back into an entire image
-
-            Example:
-                >>> rc_locs = [(0, 0), (0, 5), (0, 10)]
-                >>> tiles = [np.ones((1, 7, 3)) + i for i in range(len(rc_locs))]
-                >>> tiles = [np.ones((1, 7)) + i for i in range(len(rc_locs))]
-            """
-            shapes = [t.shape[0:2] for t in tiles]
-            n_channels = 1 if len(tiles[0].shape) == 2 else tiles[0].shape[2]
-            bboxes = np.array([
-                (r, c, r + h, c + w)
-                for ((r, c), (h, w)) in zip(rc_locs, shapes)
-            ])
-            stiched_wh = tuple(bboxes.T[2:4].max(axis=1))
-            stiched_shape = stiched_wh
-            if n_channels > 1:
-                stiched_shape = stiched_wh + (n_channels,)
-            sums = np.zeros(stiched_shape)
-            nums = np.zeros(stiched_wh)
-
-            # assume all shapes are the same
-            h, w = shapes[0]
-            weight = np.ones((h, w) )
-            # Weight borders less than center
-            # should really use receptive fields for this calculation
-            # but this should be fine.
-            weight[:h // 4]  = .25
-            weight[-h // 4:] = .25
-            weight[:w // 4]  = .25
-            weight[-w // 4:] = .25
-            weight3c = weight
-            if n_channels > 1:
-                weight3c = weight[:, :, None]
-
-            # Assume we are not in log-space here, so the weighted average
-            # formula does not need any exponentiation.
-            for bbox, tile in zip(bboxes, tiles):
-                r1, c1, r2, c2 = bbox
-                sums[r1:r2, c1:c2] += (tile * weight3c)
-                nums[r1:r2, c1:c2] += weight
-
-            if len(sums.shape) == 2:
-                stiched = sums / nums
-            else:
-                stiched = sums / nums[:, :, None]
-            return stiched
-
         groupids = [basename(p).split('_part')[0]
                     for p in pharn.dataset.inputs.dump_im_names]
         grouped_indices = ub.group_items(range(len(groupids)), groupids)
 
-        # map(len, grouped_indices)
-        # ub.chunks
-        #     loader = torch.utils.data.DataLoader(
-        #         pharn.dataset, shuffle=False,
-        #         pin_memory=True,
-        #         num_workers=0,
-        #         batch_size=1,
-        #     )
-
         output_dpath = join(pharn.test_dump_dpath, 'stitched')
         ub.ensuredir(output_dpath)
 
-        # prog = ub.ProgIter(length=len(grouped_indices), label='predict group proba', verbose=3)
-
-        import tqdm
-        for key, groupxs in tqdm.tqdm(grouped_indices.items(), desc='predict group proba'):
-
-            grouped_probs = ub.odict()
-            grouped_probs[''] = []
-            grouped_probs['1'] = []
-
-            for ix in tqdm.tqdm(groupxs, desc='pred'):
-
-                if pharn.dataset.with_gt:
-                    inputs_ = pharn.dataset[ix][0]
-                else:
-                    inputs_ = pharn.dataset[ix]
-                inputs_ = inputs_[None, ...]
-
-                if not isinstance(inputs_, (list, tuple)):
-                    inputs_ = [inputs_]
-
-                inputs_ = pharn.xpu.variables(*inputs_)
-                outputs = pharn.model.forward(inputs_)
-
-                for ox in range(len(outputs)):
+        def _write(key, stitched):
+            try:
+                for ox, arr in enumerate(stitched):
                     suffix = '' if ox == 0 else str(ox)
-
-                    output_tensor = outputs[ox]
-                    log_prob_tensor = torch.nn.functional.log_softmax(output_tensor, dim=1)[0]
-                    prob_tensor = torch.exp(log_prob_tensor)
-                    probs = np.ascontiguousarray(prob_tensor.data.cpu().numpy().transpose(1, 2, 0))
-
-                    grouped_probs[suffix].append(probs)
-
-            rc_locs = _extract_part_grid(ub.take(pharn.dataset.inputs.dump_im_names, groupxs))
-            for suffix, tiles in grouped_probs.items():
-                # from clab.profiler import profile_onthefly
-                # profile_onthefly(stitch_tiles_ave)(rc_locs, tiles, weighted=True)
-                stitched = stitch_tiles_avew(rc_locs, tiles)
-
-                dpath = ub.ensuredir(join(output_dpath, 'probs' + suffix))
-                fpath = join(dpath, key + '.h5')
-                util.write_h5arr(fpath, stitched)
+                    dpath = ub.ensuredir(join(output_dpath, 'probs' + suffix))
+                    fpath = join(dpath, key + '.h5')
+                    util.write_h5arr(fpath, arr)
+            except Exception as ex:
+                write_errors.append(ex)
+
+        def _wait_for_write():
+            if writer is not None:
+                writer.join()
+            if write_errors:
+                raise write_errors[0]
+
+        def _stage(item):
+            key, rc_locs, inputs_, is_last = item
+            return key, rc_locs, prefetch.pin_batch(inputs_), is_last
+
+        loader = pharn._part_batches(grouped_indices)
+        prefetcher = prefetch.BatchPrefetcher(loader, stage=_stage, depth=2)
+        prog = tqdm.tqdm(total=len(groupids), desc='predict parts')
+
+        writer = None
+        write_errors = []
+        stitchers = None
+        with torch.no_grad():
+            for key, rc_locs, inputs_, is_last in prefetcher:
+                inputs_ = list(pharn.xpu.variables(*inputs_, non_blocking=True))
+                outputs = pharn.model.forward(inputs_)
+                if torch.is_tensor(outputs):
+                    outputs = [outputs]
+
+                # probabilities in NHWC format
+                probs = [torch.nn.functional.softmax(out, dim=1).permute(0, 2, 3, 1).cpu()
+                         for out in outputs]
+
+                if stitchers is None:
+                    # Preallocate a canvas for each output of this full image
+                    names = ub.take(pharn.dataset.inputs.dump_im_names,
+                                    grouped_indices[key])
+                    locs = np.array(stitching.extract_part_grid(names))
+                    stitched_hw = locs.max(axis=0) + probs[0].shape[1:3]
+                    stitchers = [
+                        stitching.Stitcher(stitched_hw, p.shape[3], blend='avew')
+                        for p in probs
+                    ]
+
+                for stitcher, prob in zip(stitchers, probs):
+                    stitcher.add_tiles(rc_locs, prob)
+                prog.update(len(rc_locs))
+
+                if is_last:
+                    stitched = [stitcher.finalize() for stitcher in stitchers]
+                    _wait_for_write()
+                    writer = threading.Thread(target=_write, args=(key, stitched))
+                    writer.start()
+                    stitchers = None
+        _wait_for_write()
+        prog.close()
 
 
 def draw_gt_contours2(img, gt, thickness=4, alpha=1):
@@ -1088,28 +958,10 @@ def test_instance_restitch(out_fpaths, task):
 
 def mask_instance_label(pred, k=15, n_iters=1, dist_thresh=5,
                         min_size=0, watershed=False):
-    import cv2
-    mask = pred
-    # noise removal
-    if k > 1:
-        kernel = np.ones((k, k), np.uint8)
-        mask = cv2.morphologyEx(mask, cv2.MORPH_OPEN, kernel,
-                                iterations=n_iters)
-
-    if watershed:
-        from clab.live import filters
-        mask = filters.watershed_filter(mask, dist_thresh=dist_thresh)
-
-    mask = mask.astype(np.uint8)
-    n_ccs, pred_ccs = cv2.connectedComponents(mask, connectivity=4)
-
-    if min_size > 0:
-        # Remove small predictions
-        for inner_id, inner_rcs in util.cc_locs(pred_ccs).items():
-            if len(inner_rcs) < min_size:
-                pred_ccs[tuple(inner_rcs.T)] = 0
-
-    return pred_ccs
+    labeler = instance_labeling.default_labeler()
+    return labeler.instance_label(pred, k=k, n_iters=n_iters,
+                                  dist_thresh=dist_thresh, watershed=watershed,
+                                  min_size=min_size)
 
 
 def seeded_instance_label_from_probs(seed_prob, mask_prob, seed_thresh=.4,
@@ -1130,73 +982,50 @@ def seeded_instance_label_from_probs(seed_prob, mask_prob, seed_thresh=.4,
 
 def seeded_instance_label(seed, mask, inner_k=0, outer_k=0, post_k=0,
                           min_seed_size=0, min_size=0):
-    import cv2
+    """
+    Labels the instances in `mask` by growing the components of `seed` with a
+    watershed.
+
+    The work is split into stages (`seed_stage`, `watershed_stage`,
+    `min_size_stage`) that only depend on some of the parameters, so a
+    parameter search can cache their results (see
+    `clab.live.postproc_search`). Note that `post_k` has no effect on the
+    result.
+    """
+    seed, seed_ccs = seed_stage(seed, inner_k=inner_k,
+                                min_seed_size=min_seed_size)
+    pred_ccs = watershed_stage(seed, seed_ccs, mask, outer_k=outer_k)
+    return min_size_stage(pred_ccs, min_size=min_size)
+
 
-    mask = mask.astype(np.uint8)
-    seed = seed.astype(np.uint8)
-
-    if inner_k > 0:
-        kernel = np.ones((inner_k, inner_k), np.uint8)
-        seed = cv2.morphologyEx(seed, cv2.MORPH_OPEN, kernel,
-                                 iterations=1)
-
-    if min_seed_size > 0:
-        # Remove very small seeds
-        for inner_id, inner_rcs in util.cc_locs(seed).items():
-            if len(inner_rcs) < min_seed_size:
-                seed[tuple(inner_rcs.T)] = 0
-
-    seed_ccs = cv2.connectedComponents(seed, connectivity=4)[1]
-
-    # Remove seeds not surrounded by a mask
-    seed[(seed & ~mask)] = 0
-
-    if outer_k > 1:
-        mask = cv2.morphologyEx(mask, cv2.MORPH_ERODE,
-                                np.ones((outer_k, outer_k), np.uint8),
-                                iterations=1)
-        # Ensure we dont clobber a seed
-        mask[seed.astype(np.bool)] = 1
-
-    dmask1 = cv2.dilate(mask, np.ones((3, 3)))
-    dmask2 = cv2.dilate(dmask1, np.ones((3, 3)))
-
-    # Build a topological wall between mask components
-    twall = dmask1 - mask
-
-    # Pixels beyond the wall region are sure background
-    sure_bg = 1 - dmask2
-
-    # prepare watershed seeds
-    # Label sure background as 1
-    wseed = sure_bg.astype(np.int)
-    # Add the seeds starting at 2
-    seed_mask = seed_ccs > 0
-    seed_labels = seed_ccs[seed_mask]
-    wseed[seed_mask] = seed_labels + 1
-    # The unsure region is now labeled as zero
-
-    topology = np.dstack([twall * 255] * 3)
-    markers = np.ascontiguousarray(wseed.astype(np.int32).copy())
-    markers = cv2.watershed(topology, markers)
-    # Remove background and border labels
-    markers[markers <= 1] = 0
-
-    instance_mask = (markers > 0).astype(np.uint8)
-
-    if post_k > 0:
-        mask = cv2.morphologyEx(mask, cv2.MORPH_ERODE,
-                                np.ones((post_k, post_k), np.uint8),
-                                iterations=1)
-
-    pred_ccs = cv2.connectedComponents(instance_mask, connectivity=4)[1]
-
-    if min_size > 0:
-        # Remove small predictions
-        for inner_id, inner_rcs in util.cc_locs(pred_ccs).items():
-            if len(inner_rcs) < min_size:
-                pred_ccs[tuple(inner_rcs.T)] = 0
-    return pred_ccs
+def seed_stage(seed, inner_k=0, min_seed_size=0):
+    """
+    Cleans a binary seed mask.
+
+    Returns:
+        Tuple[ndarray, ndarray]: the uint8 seed mask and its 4-connected
+            components
+    """
+    labeler = instance_labeling.default_labeler()
+    return labeler.seeds(seed, inner_k=inner_k, min_seed_size=min_seed_size)
+
+
+def watershed_stage(seed, seed_ccs, mask, outer_k=0):
+    """
+    Grows the seed components within the mask.
+
+    Returns:
+        ndarray: 4-connected components of the watershed regions
+    """
+    labeler = instance_labeling.default_labeler()
+    return labeler.watershed(seed, seed_ccs, mask, outer_k=outer_k)
+
+
+def min_size_stage(pred_ccs, min_size=0):
+    """
+    Removes predicted instances smaller than `min_size` (inplace)
+    """
+    return instance_labeling.remove_small_labels(pred_ccs, min_size)
 
 
 if __name__ == '__main__':
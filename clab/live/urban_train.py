@@ -51,6 +51,9 @@ class SSegInputsWrapper(torch.utils.data.Dataset):
 
         self.loader = im_loaders.np_loader
         self.rng = np.random.RandomState(432432)
+        # If set to a ChipStore of the inputs, chips are read from the store
+        # instead of decoding each file
+        self.chips = None
 
         inputs_base = ub.ensuredir((task.workdir, 'inputs'))
         inputs.base_dpath = inputs_base
@@ -193,25 +196,28 @@ class SSegInputsWrapper(torch.utils.data.Dataset):
             gt_tensor = im_loaders.label_to_long_tensor(gt)
         return input_tuple, gt_tensor
 
-    def load_inputs(self, index):
-        im_fpath = self.inputs.im_paths[index]
+    def _load(self, key, index, colorspace=None):
+        if self.chips is not None:
+            # zero-copy read from the packed store
+            return im_loaders.np_convert(self.chips[index][key], colorspace)
+        else:
+            fpath = self.inputs.paths[key][index]
+            return self.loader(fpath, colorspace=colorspace)
 
+    def load_inputs(self, index):
         if self.inputs.gt_paths:
-            gt_fpath = self.inputs.gt_paths[index]
-            gt_hwc = self.loader(gt_fpath, colorspace=None)
+            gt_hwc = self._load('gt', index, colorspace=None)
         else:
             gt_hwc = None
 
         # Load in RGB for now, we will convert right before we center the data
-        im = self.loader(im_fpath, colorspace='RGB')
+        im = self._load('im', index, colorspace='RGB')
 
         aux_channels = []
         if self.aux_keys:
-            aux_paths = [self.inputs.aux_paths[k][index]
-                         for k in self.aux_keys]
             aux_channel = np.dstack([
-                self.loader(p, colorspace=None)
-                for p in aux_paths
+                self._load(k, index, colorspace=None)
+                for k in self.aux_keys
             ])
             aux_channels = [aux_channel]
 
@@ -9,6 +9,7 @@ let t_i = sum_j(n_ij) be the total number of pixels of class i.
 """
 # use averages in util_averages
 from clab import util
+from clab import xpu_device
 import numpy as np
 from scipy.sparse import coo_matrix
 import torch  # NOQA
@@ -439,6 +440,138 @@ def _clf_metrics(output, label, all_labels, ignore_label=-100):
     return metrics_dict
 
 
+class ConfusionAccumulator(object):
+    """
+    Accumulates a confusion matrix over an epoch on the device of the
+    predictions.
+
+    Each `update` is a bincount of `true * n + pred` added into an integer
+    tensor, without masking or copying to the host, so it does not force a
+    device sync. Metrics are only computed when `summary` is called.
+
+    Args:
+        n_classes (int): number of classes
+        ignore_label (int): pixels with this true or predicted label are not
+            counted, and its row / column is excluded from the metrics.
+
+    Example:
+        >>> output = torch.FloatTensor([[[.9, .1], [.2, .8]], [[.1, .9], [.8, .2]]])
+        >>> label = torch.LongTensor([[0, 1], [0, 2]])
+        >>> accum = ConfusionAccumulator(n_classes=3, ignore_label=2)
+        >>> accum.update(output[None], label[None])
+        >>> print(accum.cfsn.numpy())
+        [[1 1 0]
+         [0 1 0]
+         [0 0 0]]
+        >>> print(ub.repr2(accum.summary(), precision=3, nl=0))
+        {'miou': 0.500, 'pixel_acc': 0.667, 'class_acc': 0.750}
+        >>> # labels can also be compared directly with predictions
+        >>> accum.update(torch.LongTensor([0, 1]), torch.LongTensor([0, 1]))
+        >>> assert accum.cfsn.sum() == 5
+        >>> accum.reset()
+        >>> assert accum.cfsn.sum() == 0
+        >>> # class_acc averages over predicted classes, like `_sseg_metrics`
+        >>> accum = ConfusionAccumulator(n_classes=3)
+        >>> accum.update(torch.LongTensor([0, 0, 1, 2]), torch.LongTensor([0, 1, 1, 1]))
+        >>> print(ub.repr2(accum.summary(), precision=3, nl=0))
+        {'miou': 0.278, 'pixel_acc': 0.500, 'class_acc': 0.500}
+
+    Example:
+        >>> # An accumulator per tag that is summarized after each epoch
+        >>> from clab import fit_harness
+        >>> harn = fit_harness.FitHarness(loaders={})
+        >>> accums = {'train': ConfusionAccumulator(n_classes=2)}
+        >>> @harn.add_batch_metric_hook
+        >>> def batch_metrics(harn, output, label):
+        >>>     accums[harn.current_tag].update(output, label)
+        >>>     return {}
+        >>> @harn.add_epoch_metric_hook
+        >>> def epoch_metrics(harn, tag):
+        >>>     return accums[tag].summary(reset=True)
+    """
+    def __init__(accum, n_classes, ignore_label=-100):
+        accum.n_classes = n_classes
+        accum.ignore_label = ignore_label
+        accum._cfsn = None
+
+    def reset(accum):
+        accum._cfsn = None
+
+    def update(accum, output, label):
+        """
+        Args:
+            output (Tensor): class scores with classes along dimension 1, or
+                predicted labels with the same shape as `label`.
+            label (Tensor): true labels
+        """
+        output = getattr(output, 'data', output)
+        true = getattr(label, 'data', label)
+        if output.dim() == true.dim() + 1:
+            pred = output.max(dim=1)[1]
+        else:
+            pred = output
+        n = accum.n_classes
+        if accum._cfsn is None or accum._cfsn.device != true.device:
+            # the last bin collects every pixel that is not counted
+            accum._cfsn = torch.zeros(n * n + 1, dtype=torch.long,
+                                      device=true.device)
+        true = true.view(-1).long()
+        pred = pred.view(-1).long().to(true.device)
+        valid = ((true >= 0) & (true < n) & (pred >= 0) & (pred < n) &
+                 (true != accum.ignore_label) & (pred != accum.ignore_label))
+        bins = torch.where(valid, true * n + pred, torch.full_like(true, n * n))
+        # index_add_ is a bincount that does not need the max bin on the host
+        accum._cfsn.index_add_(0, bins, torch.ones_like(bins))
+
+    @property
+    def cfsn(accum):
+        """
+        Tensor: confusion matrix where rows are true and columns are predicted
+            labels (on the device of the updates)
+        """
+        n = accum.n_classes
+        if accum._cfsn is None:
+            return torch.zeros(n, n, dtype=torch.long)
+        return accum._cfsn[:-1].view(n, n)
+
+    def summary(accum, reset=False):
+        """
+        Computes the metrics of the accumulated matrix. In a distributed run
+        the matrices of all processes are summed first.
+
+        Args:
+            reset (bool): start a new accumulation afterwards
+
+        Returns:
+            Dict: miou, pixel_acc, and class_acc (the mean over predicted
+                classes of the fraction predicted correctly)
+        """
+        cfsn = accum.cfsn
+        if xpu_device.is_distributed():
+            cfsn = cfsn.clone()
+            torch.distributed.all_reduce(cfsn)
+        cfsn = cfsn.cpu().numpy()
+        if reset:
+            accum.reset()
+
+        keep = [i for i in range(accum.n_classes) if i != accum.ignore_label]
+        cfsn = cfsn[keep][:, keep]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            ious = jaccard_score_from_confusion(cfsn)
+            total = cfsn.sum()
+            pixel_accuracy = cfsn.trace() / total if total else 0.0
+            # `_sseg_metrics` built its matrix as confusion_matrix(y_pred,
+            # y_true), with predictions on the rows. Transpose so class_acc
+            # keeps that meaning (per predicted class) and stays comparable.
+            perclass_acc = np.nan_to_num(perclass_accuracy_from_confusion(cfsn.T))
+
+        metrics_dict = ub.odict()
+        metrics_dict['miou'] = float(ious.mean())
+        metrics_dict['pixel_acc'] = float(pixel_accuracy)
+        metrics_dict['class_acc'] = float(perclass_acc.mean())
+        return metrics_dict
+
+
 def _siamese_metrics(output, label, margin=1):
     """
 
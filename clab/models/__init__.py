@@ -4,21 +4,48 @@ python -c "import ubelt._internal as a; a.autogen_init('clab.models')"
 """
 # flake8: noqa
 from __future__ import absolute_import, division, print_function, unicode_literals
-from clab.models import unet_aux
-from clab.models import unet
-from clab.models import siamese
-from clab.models import mnist_net
-from clab.models import fcn
-from clab.models import sseg_dummy
-from clab.models import segnet
-from clab.models import pspnet
-from clab.models import linknet
-from clab.models.unet_aux import (InputAux2,)
-from clab.models.unet import (UNet,)
-from clab.models.siamese import (SiameseLP, SiameseCLF,)
-from clab.models.mnist_net import (MnistNet,)
-from clab.models.fcn import (FCN32, FCN16, FNC8,)
-from clab.models.sseg_dummy import (SSegDummy,)
-from clab.models.segnet import (SegNet,)
-from clab.models.pspnet import (PSPNet,)
-from clab.models.linknet import (LinkNet,)
\ No newline at end of file
+from clab.util.lazy_loader import lazy_import
+
+# Models are imported on first use (see clab.util.lazy_loader)
+submodules = [
+    'unet_aux',
+    'unet',
+    'siamese',
+    'mnist_net',
+    'fcn',
+    'sseg_dummy',
+    'segnet',
+    'pspnet',
+    'linknet',
+]
+submod_attrs = {
+    'unet_aux': [
+        'InputAux2',
+    ],
+    'unet': [
+        'UNet',
+    ],
+    'siamese': [
+        'SiameseLP', 'SiameseCLF',
+    ],
+    'mnist_net': [
+        'MnistNet',
+    ],
+    'fcn': [
+        'FCN32', 'FCN16', 'FNC8',
+    ],
+    'sseg_dummy': [
+        'SSegDummy',
+    ],
+    'segnet': [
+        'SegNet',
+    ],
+    'pspnet': [
+        'PSPNet',
+    ],
+    'linknet': [
+        'LinkNet',
+    ],
+}
+__getattr__, __dir__, __all__ = lazy_import(__name__, submodules, submod_attrs)
+del lazy_import, submodules, submod_attrs
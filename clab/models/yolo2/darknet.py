@@ -17,6 +17,7 @@ import torch.nn.functional as F
 
 from .layers.reorg.reorg_layer import ReorgLayer
 from .utils import yolo_utils
+from .utils.batched_nms import batched_nms
 
 
 class Conv2d_Noli(nn.Module):
@@ -356,89 +357,74 @@ class Darknet19(nn.Module):
         out_size = np.array(inp_size) // 32  # hacked we know the factor is 32
         W, H = out_size
 
-        out_boxes = []
-        out_scores = []
-        out_cxs = []
-
-        # For each image in the batch, postprocess the predicted boxes
-        for bx in range(aoff_pred.shape[0]):
-            aoffs = aoff_pred[bx][None, :]
-            ious  = iou_pred[bx]
-            probs = prob_pred[bx]
-            orig_w, orig_h = orig_sizes[bx]
-
-            # Convert anchored predictions to absolute tlbr bounding boxes in
-            # normalized space
-            aoffs = np.ascontiguousarray(aoffs, dtype=np.float)
-            norm_boxes = yolo_utils.yolo_to_bbox(aoffs, anchors, H, W)[0]
-
-            # Scale the bounding boxes to the size of the original image.
-            # and convert to integer representation.
-            boxes = norm_boxes.copy()
-            boxes[..., 0::2] *= float(orig_w)
-            boxes[..., 1::2] *= float(orig_h)
-            boxes = boxes.astype(np.int)
-
-            # converts [1, W * H, A, 4] -> [W * H * A, 4]
-            boxes = np.reshape(boxes, [-1, 4])
-            ious = np.reshape(ious, [-1])
-            probs = np.reshape(probs, [-1, num_classes])
-
-            # Predict the class with maximum probability
-            cls_inds = np.argmax(probs, axis=1)
-            cls_probs = probs[(np.arange(probs.shape[0]), cls_inds)]
-
-            """
-            Reference: arXiv:1506.02640 [cs.CV] (Yolo 1):
-                Formally we define confidence as $Pr(Object) ∗ IOU^truth_pred$.
-                If no object exists in that cell, the confidence scores should
-                be zero. Otherwise we want the confidence score to equal the
-                intersection over union (IOU) between the predicted box and the
-                ground truth
-            """
-            # Compute the final probabilities for the predicted class
-            scores = ious * cls_probs
-
-            # filter boxes based on confidence threshold
-            keep_conf = np.where(scores >= conf_thresh)
-            boxes = boxes[keep_conf]
-            scores = scores[keep_conf]
-            cls_inds = cls_inds[keep_conf]
-
-            # nonmax supression (per-class)
-            keep_flags = np.zeros(len(boxes), dtype=np.uint8)
-            cx_to_inds = ub.group_items(range(len(cls_inds)), cls_inds)
-            cx_to_inds = ub.map_vals(np.array, cx_to_inds)
-            for cx, inds in cx_to_inds.items():
-                # get predictions for each class
-                c_bboxes = boxes[inds]
-                c_scores = scores[inds]
-                c_keep = yolo_utils.nms_detections(c_bboxes, c_scores,
-                                                   nms_thresh)
-                keep_flags[inds[c_keep]] = 1
-
-            keep_nms = np.where(keep_flags > 0)
-            boxes = boxes[keep_nms]
-            scores = scores[keep_nms]
-            cls_inds = cls_inds[keep_nms]
-
-            # clip
-            boxes = yolo_utils.clip_boxes(boxes, im_shape=(orig_h, orig_w))
-
-            # sort boxes by descending score
-            sortx = scores.argsort()[::-1]
-            boxes = boxes[sortx]
-            scores = scores[sortx]
-            cls_inds = cls_inds[sortx]
-
-            if max_per_image > 0 and len(boxes) > max_per_image:
-                boxes = boxes[:max_per_image]
-                scores = scores[:max_per_image]
-                cls_inds = cls_inds[:max_per_image]
-
-            out_boxes.append(boxes)
-            out_scores.append(scores)
-            out_cxs.append(cls_inds)
+        bsize = aoff_pred.shape[0]
+
+        # Convert anchored predictions to absolute tlbr bounding boxes in
+        # normalized space
+        aoff_pred = np.ascontiguousarray(aoff_pred, dtype=np.float)
+        norm_boxes = yolo_utils.yolo_to_bbox(aoff_pred, anchors, H, W)
+
+        # Scale the bounding boxes to the size of the original image.
+        # and convert to integer representation.
+        orig_w = orig_sizes[:, 0].astype(np.float)[:, None, None]
+        orig_h = orig_sizes[:, 1].astype(np.float)[:, None, None]
+        boxes = norm_boxes.copy()
+        boxes[..., 0::2] *= orig_w[..., None]
+        boxes[..., 1::2] *= orig_h[..., None]
+        boxes = boxes.astype(np.int)
+
+        # converts [B, W * H, A, 4] -> [B * W * H * A, 4]
+        boxes = np.reshape(boxes, [-1, 4])
+        ious = np.reshape(iou_pred, [-1])
+        probs = np.reshape(prob_pred, [-1, num_classes])
+        batch_idxs = np.repeat(np.arange(bsize), len(boxes) // max(bsize, 1))
+
+        # Predict the class with maximum probability
+        cls_inds = np.argmax(probs, axis=1)
+        cls_probs = probs[(np.arange(probs.shape[0]), cls_inds)]
+
+        """
+        Reference: arXiv:1506.02640 [cs.CV] (Yolo 1):
+            Formally we define confidence as $Pr(Object) ∗ IOU^truth_pred$.
+            If no object exists in that cell, the confidence scores should
+            be zero. Otherwise we want the confidence score to equal the
+            intersection over union (IOU) between the predicted box and the
+            ground truth
+        """
+        # Compute the final probabilities for the predicted class
+        scores = ious * cls_probs
+
+        # filter boxes based on confidence threshold
+        keep_conf = np.where(scores >= conf_thresh)
+        boxes = boxes[keep_conf]
+        scores = scores[keep_conf]
+        cls_inds = cls_inds[keep_conf]
+        batch_idxs = batch_idxs[keep_conf]
+
+        # nonmax supression (per-image and per-class) for the whole batch at
+        # once. The kept indices are sorted by image and descending score and
+        # only the top max_per_image boxes of each image are kept.
+        keep_nms = batched_nms(boxes.astype(np.float32),
+                               scores.astype(np.float32), batch_idxs,
+                               cls_inds, nms_thresh,
+                               max_per_image=max_per_image or None, bias=1)
+        boxes = boxes[keep_nms]
+        scores = scores[keep_nms]
+        cls_inds = cls_inds[keep_nms]
+        batch_idxs = batch_idxs[keep_nms]
+
+        # clip each box to the bounds of its image
+        im_w = orig_sizes[batch_idxs, 0]
+        im_h = orig_sizes[batch_idxs, 1]
+        boxes[:, 0::2] = np.minimum(boxes[:, 0::2], (im_w - 1)[:, None])
+        boxes[:, 1::2] = np.minimum(boxes[:, 1::2], (im_h - 1)[:, None])
+        boxes = np.maximum(boxes, 0, out=boxes)
+
+        # split back into a list of results for each image
+        splits = np.cumsum(np.bincount(batch_idxs, minlength=bsize))[:-1]
+        out_boxes = np.split(boxes, splits)
+        out_scores = np.split(scores, splits)
+        out_cxs = np.split(cls_inds, splits)
 
         postout = (out_boxes, out_scores, out_cxs)
         return postout
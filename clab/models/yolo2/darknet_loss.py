@@ -93,10 +93,16 @@ class DarknetLoss(BaseLossWithCudaState):
         >>> epoch = 1
         >>> loss = criterion(aoff_pred, iou_pred, prob_pred, gt_boxes,
         >>>                  gt_classes, gt_weights, inp_size)
+        >>> # padded groundtruth (e.g. from padded_collate) is also accepted
+        >>> padded = pad_truth(gt_boxes, gt_classes, gt_weights)
+        >>> loss2 = criterion(aoff_pred, iou_pred, prob_pred, *padded,
+        >>>                   inp_size=inp_size)
+        >>> assert torch.allclose(loss, loss2)
     """
     def __init__(criterion, anchors, object_scale=5.0, noobject_scale=1.0,
                  class_scale=1.0, coord_scale=1.0, iou_thresh=0.6,
-                 reproduce_longcw=False, workers=None, denom='num_boxes'):
+                 reproduce_longcw=False, workers=None, denom='num_boxes',
+                 batched=True):
         # train
         super(DarknetLoss, criterion).__init__()
         criterion.bbox_loss = None
@@ -116,6 +122,10 @@ class DarknetLoss(BaseLossWithCudaState):
         criterion.mse = nn.MSELoss(size_average=False)
         criterion.denom = denom
 
+        # build targets for the whole batch with tensor ops on the device of
+        # the predictions (otherwise use the per-item numpy reference)
+        criterion.batched = batched
+
     def forward(criterion, aoff_pred, iou_pred, prob_pred,
                 gt_boxes=None, gt_classes=None, gt_weights=None,
                 inp_size=None, epoch=None):
@@ -124,37 +134,35 @@ class DarknetLoss(BaseLossWithCudaState):
             aoff_pred (torch.FloatTensor): anchor bounding box offsets
             iou_pred (torch.FloatTensor): objectness probability prediction
             prob_pred (torch.FloatTensor): conditional probability per class
-            gt_boxes (list): groundtruth bounding boxes
-            gt_classes (list): groundtruth class indexes
-            gt_weights (list): example weights
+            gt_boxes (list | Tensor): groundtruth bounding boxes. Either a
+                list of [N_i, 4] tensors or a padded [B, N, 4] tensor (as
+                produced by `clab.data.collate.padded_collate`).
+            gt_classes (list | Tensor): groundtruth class indexes. In the
+                padded format negative classes mark padding.
+            gt_weights (list | Tensor): example weights
             inp_size (tuple): WxH of image passed through the network
         """
         n_classes = prob_pred.shape[-1]
 
-        # Transform groundtruth into formats comparable to predictions
-        _tup = criterion._build_target(aoff_pred, iou_pred, gt_boxes,
-                                       gt_classes, gt_weights, inp_size,
-                                       n_classes, criterion.anchors, epoch)
-        _aoffs, _ious, _classes, _aoff_mask, _iou_mask, _class_mask = _tup
-
-        device = criterion.get_device()
-
-        # def logit(p):
-        #     import scipy.special
-        #     eps = np.finfo(np.float).eps
-        #     p = min(max(eps, p), 1 - eps)
-        #     scipy.special.logit(p)
-        #     # return -np.log((1 / p) - 1)
-        # logit(_aoffs[..., 0:2])
-
-        aoff_true = np_to_variable(_aoffs, device)
-        iou_true  = np_to_variable(_ious, device)
-        cls_onehot_true = np_to_variable(_classes, device)
-
-        aoff_mask = np_to_variable(_aoff_mask, device, dtype=torch.FloatTensor)
-        iou_mask = np_to_variable(_iou_mask, device, dtype=torch.FloatTensor)
-        class_mask = np_to_variable(_class_mask, device,
-                                    dtype=torch.FloatTensor)
+        if criterion.batched:
+            # Targets are built directly on the device of the predictions
+            gt_boxes, gt_classes, gt_weights = pad_truth(
+                gt_boxes, gt_classes, gt_weights, bsize=len(aoff_pred),
+                device=aoff_pred.device)
+            _tup = build_targets_batched(
+                aoff_pred, iou_pred, gt_boxes, gt_classes, gt_weights,
+                inp_size, n_classes, criterion.anchors, epoch=epoch,
+                **criterion._losskw())
+            aoff_true, iou_true, cls_onehot_true = _tup[0:3]
+            aoff_mask, iou_mask, class_mask = _tup[3:6]
+            num_boxes = int((gt_classes >= 0).sum())
+        else:
+            _tup = criterion._build_target_variables(
+                aoff_pred, iou_pred, gt_boxes, gt_classes, gt_weights,
+                inp_size, n_classes, epoch)
+            aoff_true, iou_true, cls_onehot_true = _tup[0:3]
+            aoff_mask, iou_mask, class_mask = _tup[3:6]
+            num_boxes = sum(len(boxes) for boxes in gt_boxes)
 
         aoff_mask = aoff_mask.expand_as(aoff_true)
         class_mask = class_mask.expand_as(prob_pred)
@@ -173,7 +181,6 @@ class DarknetLoss(BaseLossWithCudaState):
         # Shouldn't we divide by number of predictions or nothing?
         # denom = num_boxes = sum(len(boxes) for boxes in gt_boxes)
         bsize, wh, A, _ = aoff_pred.shape
-        num_boxes = sum(len(boxes) for boxes in gt_boxes)
 
         if criterion.reproduce_longcw:
             criterion.bbox_loss = longcw_mse(aoff_mask, aoff_true, aoff_pred)
@@ -204,6 +211,48 @@ class DarknetLoss(BaseLossWithCudaState):
                       criterion.cls_loss)
         return total_loss
 
+    def _losskw(criterion):
+        return dict(object_scale=criterion.object_scale,
+                    noobject_scale=criterion.noobject_scale,
+                    class_scale=criterion.class_scale,
+                    coord_scale=criterion.coord_scale,
+                    iou_thresh=criterion.iou_thresh,
+                    reproduce_longcw=criterion.reproduce_longcw)
+
+    def _build_target_variables(criterion, aoff_pred, iou_pred, gt_boxes,
+                                gt_classes, gt_weights, inp_size, n_classes,
+                                epoch=None):
+        """
+        Runs the numpy reference target builder and moves the result back to
+        the device.
+        """
+        # Transform groundtruth into formats comparable to predictions
+        _tup = criterion._build_target(aoff_pred, iou_pred, gt_boxes,
+                                       gt_classes, gt_weights, inp_size,
+                                       n_classes, criterion.anchors, epoch)
+        _aoffs, _ious, _classes, _aoff_mask, _iou_mask, _class_mask = _tup
+
+        device = criterion.get_device()
+
+        # def logit(p):
+        #     import scipy.special
+        #     eps = np.finfo(np.float).eps
+        #     p = min(max(eps, p), 1 - eps)
+        #     scipy.special.logit(p)
+        #     # return -np.log((1 / p) - 1)
+        # logit(_aoffs[..., 0:2])
+
+        aoff_true = np_to_variable(_aoffs, device)
+        iou_true  = np_to_variable(_ious, device)
+        cls_onehot_true = np_to_variable(_classes, device)
+
+        aoff_mask = np_to_variable(_aoff_mask, device, dtype=torch.FloatTensor)
+        iou_mask = np_to_variable(_iou_mask, device, dtype=torch.FloatTensor)
+        class_mask = np_to_variable(_class_mask, device,
+                                    dtype=torch.FloatTensor)
+        return (aoff_true, iou_true, cls_onehot_true, aoff_mask, iou_mask,
+                class_mask)
+
     def _build_target(criterion, aoff_pred, iou_pred, gt_boxes, gt_classes,
                       gt_weights, inp_size, n_classes, anchors, epoch=None):
         """
@@ -227,12 +276,7 @@ class DarknetLoss(BaseLossWithCudaState):
             >>>                                gt_classes, gt_weights, inp_size,
             >>>                                n_classes, criterion.anchors)
         """
-        losskw = dict(object_scale=criterion.object_scale,
-                      noobject_scale=criterion.noobject_scale,
-                      class_scale=criterion.class_scale,
-                      coord_scale=criterion.coord_scale,
-                      iou_thresh=criterion.iou_thresh,
-                      reproduce_longcw=criterion.reproduce_longcw)
+        losskw = criterion._losskw()
 
         func = partial(build_target_item, inp_size=inp_size,
                        n_classes=n_classes, anchors=anchors, epoch=epoch,
@@ -512,6 +556,337 @@ def build_target_item(data1, inp_size, n_classes, anchors, object_scale=5.0,
     return _aoffs, _ious, _classes, _aoff_mask, _iou_mask, _class_mask
 
 
+def pad_truth(gt_boxes, gt_classes, gt_weights, bsize=None, device=None):
+    """
+    Puts groundtruth into the padded format used by `build_targets_batched`.
+
+    Args:
+        gt_boxes (list | Tensor): list of [N_i, 4] tlbr boxes per item or an
+            already padded [B, N, 4] tensor.
+        gt_classes (list | Tensor): class index per box. Padding is marked
+            with a negative class.
+        gt_weights (list | Tensor): weight per box
+        bsize (int): batch size. Only needed when the padded tensors are
+            empty (`padded_collate` returns an empty tensor in that case).
+        device (torch.device): device to put the result on
+
+    Returns:
+        tuple: padded boxes [B, N, 4], classes [B, N], and weights [B, N]
+
+    Example:
+        >>> from clab.models.yolo2.darknet_loss import *
+        >>> gt_boxes = [torch.rand(2, 4), torch.rand(0, 4), torch.rand(3, 4)]
+        >>> gt_classes = [torch.LongTensor([0, 1]), torch.LongTensor([]),
+        >>>               torch.LongTensor([2, 2, 0])]
+        >>> gt_weights = [torch.ones(2), torch.ones(0), torch.ones(3)]
+        >>> boxes, classes, weights = pad_truth(gt_boxes, gt_classes, gt_weights)
+        >>> print(classes.tolist())
+        [[0, 1, -1], [-1, -1, -1], [2, 2, 0]]
+        >>> assert torch.all(boxes[2] == gt_boxes[2])
+        >>> boxes, classes, weights = pad_truth(boxes, classes, weights)
+        >>> assert boxes.shape == (3, 3, 4)
+    """
+    if torch.is_tensor(gt_boxes):
+        # Already padded
+        if bsize is None or gt_boxes.numel():
+            bsize = len(gt_boxes)
+        boxes = gt_boxes.reshape(bsize, -1, 4).float()
+        classes = gt_classes.reshape(bsize, -1).long()
+        weights = gt_weights.reshape(bsize, -1).float()
+    else:
+        if device is None and len(gt_boxes) and torch.is_tensor(gt_boxes[0]):
+            device = gt_boxes[0].device
+        bsize = len(gt_boxes)
+        lens = [len(item) for item in gt_boxes]
+        n_max = max(lens + [0])
+        # Concatenate everything so the scatter into the padded arrays (and
+        # the transfer to the device) happens only once.
+        flat_boxes = torch.cat([torch.as_tensor(item).float().reshape(-1, 4)
+                                for item in gt_boxes] + [torch.empty(0, 4)])
+        flat_classes = torch.cat([torch.as_tensor(item).long().reshape(-1)
+                                  for item in gt_classes] +
+                                 [torch.empty(0).long()])
+        flat_weights = torch.cat([torch.as_tensor(item).float().reshape(-1)
+                                  for item in gt_weights] + [torch.empty(0)])
+        bxs = torch.cat([torch.full((n,), bx, dtype=torch.long)
+                         for bx, n in enumerate(lens)] +
+                        [torch.empty(0).long()])
+        gxs = torch.cat([torch.arange(n) for n in lens] +
+                        [torch.empty(0).long()])
+
+        boxes = torch.full((bsize, n_max, 4), -1.0)
+        classes = torch.full((bsize, n_max), -1, dtype=torch.long)
+        weights = torch.zeros((bsize, n_max))
+        boxes[bxs, gxs] = flat_boxes.cpu()
+        classes[bxs, gxs] = flat_classes.cpu()
+        weights[bxs, gxs] = flat_weights.cpu()
+
+    if device is not None:
+        boxes = boxes.to(device)
+        classes = classes.to(device)
+        weights = weights.to(device)
+    return boxes, classes, weights
+
+
+def build_targets_batched(aoff_pred, iou_pred, gt_boxes, gt_classes,
+                          gt_weights, inp_size, n_classes, anchors,
+                          object_scale=5.0, noobject_scale=1.0,
+                          class_scale=1.0, coord_scale=1.0, iou_thresh=0.6,
+                          reproduce_longcw=False, epoch=None):
+    """
+    Batched tensor version of `build_target_item`.
+
+    Computes the YOLO loss targets for every item in the batch at once using
+    tensor ops on the device of `aoff_pred`, so nothing is round-tripped
+    through numpy.
+
+    Args:
+        aoff_pred (Tensor): [B, H x W, A, 4] predicted anchor offsets
+        iou_pred (Tensor): [B, H x W, A, 1] predicted objectness
+        gt_boxes (Tensor): [B, N, 4] padded tlbr boxes in input coordinates
+        gt_classes (Tensor): [B, N] padded classes (negative means padding)
+        gt_weights (Tensor): [B, N] padded weights
+        inp_size (tuple): WxH of image passed through the network
+        n_classes (int): number of classes
+        anchors (ndarray): [A, 2] anchor sizes in output coordinates
+
+    Returns:
+        tuple: _aoffs, _ious, _classes, _aoff_mask, _iou_mask, _class_mask
+            with the same meaning as in `build_target_item`, but with a
+            leading batch dimension.
+
+    Notes:
+        To agree with the reference, items without any groundtruth do not
+        get the no-object penalty (all of their masks are zero).
+
+    Example:
+        >>> from clab.models.yolo2.darknet_loss import *
+        >>> from clab.models.yolo2.utils import yolo_utils
+        >>> inp_size = (96, 96)
+        >>> n_classes, A, H, W = 3, 5, 3, 3
+        >>> rng = np.random.RandomState(0)
+        >>> anchors = np.abs(rng.randn(A, 2) * [W, H])
+        >>> ntrues = [1, 4, 2, 7]
+        >>> gt_boxes = [yolo_utils.random_boxes(n, 'tlbr', scale=48.).reshape(-1, 4)
+        >>>             for n in ntrues]
+        >>> gt_classes = [torch.LongTensor(rng.randint(0, n_classes, n)) for n in ntrues]
+        >>> gt_weights = [torch.FloatTensor(rng.rand(n)) for n in ntrues]
+        >>> aoff_pred, iou_pred = darknet.demo_predictions(len(ntrues), W, H, A)
+        >>> padded = pad_truth(gt_boxes, gt_classes, gt_weights)
+        >>> _tup = build_targets_batched(aoff_pred, iou_pred, *padded,
+        >>>                              inp_size=inp_size, n_classes=n_classes,
+        >>>                              anchors=anchors, epoch=1)
+        >>> # The result agrees with the per-item numpy reference
+        >>> for bx in range(len(ntrues)):
+        >>>     data = (aoff_pred[bx].numpy(), iou_pred[bx].numpy(),
+        >>>             gt_boxes[bx].numpy(), gt_classes[bx].numpy(),
+        >>>             gt_weights[bx].numpy())
+        >>>     ref = build_target_item(data, inp_size, n_classes, anchors,
+        >>>                             epoch=1)
+        >>>     for got, want in zip(_tup, ref):
+        >>>         assert np.allclose(got[bx].numpy(), want, atol=1e-5)
+
+    Example:
+        >>> # Items without groundtruth do not contribute to the loss
+        >>> from clab.models.yolo2.darknet_loss import *
+        >>> aoff_pred, iou_pred = darknet.demo_predictions(2, 3, 3, 5)
+        >>> padded = pad_truth(torch.empty(0), torch.empty(0), torch.empty(0),
+        >>>                    bsize=2)
+        >>> anchors = np.ones((5, 2))
+        >>> _tup = build_targets_batched(aoff_pred, iou_pred, *padded,
+        >>>                              inp_size=(96, 96), n_classes=3,
+        >>>                              anchors=anchors)
+        >>> _aoffs, _ious, _classes, _aoff_mask, _iou_mask, _class_mask = _tup
+        >>> assert _iou_mask.sum() == 0 and _class_mask.sum() == 0
+    """
+    with torch.no_grad():
+        aoff_pred = aoff_pred.detach().float()
+        iou_pred = iou_pred.detach().float()
+        device = aoff_pred.device
+        bsize, n_cells, n_anchors, _ = aoff_pred.shape
+
+        # Output size of the grid (which is a factor of 32 less than inp_size)
+        out_size = [s // 32 for s in inp_size]
+        in_w, in_h = map(float, inp_size)
+        out_w, out_h = map(float, out_size)
+
+        anchors = torch.as_tensor(np.asarray(anchors, dtype=np.float32),
+                                  device=device)
+        gt_boxes = gt_boxes.to(device).float().reshape(bsize, -1, 4)
+        gt_classes = gt_classes.to(device).long().reshape(bsize, -1)
+        gt_weights = gt_weights.to(device).float().reshape(bsize, -1)
+        is_real = gt_classes >= 0
+
+        # APPLY OFFSETS TO EACH ANCHOR BOX (in absolute input space)
+        bbox_abs_pred = _batch_yolo_to_bbox(aoff_pred, anchors, out_w, out_h)
+        bbox_abs_pred[..., 0::2] *= in_w
+        bbox_abs_pred[..., 1::2] *= in_h
+
+        # FIND IOU BETWEEN ALL PAIRS OF (PRED x TRUE) BOXES
+        # ious is [B, n_cells * n_anchors, N]
+        ious = _batch_bbox_ious(bbox_abs_pred.view(bsize, -1, 4), gt_boxes)
+        ious = ious * is_real[:, None, :].float()
+        if ious.shape[2] > 0:
+            best_ious = ious.max(dim=2)[0]
+        else:
+            best_ious = ious.new_zeros(ious.shape[0:2])
+        best_ious = best_ious.view(bsize, n_cells, n_anchors, 1)
+
+        # ASSIGN EACH TRUE BOX TO A GRID CELL AND ANCHOR BOX
+        gt_aoff, gt_anchor_inds, gt_cell_inds = _batch_bbox_to_yolo(
+            gt_boxes, anchors, inp_size, out_size)
+
+        # POPULATE OUTPUT
+        _classes = aoff_pred.new_zeros((bsize, n_cells, n_anchors, n_classes))
+        _class_mask = aoff_pred.new_zeros((bsize, n_cells, n_anchors, 1))
+        _ious = aoff_pred.new_zeros((bsize, n_cells, n_anchors, 1))
+        _aoffs = aoff_pred.new_empty((bsize, n_cells, n_anchors, 4))
+        _aoff_mask = aoff_pred.new_zeros((bsize, n_cells, n_anchors, 1))
+
+        if reproduce_longcw or (epoch is not None and epoch <= 60):
+            # HACK: While the network is warming up we encourage it to
+            # predict the exact anchor boxes
+            _aoff_mask += 0.01
+
+        _aoffs[..., 0:2] = 0.5  # cell center in relative output coordinates
+        _aoffs[..., 2:4] = 1.0  # size of one cell in relative output coords
+
+        # HANDLE NO-OBJECT CASES
+        # (the reference leaves the masks of items without truth untouched)
+        has_truth = is_real.any(dim=1).view(bsize, 1, 1, 1)
+        noobj_flags = ((best_ious <= iou_thresh) & has_truth).float()
+        if reproduce_longcw:
+            _iou_mask = noobj_flags * (noobject_scale * (0 - iou_pred))
+        else:
+            _iou_mask = noobj_flags * noobject_scale
+
+        # HANDLE ASSIGNED OBJECT CASES
+        # Ignore groundtruth outside of image bounds
+        flags = is_real & (gt_cell_inds >= 0) & (gt_cell_inds < n_cells)
+        bxs, gxs = flags.nonzero(as_tuple=True)
+        cell_inds = gt_cell_inds[bxs, gxs]
+        axs = gt_anchor_inds[bxs, gxs]
+        pred_inds = cell_inds * n_anchors + axs
+        slots = bxs * (n_cells * n_anchors) + pred_inds
+
+        # Like the sequential reference, when several groundtruth boxes are
+        # assigned to the same anchor the last one wins. (nonzero returns them
+        # in order, so the winner has the largest position in each slot.)
+        order = torch.arange(len(slots), device=device)
+        last = torch.full((bsize * n_cells * n_anchors,), -1,
+                          dtype=torch.long, device=device)
+        last = last.scatter_reduce(0, slots, order, reduce='amax')
+        is_winner = last[slots] == order
+        w_bxs, w_gxs = bxs[is_winner], gxs[is_winner]
+        w_slots = slots[is_winner]
+        w_weight = gt_weights[w_bxs, w_gxs]
+
+        # RESCORE: the target objectness is the iou with the assigned truth
+        _ious.view(-1)[w_slots] = ious[w_bxs, pred_inds[is_winner], w_gxs]
+        if reproduce_longcw:
+            iou_penalty = 1 - iou_pred.reshape(-1)[w_slots]
+            _iou_mask.view(-1)[w_slots] = object_scale * iou_penalty * w_weight
+        else:
+            _iou_mask.view(-1)[w_slots] = object_scale * w_weight
+
+        _aoffs.view(-1, 4)[w_slots] = gt_aoff[w_bxs, w_gxs]
+        _aoff_mask.view(-1)[w_slots] = coord_scale * w_weight
+        _class_mask.view(-1)[w_slots] = class_scale * w_weight
+
+        # Every assigned class is marked (even if the box lost its anchor)
+        _classes.view(-1, n_classes)[slots, gt_classes[bxs, gxs]] = 1.
+
+    return _aoffs, _ious, _classes, _aoff_mask, _iou_mask, _class_mask
+
+
+def _batch_yolo_to_bbox(aoff_pred, anchors, out_w, out_h):
+    """
+    Tensor version of `yolo_utils.yolo_to_bbox`. Returns [B, H x W, A, 4]
+    tlbr boxes in normalized coordinates.
+    """
+    n_cells = aoff_pred.shape[1]
+    out_w = int(out_w)
+    cell_inds = torch.arange(n_cells, device=aoff_pred.device)
+    rows = (cell_inds // out_w).to(aoff_pred.dtype)[None, :, None]
+    cols = (cell_inds % out_w).to(aoff_pred.dtype)[None, :, None]
+
+    cx = (aoff_pred[..., 0] + cols) / out_w
+    cy = (aoff_pred[..., 1] + rows) / out_h
+    half_bw = aoff_pred[..., 2] * anchors[:, 0] / out_w * 0.5
+    half_bh = aoff_pred[..., 3] * anchors[:, 1] / out_h * 0.5
+    return torch.stack([cx - half_bw, cy - half_bh,
+                        cx + half_bw, cy + half_bh], dim=-1)
+
+
+def _batch_bbox_ious(boxes, query_boxes):
+    """
+    Tensor version of `yolo_utils.bbox_ious` (with the same +1 pixel
+    convention) computed for every item in a batch.
+
+    Args:
+        boxes (Tensor): [B, N, 4]
+        query_boxes (Tensor): [B, K, 4]
+
+    Returns:
+        Tensor: [B, N, K] ious
+    """
+    b = boxes[:, :, None, :]
+    q = query_boxes[:, None, :, :]
+    iw = (torch.min(b[..., 2], q[..., 2]) -
+          torch.max(b[..., 0], q[..., 0]) + 1).clamp(min=0)
+    ih = (torch.min(b[..., 3], q[..., 3]) -
+          torch.max(b[..., 1], q[..., 1]) + 1).clamp(min=0)
+    inter_area = iw * ih
+    box_area = (b[..., 2] - b[..., 0] + 1) * (b[..., 3] - b[..., 1] + 1)
+    qbox_area = (q[..., 2] - q[..., 0] + 1) * (q[..., 3] - q[..., 1] + 1)
+    return inter_area / (qbox_area + box_area - inter_area)
+
+
+def _batch_bbox_to_yolo(gt_boxes, anchors, inp_size, out_size):
+    """
+    Tensor version of `_bbox_to_yolo_flat` for padded [B, N, 4] groundtruth.
+
+    Returns:
+        tuple: gt_aoff [B, N, 4], gt_anchor_inds [B, N], gt_cell_inds [B, N]
+    """
+    in_w, in_h = map(float, inp_size)
+    out_w, out_h = map(float, out_size)
+    cell_w = in_w / out_w
+    cell_h = in_h / out_h
+    sf_x, sf_y = (out_w / in_w), (out_h / in_h)
+
+    x1, y1 = gt_boxes[..., 0], gt_boxes[..., 1]
+    x2, y2 = gt_boxes[..., 2], gt_boxes[..., 3]
+    cx = (x1 + x2) * 0.5 / cell_w
+    cy = (y1 + y2) * 0.5 / cell_h
+
+    gt_width_out = (x2 - x1) * sf_x
+    gt_height_out = (y2 - y1) * sf_y
+
+    # Same as yolo_utils.anchor_intersections on the boxes in output coords
+    boxw = (x2 * sf_x - x1 * sf_x + 1)[..., None]
+    boxh = (y2 * sf_y - y1 * sf_y + 1)[..., None]
+    iw = torch.min(anchors[:, 0], boxw)
+    ih = torch.min(anchors[:, 1], boxh)
+    inter_area = iw * ih
+    anchor_area = anchors[:, 0] * anchors[:, 1]
+    anchor_ious = inter_area / (anchor_area + boxw * boxh - inter_area)
+    gt_anchor_inds = anchor_ious.argmax(dim=-1)
+
+    floor_cx = torch.floor(cx)
+    floor_cy = torch.floor(cy)
+    gt_cell_inds = (floor_cy * out_w + floor_cx).long()
+
+    gt_anchors = anchors[gt_anchor_inds]
+    gt_aoff = torch.stack([
+        cx - floor_cx,
+        cy - floor_cy,
+        gt_width_out / gt_anchors[..., 0],
+        gt_height_out / gt_anchors[..., 1],
+    ], dim=-1)
+    return gt_aoff, gt_anchor_inds, gt_cell_inds
+
+
 def _pred_true_overlap(bbox_abs_pred, gt_boxes_np):
     """
     Find iou between all pairs of (pred x true) boxes
@@ -11,6 +11,7 @@ from clab.util import profiler
 import numpy as np
 import ubelt as ub
 from clab.models.yolo2.utils import yolo_utils
+from clab.models.yolo2.utils.batched_nms import batched_nms
 
 log = logging.getLogger(__name__)
 
@@ -22,6 +23,7 @@ class GetBoundingBoxes(object):
         network (lightnet.network.Darknet): Network the converter will be used with
         conf_thresh (Number [0-1]): Confidence threshold to filter detections
         nms_thresh(Number [0-1]): Overlapping threshold to filter detections with non-maxima suppresion
+        max_per_image (int): if specified, only keep this many of the highest scoring detections in each image
 
     Returns:
         (Batch x Boxes x 6 tensor): **[x_center, y_center, width, height, confidence, class_id]** for every bounding box
@@ -29,9 +31,11 @@ class GetBoundingBoxes(object):
     Note:
         The output tensor uses relative values for its coordinates.
     """
-    def __init__(self, network=None, conf_thresh=0.001, nms_thresh=0.4, anchors=None, num_classes=None):
+    def __init__(self, network=None, conf_thresh=0.001, nms_thresh=0.4, anchors=None, num_classes=None,
+                 max_per_image=None):
         self.conf_thresh = conf_thresh
         self.nms_thresh = nms_thresh
+        self.max_per_image = max_per_image
         if anchors is not None:
             self.num_classes = num_classes
             self.anchors = anchors['values']
@@ -44,10 +48,13 @@ class GetBoundingBoxes(object):
             self.anchor_step = len(self.anchors) // self.num_anchors
 
     @profiler.profile
-    def __call__(self, network_output, mode=1):
+    def __call__(self, network_output, mode=None):
         """ Compute bounding boxes after thresholding and nms
 
             network_output (torch.autograd.Variable): Output tensor from the lightnet network
+            mode (int): By default all images are thresholded and suppressed
+                at once (with class-aware nms). Otherwise selects one of the
+                older per-image implementations.
 
         Examples:
             >>> import torch
@@ -101,10 +108,50 @@ class GetBoundingBoxes(object):
             %timeit self(output.data, mode=1)
             %timeit self(output.data, mode=2)
         """
+        if mode is None:
+            return self._batched(network_output.data)
         boxes = self._get_boxes(network_output.data, mode=mode)
         boxes = [self._nms(box, mode=mode) for box in boxes]
         return boxes
 
+    @profiler.profile
+    def _batched(self, output):
+        """
+        Thresholds and suppresses the detections of all images at once.
+
+        Example:
+            >>> import torch
+            >>> torch.random.manual_seed(0)
+            >>> anchors = dict(num=5, values=[1.3221,1.73145,3.19275,4.00944,5.05587,
+            >>>                               8.09892,9.47112,4.84053,11.2364,10.0071])
+            >>> self = GetBoundingBoxes(anchors=anchors, num_classes=20, conf_thresh=.01, nms_thresh=0.5)
+            >>> output = torch.randn(8, 125, 9, 9)
+            >>> boxes = self._batched(output.clone())
+            >>> # same as suppressing each image and class separately
+            >>> for box, dets in zip(boxes, self._get_boxes(output.clone())):
+            >>>     a, b = dets[:, 0:2], dets[:, 2:4]
+            >>>     tlbr = torch.cat([a - b / 2, a + b / 2], 1)
+            >>>     keep = batched_nms(tlbr, dets[:, 4], None, dets[:, 5],
+            >>>                        self.nms_thresh, bias=0)
+            >>>     assert torch.all(box == dets[keep.sort()[0]])
+            >>> self.max_per_image = 3
+            >>> boxes = self._batched(output.clone())
+            >>> assert all(len(b) <= 3 for b in boxes)
+        """
+        dets, batch_idxs, batch = self._get_boxes_flat(output)
+
+        a = dets[:, 0:2]
+        b = dets[:, 2:4]
+        tlbr = torch.cat([a - b / 2, a + b / 2], 1)
+        keep = batched_nms(tlbr, dets[:, 4], batch_idxs, dets[:, 5].long(),
+                           self.nms_thresh, max_per_image=self.max_per_image,
+                           bias=0)
+        # Keep the original order of the detections within each image
+        keep = keep.sort()[0]
+        dets = dets[keep]
+        counts = torch.bincount(batch_idxs[keep], minlength=batch)
+        return list(torch.split(dets, counts.tolist()))
+
     @classmethod
     @profiler.profile
     def apply(cls, network_output, network, conf_thresh, nms_thresh):
@@ -133,26 +180,60 @@ class GetBoundingBoxes(object):
             %timeit self._get_boxes(output.data, mode=1)
         """
 
+        if mode == 0:
+            output_, cls_max, cls_max_idx = self._decode(output)
+            batch = output_.size(0)
+            output_ = output_.cpu()
+            cls_max = cls_max.cpu()
+            cls_max_idx = cls_max_idx.cpu()
+            boxes = []
+            for b in range(batch):
+                box_batch = []
+                for a in range(self.num_anchors):
+                    for i in range(output_.size(3)):
+                        if cls_max[b,a,i] > self.conf_thresh:
+                            box_batch.append([
+                                output_[b,a,0,i],
+                                output_[b,a,1,i],
+                                output_[b,a,2,i],
+                                output_[b,a,3,i],
+                                cls_max[b,a,i],
+                                cls_max_idx[b,a,i]
+                                ])
+                box_batch = torch.Tensor(box_batch)
+                boxes.append(box_batch)
+        elif mode == 1 or mode == 2:
+            filtered_dets, batch_idxs, batch = self._get_boxes_flat(output)
+            # split the filtered detections into one tensor per image
+            n_dets = torch.bincount(batch_idxs, minlength=batch)
+            boxes = list(torch.split(filtered_dets, n_dets.tolist()))
+
+        return boxes
+
+    def _decode(self, output):
+        """
+        Transforms the raw output (inplace) into boxes and class scores.
+
+        Returns:
+            tuple: output_ [B, A, 5 + C, H * W] where the first 5 channels are
+                (xc, yc, w, h, box_score), and the max class score and index
+                for each prediction [B, A, H * W].
+        """
         # Check dimensions
         if output.dim() == 3:
             output.unsqueeze_(0)
 
         # Variables
-        cuda = output.is_cuda
+        device = output.device
         batch = output.size(0)
         h = output.size(2)
         w = output.size(3)
 
         # Compute xc,yc, w,h, box_score on Tensor
-        lin_x = torch.linspace(0, w-1, w).repeat(h,1).view(h*w)
-        lin_y = torch.linspace(0, h-1, h).repeat(w,1).t().contiguous().view(h*w)
-        anchor_w = torch.Tensor(self.anchors[::2]).view(1, self.num_anchors, 1)
-        anchor_h = torch.Tensor(self.anchors[1::2]).view(1, self.num_anchors, 1)
-        if cuda:
-            lin_x = lin_x.cuda()
-            lin_y = lin_y.cuda()
-            anchor_w = anchor_w.cuda()
-            anchor_h = anchor_h.cuda()
+        lin_x = torch.linspace(0, w-1, w, device=device).repeat(h,1).view(h*w)
+        lin_y = torch.linspace(0, h-1, h, device=device).repeat(w,1).t().contiguous().view(h*w)
+        anchor_w = torch.Tensor(self.anchors[::2]).view(1, self.num_anchors, 1).to(device)
+        anchor_h = torch.Tensor(self.anchors[1::2]).view(1, self.num_anchors, 1).to(device)
 
         output_ = output.view(batch, self.num_anchors, -1, h*w)  # -1 == 5+num_classes (we can drop feature maps if 1 class)
         output_[:,:,0,:].sigmoid_().add_(lin_x).div_(w)          # X center
@@ -172,69 +253,54 @@ class GetBoundingBoxes(object):
         else:
             cls_max = output_[:,:,4,:]
             cls_max_idx = torch.zeros_like(cls_max)
+        return output_, cls_max, cls_max_idx
+
+    @profiler.profile
+    def _get_boxes_flat(self, output):
+        """
+        Returns the detections of all images that pass the confidence
+        threshold in a single flat tensor.
+
+        Returns:
+            tuple: (dets, batch_idxs, batch) where dets is a [N, 6] tensor of
+                [x_center, y_center, width, height, confidence, class_id],
+                batch_idxs is the [N] index of the image of each detection,
+                and batch is the number of images.
+
+        Example:
+            >>> import torch
+            >>> torch.random.manual_seed(0)
+            >>> anchors = dict(num=5, values=[1.3221,1.73145,3.19275,4.00944,5.05587,
+            >>>                               8.09892,9.47112,4.84053,11.2364,10.0071])
+            >>> self = GetBoundingBoxes(anchors=anchors, num_classes=20, conf_thresh=.14, nms_thresh=0.5)
+            >>> output = torch.randn(16, 125, 9, 9)
+            >>> dets, batch_idxs, batch = self._get_boxes_flat(output.clone())
+            >>> boxes = self._get_boxes(output.clone(), mode=0)
+            >>> assert torch.allclose(dets, torch.cat(boxes))
+        """
+        output_, cls_max, cls_max_idx = self._decode(output)
+        batch = output_.size(0)
 
         # Save detection if conf*class_conf is higher than threshold
+        flags = cls_max > self.conf_thresh
+        flat_flags = flags.view(-1)
 
-        if mode == 0:
-            output_ = output_.cpu()
-            cls_max = cls_max.cpu()
-            cls_max_idx = cls_max_idx.cpu()
-            boxes = []
-            for b in range(batch):
-                box_batch = []
-                for a in range(self.num_anchors):
-                    for i in range(h*w):
-                        if cls_max[b,a,i] > self.conf_thresh:
-                            box_batch.append([
-                                output_[b,a,0,i],
-                                output_[b,a,1,i],
-                                output_[b,a,2,i],
-                                output_[b,a,3,i],
-                                cls_max[b,a,i],
-                                cls_max_idx[b,a,i]
-                                ])
-                box_batch = torch.Tensor(box_batch)
-                boxes.append(box_batch)
-        elif mode == 1 or mode == 2:
-            # Save detection if conf*class_conf is higher than threshold
-            flags = cls_max > self.conf_thresh
-            flat_flags = flags.view(-1)
-
-            # number of potential detections per batch
-            item_size = np.prod(flags.shape[1:])
-            slices = [slice((item_size * i), (item_size * (i + 1))) for i in range(batch)]
-            # number of detections per batch (prepended with a zero)
-            n_dets = torch.stack([flat_flags[0].long() * 0] + [flat_flags[sl].long().sum() for sl in slices])
-            # indices of splits between filtered detections
-            filtered_split_idxs = torch.cumsum(n_dets, dim=0)
-
-            # Do actual filtering of detections by confidence thresh
-            flat_coords = output_.transpose(2, 3)[..., 0:4].clone().view(-1, 4)
-            flat_class_max = cls_max.view(-1)
-            flat_class_idx = cls_max_idx.view(-1)
-
-            coords = flat_coords[flat_flags]
-            scores = flat_class_max[flat_flags]
-            cls_idxs = flat_class_idx[flat_flags]
-
-            filtered_dets = torch.cat([coords, scores[:, None],
-                                       cls_idxs[:, None].float()], dim=1)
-
-            boxes2 = []
-            for lx, rx in zip(filtered_split_idxs, filtered_split_idxs[1:]):
-                batch_box = filtered_dets[lx:rx]
-                boxes2.append(batch_box)
-
-            if False:
-                boxes3 = [torch.Tensor(box) for box in boxes]
-                list(map(len, boxes2))
-                list(map(len, boxes3))
-                for b2, b3 in zip(boxes3, boxes2):
-                    assert np.all(b2.cpu() == b3.cpu())
-
-            boxes = boxes2
+        # Do actual filtering of detections by confidence thresh
+        flat_coords = output_.transpose(2, 3)[..., 0:4].contiguous().view(-1, 4)
+        flat_class_max = cls_max.view(-1)
+        flat_class_idx = cls_max_idx.view(-1)
 
-        return boxes
+        coords = flat_coords[flat_flags]
+        scores = flat_class_max[flat_flags]
+        cls_idxs = flat_class_idx[flat_flags]
+
+        filtered_dets = torch.cat([coords, scores[:, None],
+                                   cls_idxs[:, None].float()], dim=1)
+
+        # index of the image each detection belongs to
+        item_size = flat_flags.numel() // batch
+        batch_idxs = torch.nonzero(flat_flags).view(-1) // item_size
+        return filtered_dets, batch_idxs, batch
 
     @profiler.profile
     def _nms(self, boxes, mode=1):
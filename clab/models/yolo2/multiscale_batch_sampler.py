@@ -1,5 +1,6 @@
 import torch.utils.data.sampler as torch_sampler
 import torch
+import torch.nn.functional as F
 
 
 class MultiScaleBatchSampler(torch_sampler.BatchSampler):
@@ -7,6 +8,10 @@ class MultiScaleBatchSampler(torch_sampler.BatchSampler):
     Indicies returned in the batch are tuples indicating data index and scale
     index. Requires that dataset has a `multi_scale_inp_size` attribute.
 
+    When shuffling, a new random scale is chosen every `resample_frequency`
+    batches, so the scale changes on fixed batch boundaries (i.e. batches
+    `[0, f)` share a scale, then `[f, 2f)`, and so on).
+
     Example:
         >>> import torch.utils.data as torch_data
         >>> class DummyDatset(torch_data.Dataset):
@@ -26,6 +31,13 @@ class MultiScaleBatchSampler(torch_sampler.BatchSampler):
         >>> assert len(rand_idxs[-1]) == 2
         >>> assert {len({x[1] for x in xs}) for xs in rand_idxs} == {1}
         >>> assert {x[1] for xs in seq_idxs for x in xs} == {0}
+        >>> # scales only change every `resample_frequency` batches
+        >>> data_source.multi_scale_inp_size = list(range(100))
+        >>> rand = MultiScaleBatchSampler(data_source, shuffle=1, batch_size=1,
+        >>>                               resample_frequency=4)
+        >>> scales = [b[0][1] for b in rand]
+        >>> assert all(len(set(scales[i:i + 4])) == 1 for i in range(0, 34, 4))
+        >>> assert len(set(scales)) > 1
     """
 
     def __init__(self, data_source, shuffle=False, batch_size=16,
@@ -42,23 +54,67 @@ class MultiScaleBatchSampler(torch_sampler.BatchSampler):
 
     def __iter__(self):
         batch = []
-        if self.shuffle:
-            scale_index = int(torch.rand(1) * self.num_scales)
-        else:
-            scale_index = 0
-
+        bx = 0
+        scale_index = 0
         for idx in self.sampler:
+            if not batch and self.shuffle and bx % self.resample_frequency == 0:
+                # choose a new scale index at the start of every
+                # `resample_frequency`-th batch
+                scale_index = int(torch.rand(1) * self.num_scales)
             batch.append((int(idx), scale_index))
             if len(batch) == self.batch_size:
                 yield batch
-                if self.shuffle and idx % self.resample_frequency == 0:
-                    # choose a new scale index every 10 batches
-                    scale_index = int(torch.rand(1) * self.num_scales)
+                bx += 1
                 batch = []
         if len(batch) > 0 and not self.drop_last:
             yield batch
 
 
+def resize_batch(images, boxes, size, mode='bilinear'):
+    """
+    Resizes a batch of images and their boxes to a new size in a single
+    interpolate call on the device the batch is already on.
+
+    Args:
+        images (Tensor): [B, C, H, W] batch of images
+        boxes (list of Tensor): the [N_i, 4] tlbr boxes of each image (or a
+            single [B, N, 4] tensor)
+        size (tuple): new (width, height)
+        mode (str): interpolation mode
+
+    Returns:
+        Tuple[Tensor, list of Tensor]: resized images and boxes
+
+    Example:
+        >>> images = torch.rand(3, 3, 32, 48)
+        >>> boxes = [torch.FloatTensor([[0, 0, 48, 32], [12, 8, 24, 16]]),
+        >>>          torch.zeros(0, 4), torch.FloatTensor([[24, 16, 36, 24]])]
+        >>> images2, boxes2 = resize_batch(images, boxes, (24, 64))
+        >>> assert images2.shape == (3, 3, 64, 24)
+        >>> print(boxes2[0].tolist(), boxes2[1].shape, boxes2[2].tolist())
+        [[0.0, 0.0, 24.0, 64.0], [6.0, 16.0, 12.0, 32.0]] torch.Size([0, 4]) [[12.0, 32.0, 18.0, 48.0]]
+        >>> _, boxes3 = resize_batch(images, torch.stack([boxes[0], boxes[0]]), (24, 64))
+        >>> assert torch.all(boxes3[1] == boxes2[0])
+    """
+    w, h = int(size[0]), int(size[1])
+    in_h, in_w = images.shape[-2:]
+    if (in_w, in_h) == (w, h):
+        return images, boxes
+    kw = {} if mode == 'nearest' else {'align_corners': False}
+    images = F.interpolate(images, size=(h, w), mode=mode, **kw)
+    # Scale the boxes of all images at once
+    factor = [w / in_w, h / in_h] * 2
+    if torch.is_tensor(boxes):
+        # boxes were collated into a [B, N, 4] tensor
+        boxes = boxes * boxes.new_tensor(factor)
+    else:
+        lens = [len(b) for b in boxes]
+        flat = torch.cat([b.view(-1, 4) for b in boxes], dim=0)
+        flat = flat * flat.new_tensor(factor)
+        boxes = list(torch.split(flat, lens, dim=0))
+    return images, boxes
+
+
 if __name__ == '__main__':
     r"""
     CommandLine:
@@ -3,19 +3,62 @@
 #   Copyright EAVISE
 #
 
-import math
-import warnings
 import torch
 import torch.nn as nn
 import numpy as np
+import itertools as it
+import ubelt as ub
 from torch.autograd import Variable
-from lightnet.util import bbox_iou, bbox_multi_ious
 
 __all__ = ['RegionLoss']
 
 
+_EPS = float(np.finfo(np.float64).eps)
+
+
 def _safelog(x):
-    return math.log(max(x, np.finfo(np.float).eps))
+    return torch.log(x.clamp(min=_EPS))
+
+
+def _cxywh_ious(boxes, query_boxes):
+    """
+    IoU between all pairs of center-format boxes in each item of a batch
+
+    Args:
+        boxes (Tensor): [B, N, 4] boxes as (cx, cy, w, h)
+        query_boxes (Tensor): [B, K, 4] boxes as (cx, cy, w, h)
+
+    Returns:
+        Tensor: [B, N, K]
+
+    Example:
+        >>> boxes = torch.FloatTensor([[[1, 1, 2, 2], [3, 3, 2, 2]]])
+        >>> query_boxes = torch.FloatTensor([[[1, 1, 2, 2], [2, 1, 2, 2]]])
+        >>> print(_cxywh_ious(boxes, query_boxes).numpy().round(3))
+        [[[1.    0.333]
+          [0.    0.   ]]]
+    """
+    return _paired_cxywh_ious(boxes[:, :, None, :],
+                              query_boxes[:, None, :, :])
+
+
+def _paired_cxywh_ious(boxes1, boxes2):
+    """ Elementwise (broadcasting) IoU of center-format boxes """
+    # convert to tlbr before broadcasting to keep the big intermediates few
+    half1 = boxes1[..., 2:4] / 2
+    half2 = boxes2[..., 2:4] / 2
+    tl1, br1 = boxes1[..., 0:2] - half1, boxes1[..., 0:2] + half1
+    tl2, br2 = boxes2[..., 0:2] - half2, boxes2[..., 0:2] + half2
+    iw = (torch.min(br1[..., 0], br2[..., 0]) -
+          torch.max(tl1[..., 0], tl2[..., 0])).clamp(min=0)
+    ih = (torch.min(br1[..., 1], br2[..., 1]) -
+          torch.max(tl1[..., 1], tl2[..., 1])).clamp(min=0)
+    inter_area = iw * ih
+    area1 = boxes1[..., 2] * boxes1[..., 3]
+    area2 = boxes2[..., 2] * boxes2[..., 3]
+    union = area1 + area2 - inter_area
+    ious = inter_area / union.clamp(min=_EPS)
+    return torch.where(inter_area > 0, ious, torch.zeros_like(ious))
 
 
 class RegionLoss(torch.nn.modules.loss._Loss):
@@ -134,7 +177,7 @@ class RegionLoss(torch.nn.modules.loss._Loss):
         nC = self.num_classes
         nH = output.data.size(2)
         nW = output.data.size(3)
-        cuda = output.is_cuda
+        device = output.device
         if isinstance(target, Variable):
             target = target.data
 
@@ -147,45 +190,32 @@ class RegionLoss(torch.nn.modules.loss._Loss):
         if nC > 1:
             cls = output[:,:,5:].contiguous().view(nB*nA, nC, nH*nW).transpose(1,2).contiguous().view(-1, nC)
 
-        # Create prediction boxes
-        pred_boxes = torch.FloatTensor(nB*nA*nH*nW, 4)
-        lin_x = torch.linspace(0, nW-1, nW).repeat(nH,1).view(nH*nW)
-        lin_y = torch.linspace(0, nH-1, nH).repeat(nW,1).t().contiguous().view(nH*nW)
-        anchor_w = torch.Tensor(self.anchors[::self.anchor_step]).view(nA, 1)
-        anchor_h = torch.Tensor(self.anchors[1::self.anchor_step]).view(nA, 1)
-        if cuda:
-            pred_boxes = pred_boxes.cuda()
-            lin_x = lin_x.cuda()
-            lin_y = lin_y.cuda()
-            anchor_w = anchor_w.cuda()
-            anchor_h = anchor_h.cuda()
-
-        pred_boxes[:,0] = (coord[:,:,0].data + lin_x).view(-1)
-        pred_boxes[:,1] = (coord[:,:,1].data + lin_y).view(-1)
-        pred_boxes[:,2] = (coord[:,:,2].data.exp() * anchor_w).view(-1)
-        pred_boxes[:,3] = (coord[:,:,3].data.exp() * anchor_h).view(-1)
-        pred_boxes = pred_boxes.cpu()
-
-        # Create predicted confs
-        pred_confs = torch.FloatTensor(nB*nA*nH*nW)
-        pred_confs = conf.data.view(-1).cpu()
-
-        # Get target values
-        coord_mask,conf_mask,cls_mask,tcoord,tconf,tcls = self.build_targets(pred_boxes,pred_confs,target,nH,nW, seen=seen)
+        # Create prediction boxes (on the same device as the output)
+        lin_x = torch.linspace(0, nW-1, nW, device=device).repeat(nH,1).view(nH*nW)
+        lin_y = torch.linspace(0, nH-1, nH, device=device).repeat(nW,1).t().contiguous().view(nH*nW)
+        anchors = self._anchor_tensor(device)
+        anchor_w = anchors[:, 0].view(nA, 1)
+        anchor_h = anchors[:, 1].view(nA, 1)
+
+        with torch.no_grad():
+            coord_ = coord.detach().float()
+            pred_boxes = torch.stack([
+                (coord_[:,:,0] + lin_x).view(-1),
+                (coord_[:,:,1] + lin_y).view(-1),
+                (coord_[:,:,2].exp() * anchor_w).view(-1),
+                (coord_[:,:,3].exp() * anchor_h).view(-1),
+            ], dim=1)
+
+            # Create predicted confs
+            pred_confs = conf.detach().view(-1)
+
+            # Get target values
+            coord_mask,conf_mask,cls_mask,tcoord,tconf,tcls = self.build_targets(pred_boxes,pred_confs,target,nH,nW, seen=seen)
         coord_mask = coord_mask.expand_as(tcoord)
         if nC > 1:
             tcls = tcls.view(-1)[cls_mask.view(-1)].long()
             cls_mask = cls_mask.view(-1, 1).repeat(1, nC)
 
-        if cuda:
-            tcoord = tcoord.cuda()
-            tconf = tconf.cuda()
-            coord_mask = coord_mask.cuda()
-            conf_mask = conf_mask.cuda()
-            if nC > 1:
-                tcls = tcls.cuda()
-                cls_mask = cls_mask.cuda()
-
         tcoord = Variable(tcoord, requires_grad=False)
         tconf  = Variable(tconf, requires_grad=False)
         coord_mask = Variable(coord_mask, requires_grad=False)
@@ -208,199 +238,257 @@ class RegionLoss(torch.nn.modules.loss._Loss):
 
         return self.loss_tot
 
+    def _anchor_tensor(self, device):
+        """ [nA, anchor_step] tensor of anchors on a device """
+        anchors = torch.FloatTensor(self.anchors).view(self.num_anchors,
+                                                       self.anchor_step)
+        return anchors.to(device)
+
     def build_targets(self, pred_boxes, pred_confs, ground_truth, nH, nW, seen=0):
         """ Compare prediction boxes and targets, convert targets to network output tensors """
+        device = pred_boxes.device
         if torch.is_tensor(ground_truth):
-            return self.__build_targets_tensor(pred_boxes, pred_confs, ground_truth, nH, nW, seen=seen)
+            gt_cls, gt_boxes, gt_ignore = self._tensor_truth(
+                ground_truth, nH, nW, device)
         else:
-            return self.__build_targets_brambox(pred_boxes, pred_confs, ground_truth, nH, nW, seen=seen)
+            gt_cls, gt_boxes, gt_ignore = self._brambox_truth(
+                ground_truth, device)
+        return self._build_targets_batched(pred_boxes, gt_cls, gt_boxes,
+                                           gt_ignore, nH, nW, seen=seen)
 
-    def __build_targets_tensor(self, pred_boxes, pred_confs, ground_truth, nH, nW, seen=0):
-        """ Compare prediction boxes and ground truths, convert ground truths to network output tensors """
-        # Parameters
-        nB = ground_truth.size(0)
-        nT = ground_truth.size(1)
+    def _tensor_truth(self, ground_truth, nH, nW, device):
+        """
+        Converts a padded [B, T, 5] target tensor into output coordinates.
+        Like darknet, the boxes of an item stop at the first padded entry.
+        """
+        ground_truth = ground_truth.to(device).float()
+        gt_cls = ground_truth[..., 0]
+        is_real = torch.cumprod((gt_cls >= 0).long(), dim=1).bool()
+        gt_cls = torch.where(is_real, gt_cls, torch.full_like(gt_cls, -1))
+        scale = ground_truth.new_tensor([nW, nH, nW, nH])
+        gt_boxes = ground_truth[..., 1:5] * scale
+        gt_ignore = torch.zeros_like(is_real)
+        return gt_cls.long(), gt_boxes, gt_ignore
+
+    def _brambox_truth(self, ground_truth, device):
+        """
+        Converts lists of brambox annotations into padded tensors in output
+        coordinates (the only remaining python loop is over the annotation
+        objects themselves).
+        """
+        nB = len(ground_truth)
+        nT = max([len(annos) for annos in ground_truth] + [0])
+        gt_cls = torch.full((nB, nT), -1, dtype=torch.long)
+        gt_boxes = torch.zeros((nB, nT, 4))
+        gt_ignore = torch.zeros((nB, nT), dtype=torch.bool)
+        for b, annos in enumerate(ground_truth):
+            for t, anno in enumerate(annos):
+                gt_cls[b, t] = int(anno.class_id)
+                gt_boxes[b, t, 0] = anno.x_top_left + anno.width / 2
+                gt_boxes[b, t, 1] = anno.y_top_left + anno.height / 2
+                gt_boxes[b, t, 2] = anno.width
+                gt_boxes[b, t, 3] = anno.height
+                gt_ignore[b, t] = bool(anno.ignore)
+        gt_boxes /= self.reduction
+        return gt_cls.to(device), gt_boxes.to(device), gt_ignore.to(device)
+
+    def _build_targets_batched(self, pred_boxes, gt_cls, gt_boxes, gt_ignore,
+                               nH, nW, seen=0):
+        """
+        Compare prediction boxes and ground truths, convert ground truths to
+        network output tensors.
+
+        All items and boxes are handled at once with tensor ops on the device
+        of `pred_boxes`.
+
+        Args:
+            pred_boxes (Tensor): [B * A * H * W, 4] predicted boxes as
+                (cx, cy, w, h) in output coordinates
+            gt_cls (Tensor): [B, T] class of each true box (-1 for padding)
+            gt_boxes (Tensor): [B, T, 4] true boxes as (cx, cy, w, h) in
+                output coordinates
+            gt_ignore (Tensor): [B, T] flags boxes that should be ignored
+
+        Example:
+            >>> torch.random.manual_seed(0)
+            >>> anchors = {'num': 2, 'values': [1.0, 1.0, 2.5, 1.5]}
+            >>> self = RegionLoss(num_classes=3, anchors=anchors)
+            >>> nB, nH, nW = 2, 3, 3
+            >>> pred_boxes = torch.rand(nB * 2 * nH * nW, 4) * 3
+            >>> gt_cls = torch.LongTensor([[0, 2], [1, -1]])
+            >>> gt_boxes = torch.FloatTensor([[[1.5, 1.5, 1.0, 1.0],
+            >>>                                [0.5, 2.5, 2.0, 1.0]],
+            >>>                               [[2.2, 0.7, 0.5, 0.5],
+            >>>                                [0.0, 0.0, 0.0, 0.0]]])
+            >>> gt_ignore = torch.zeros(2, 2, dtype=torch.bool)
+            >>> _tup = self._build_targets_batched(pred_boxes, gt_cls, gt_boxes,
+            >>>                                    gt_ignore, nH, nW, seen=20000)
+            >>> coord_mask, conf_mask, cls_mask, tcoord, tconf, tcls = _tup
+            >>> print(cls_mask.nonzero().tolist())
+            [[0, 0, 4], [0, 1, 6], [1, 0, 2]]
+            >>> print(tcls[cls_mask].tolist())
+            [0.0, 2.0, 1.0]
+            >>> assert float(conf_mask[0, 0, 4]) == self.object_scale
+        """
+        device = pred_boxes.device
+        nB, nT = gt_cls.shape
         nA = self.num_anchors
-        nAnchors = nA*nH*nW
-        nPixels  = nH*nW
+        nPixels = nH*nW
+        nAnchors = nA*nPixels
 
         seen = seen + nB
 
         # Tensors
-        conf_mask  = torch.ones(nB, nA, nH*nW) * self.noobject_scale
-        coord_mask = torch.zeros(nB, nA, 1, nH*nW)
-        cls_mask   = torch.zeros(nB, nA, nH*nW).byte()
-        tcoord     = torch.zeros(nB, nA, 4, nH*nW)
-        tconf      = torch.zeros(nB, nA, nH*nW)
-        tcls       = torch.zeros(nB, nA, nH*nW)
+        conf_mask  = torch.full((nB, nA, nPixels), self.noobject_scale, device=device)
+        coord_mask = torch.zeros(nB, nA, 1, nPixels, device=device)
+        cls_mask   = torch.zeros(nB, nA, nPixels, dtype=torch.bool, device=device)
+        tcoord     = torch.zeros(nB, nA, 4, nPixels, device=device)
+        tconf      = torch.zeros(nB, nA, nPixels, device=device)
+        tcls       = torch.zeros(nB, nA, nPixels, device=device)
+
+        anchors = self._anchor_tensor(device)
 
         if seen < 12800:
             coord_mask.fill_(1)
             if self.anchor_step == 4:
-                tcoord[:,:,0] = torch.Tensor(self.anchors[2::self.anchor_step]).view(1,nA,1,1).repeat(nB,1,1,nH*nW)
-                tcoord[:,:,1] = torch.Tensor(self.anchors[3::self.anchor_step]).view(1,nA,1,1).repeat(nB,1,1,nH*nW)
+                tcoord[:,:,0] = anchors[:, 2].view(1, nA, 1)
+                tcoord[:,:,1] = anchors[:, 3].view(1, nA, 1)
             else:
                 tcoord[:,:,0].fill_(0.5)
                 tcoord[:,:,1].fill_(0.5)
 
+        is_real = gt_cls >= 0
+        if nT == 0 or not bool(is_real.any()):
+            return coord_mask, conf_mask, cls_mask, tcoord, tconf, tcls
+
         # Setting confidence mask
-        for b in range(nB):
-            cur_pred_boxes = pred_boxes[b*nAnchors:(b+1)*nAnchors]
-            cur_pred_confs = pred_confs[b*nAnchors:(b+1)*nAnchors]
-            cur_ious = torch.zeros(nAnchors)
-            for t in range(nT):
-                if ground_truth[b][t][0] < 0:
-                    break
-                gx = ground_truth[b][t][1] * nW
-                gy = ground_truth[b][t][2] * nH
-                gw = ground_truth[b][t][3] * nW
-                gh = ground_truth[b][t][4] * nH
-                cur_gt_boxes = torch.FloatTensor([gx,gy,gw,gh]).repeat(nAnchors,1)
-                cur_ious = torch.max(cur_ious, bbox_multi_ious(cur_pred_boxes, cur_gt_boxes))
-            conf_mask[b].view(-1)[cur_ious > self.thresh] = 0
-
-        # Loop over ground_truths and construct tensors
-        for b in range(nB):
-            for t in range(nT):
-                if ground_truth[b][t][0] < 0:
-                    break
-                best_iou = 0.0
-                best_n = -1
-                min_dist = 10000
-                gx = ground_truth[b][t][1] * nW
-                gy = ground_truth[b][t][2] * nH
-                gw = ground_truth[b][t][3] * nW
-                gh = ground_truth[b][t][4] * nH
-                gi = min(nW-1, max(0, int(gx)))
-                gj = min(nH-1, max(0, int(gy)))
-                gt_box = [0, 0, gw, gh]
-                for n in range(nA):
-                    aw = self.anchors[self.anchor_step*n]
-                    ah = self.anchors[self.anchor_step*n+1]
-                    anchor_box = [0, 0, aw, ah]
-                    iou  = bbox_iou(anchor_box, gt_box)
-                    if self.anchor_step == 4:
-                        ax = self.anchors[self.anchor_step*n+2]
-                        ay = self.anchors[self.anchor_step*n+3]
-                        dist = pow(((gi+ax) - gx), 2) + pow(((gj+ay) - gy), 2)
-                    if iou > best_iou:
-                        best_iou = iou
-                        best_n = n
-                    elif self.anchor_step==4 and iou == best_iou and dist < min_dist:
-                        best_iou = iou
-                        best_n = n
-                        min_dist = dist
-
-                gt_box = [gx, gy, gw, gh]
-                pred_box = pred_boxes[b*nAnchors+best_n*nPixels+gj*nW+gi]
-                pred_conf = pred_confs[b*nAnchors+best_n*nPixels+gj*nW+gi]
-                iou = bbox_iou(gt_box, pred_box)
-
-                coord_mask[b][best_n][0][gj*nW+gi] = 1
-                cls_mask[b][best_n][gj*nW+gi] = 1
-                conf_mask[b][best_n][gj*nW+gi] = self.object_scale
-                tcoord[b][best_n][0][gj*nW+gi] = gx - gi
-                tcoord[b][best_n][1][gj*nW+gi] = gy - gj
-
-                tcoord[b][best_n][2][gj*nW+gi] = _safelog(
-                    gw/self.anchors[self.anchor_step*best_n])
-                tcoord[b][best_n][3][gj*nW+gi] = _safelog(
-                    gh/self.anchors[self.anchor_step*best_n+1])
-                tconf[b][best_n][gj*nW+gi] = iou
-                tcls[b][best_n][gj*nW+gi] = ground_truth[b][t][0]
+        # One IoU computation between every prediction and every true box
+        pred_boxes = pred_boxes.view(nB, nAnchors, 4)
+        ious = _cxywh_ious(pred_boxes, gt_boxes)
+        ious = ious * is_real[:, None, :].float()
+        best_ious = ious.max(dim=2)[0]
+        conf_mask.view(nB, -1)[best_ious > self.thresh] = 0
+
+        # Find the best anchor for each true box
+        gx, gy, gw, gh = gt_boxes.unbind(dim=-1)
+        gi = gx.long().clamp(0, nW-1)
+        gj = gy.long().clamp(0, nH-1)
+        aw, ah = anchors[:, 0], anchors[:, 1]
+        inter_area = torch.min(aw, gw[..., None]) * torch.min(ah, gh[..., None])
+        union = aw * ah + (gw * gh)[..., None] - inter_area
+        anchor_ious = torch.where(inter_area > 0,
+                                  inter_area / union.clamp(min=_EPS),
+                                  torch.zeros_like(inter_area))
+
+        # Mirror the sequential search (including its tie breaking)
+        best_iou = torch.zeros_like(gw)
+        best_n = torch.full_like(gi, -1)
+        min_dist = torch.full_like(gw, 10000)
+        for n in range(nA):
+            iou = anchor_ious[..., n]
+            better = iou > best_iou
+            if self.anchor_step == 4:
+                dist = ((gi.float() + anchors[n, 2]) - gx) ** 2 + ((gj.float() + anchors[n, 3]) - gy) ** 2
+                tied = ~better & (iou == best_iou) & (dist < min_dist)
+                min_dist = torch.where(tied, dist, min_dist)
+                better = better | tied
+            best_iou = torch.where(better, iou, best_iou)
+            best_n = torch.where(better, torch.full_like(best_n, n), best_n)
+        # An unmatched box indexes the last anchor (as python's -1 would)
+        best_n = best_n % nA
+
+        # Gather the real boxes in the same order as the sequential loop
+        bs, ts = is_real.nonzero(as_tuple=True)
+        best_n = best_n[bs, ts]
+        cells = gj[bs, ts] * nW + gi[bs, ts]
+        pred_inds = best_n * nPixels + cells
+        slots = bs * nAnchors + pred_inds
+
+        # When several boxes are assigned to the same prediction the last one
+        # wins. Ignored boxes only overwrite the confidence mask.
+        order = torch.arange(len(slots), device=device)
+
+        def _last_writer(flags):
+            last = torch.full((nB * nAnchors,), -1, dtype=torch.long,
+                              device=device)
+            last = last.scatter_reduce(0, slots[flags], order[flags],
+                                       reduce='amax')
+            return flags & (last[slots] == order)
+
+        ignore = gt_ignore[bs, ts]
+        final = _last_writer(torch.ones_like(ignore))
+        conf_vals = torch.where(ignore, torch.zeros_like(gx[bs, ts]),
+                                torch.full_like(gx[bs, ts], self.object_scale))
+        conf_mask.view(-1)[slots[final]] = conf_vals[final]
+
+        keep = _last_writer(~ignore)
+        k_bs, k_ts, k_n = bs[keep], ts[keep], best_n[keep]
+        k_cells = cells[keep]
+        k_slots = slots[keep]
+        k_gt = gt_boxes[k_bs, k_ts]
+        k_pred = pred_boxes[k_bs, pred_inds[keep]]
+
+        coord_mask.view(-1)[k_slots] = 1
+        cls_mask.view(-1)[k_slots] = True
+        tcoord[k_bs, k_n, 0, k_cells] = k_gt[:, 0] - gi[k_bs, k_ts].float()
+        tcoord[k_bs, k_n, 1, k_cells] = k_gt[:, 1] - gj[k_bs, k_ts].float()
+        tcoord[k_bs, k_n, 2, k_cells] = _safelog(k_gt[:, 2] / aw[k_n])
+        tcoord[k_bs, k_n, 3, k_cells] = _safelog(k_gt[:, 3] / ah[k_n])
+        tconf.view(-1)[k_slots] = _paired_cxywh_ious(k_gt, k_pred)
+        tcls.view(-1)[k_slots] = gt_cls[k_bs, k_ts].float()
 
         return coord_mask, conf_mask, cls_mask, tcoord, tconf, tcls
 
-    def __build_targets_brambox(self, pred_boxes, pred_confs, ground_truth, nH, nW, seen=0):
-        """ Compare prediction boxes and ground truths, convert ground truths to network output tensors """
-        # Parameters
-        nB = len(ground_truth)
-        nA = self.num_anchors
-        nAnchors = nA*nH*nW
-        nPixels  = nH*nW
 
-        seen = seen + nB
+def benchmark_region_loss(batch_sizes=[1, 4, 16], num_trues=[1, 10, 50],
+                          num_classes=20, num_anchors=5, out_size=13,
+                          device=None, num=10):
+    """
+    Reports the latency of `RegionLoss.forward` versus batch size and the
+    number of groundtruth boxes per image.
 
-        # Tensors
-        conf_mask  = torch.ones(nB, nA, nH*nW) * self.noobject_scale
-        coord_mask = torch.zeros(nB, nA, 1, nH*nW)
-        cls_mask   = torch.zeros(nB, nA, nH*nW).byte()
-        tcoord     = torch.zeros(nB, nA, 4, nH*nW)
-        tconf      = torch.zeros(nB, nA, nH*nW)
-        tcls       = torch.zeros(nB, nA, nH*nW)
+    CommandLine:
+        python -m clab.models.yolo2.region_loss benchmark_region_loss
 
-        if seen < 12800:
-            coord_mask.fill_(1)
-            if self.anchor_step == 4:
-                tcoord[:,:,0] = torch.Tensor(self.anchors[2::self.anchor_step]).view(1,nA,1,1).repeat(nB,1,1,nH*nW)
-                tcoord[:,:,1] = torch.Tensor(self.anchors[3::self.anchor_step]).view(1,nA,1,1).repeat(nB,1,1,nH*nW)
-            else:
-                tcoord[:,:,0].fill_(0.5)
-                tcoord[:,:,1].fill_(0.5)
+    Example:
+        >>> # xdoc: +REQUIRES(--bench)
+        >>> benchmark_region_loss(batch_sizes=[1, 8, 32, 64],
+        >>>                       num_trues=[1, 10, 50, 100])
 
-        # Setting confidence mask
-        for b in range(nB):
-            cur_pred_boxes = pred_boxes[b*nAnchors:(b+1)*nAnchors]
-            cur_pred_confs = pred_confs[b*nAnchors:(b+1)*nAnchors]
-            cur_ious = torch.zeros(nAnchors)
-            for anno in ground_truth[b]:
-                gx = (anno.x_top_left + anno.width/2) / self.reduction
-                gy = (anno.y_top_left + anno.height/2) / self.reduction
-                gw = anno.width / self.reduction
-                gh = anno.height / self.reduction
-                cur_gt_boxes = torch.FloatTensor([gx,gy,gw,gh]).expand(nAnchors,-1)
-                cur_ious = torch.max(cur_ious, bbox_multi_ious(cur_pred_boxes, cur_gt_boxes))
-            conf_mask[b].view(-1)[cur_ious > self.thresh] = 0
-
-        # Loop over ground_truths and construct tensors
-        for b in range(nB):
-            for anno in ground_truth[b]:
-                best_iou = 0.0
-                best_n = -1
-                min_dist = 10000
-                gx = (anno.x_top_left + anno.width/2) / self.reduction
-                gy = (anno.y_top_left + anno.height/2) / self.reduction
-                gw = anno.width / self.reduction
-                gh = anno.height / self.reduction
-                gi = min(nW-1, max(0, int(gx)))
-                gj = min(nH-1, max(0, int(gy)))
-                gt_box = [0, 0, gw, gh]
-                for n in range(nA):
-                    aw = self.anchors[self.anchor_step*n]
-                    ah = self.anchors[self.anchor_step*n+1]
-                    anchor_box = [0, 0, aw, ah]
-                    iou  = bbox_iou(anchor_box, gt_box)
-                    if self.anchor_step == 4:
-                        ax = self.anchors[self.anchor_step*n+2]
-                        ay = self.anchors[self.anchor_step*n+3]
-                        dist = pow(((gi+ax) - gx), 2) + pow(((gj+ay) - gy), 2)
-                    if iou > best_iou:
-                        best_iou = iou
-                        best_n = n
-                    elif self.anchor_step==4 and iou == best_iou and dist < min_dist:
-                        best_iou = iou
-                        best_n = n
-                        min_dist = dist
-
-                gt_box = [gx, gy, gw, gh]
-                pred_box = pred_boxes[b*nAnchors+best_n*nPixels+gj*nW+gi]
-                pred_conf = pred_confs[b*nAnchors+best_n*nPixels+gj*nW+gi]
-                iou = bbox_iou(gt_box, pred_box)
-
-                if anno.ignore:
-                    conf_mask[b][best_n][gj*nW+gi] = 0
-                else:
-                    coord_mask[b][best_n][0][gj*nW+gi] = 1
-                    cls_mask[b][best_n][gj*nW+gi] = 1
-                    conf_mask[b][best_n][gj*nW+gi] = self.object_scale
-                    tcoord[b][best_n][0][gj*nW+gi] = gx - gi
-                    tcoord[b][best_n][1][gj*nW+gi] = gy - gj
-                    tcoord[b][best_n][2][gj*nW+gi] = math.log(gw/self.anchors[self.anchor_step*best_n])
-                    tcoord[b][best_n][3][gj*nW+gi] = math.log(gh/self.anchors[self.anchor_step*best_n+1])
-                    tconf[b][best_n][gj*nW+gi] = iou
-                    tcls[b][best_n][gj*nW+gi] = anno.class_id
+    Example:
+        >>> results = benchmark_region_loss([2], [3], num_classes=3, num=1)
+        >>> assert set(results.keys()) == {(2, 3)}
+    """
+    if device is None:
+        device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    rng = np.random.RandomState(0)
+    anchors = {'num': num_anchors,
+               'values': list((rng.rand(num_anchors * 2) * 4 + .5))}
+    self = RegionLoss(num_classes=num_classes, anchors=anchors)
+    nH = nW = out_size
+    n_channels = num_anchors * (5 + num_classes)
+
+    def _sync():
+        if torch.device(device).type == 'cuda':
+            torch.cuda.synchronize()
+
+    results = ub.odict()
+    for nB, nT in it.product(batch_sizes, num_trues):
+        output = torch.randn(nB, n_channels, nH, nW, device=device)
+        target = torch.FloatTensor(rng.rand(nB, nT, 5))
+        target[..., 0] = torch.LongTensor(rng.randint(0, num_classes, (nB, nT))).float()
+        target[..., 3:5] *= .5
+        target = target.to(device)
+        ti = ub.Timerit(num, bestof=3, verbose=0)
+        for timer in ti:
+            _sync()
+            with timer:
+                self(output, target, seen=20000)
+                _sync()
+        results[(nB, nT)] = ti.min()
+        print('B={:3d} T={:4d}: {:8.3f} ms'.format(nB, nT, ti.min() * 1000))
+    return results
 
-        return coord_mask, conf_mask, cls_mask, tcoord, tconf, tcls
 
 if __name__ == '__main__':
     """
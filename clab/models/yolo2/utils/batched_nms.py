@@ -0,0 +1,295 @@
+# -*- coding: utf-8 -*-
+"""
+Class-aware non-maximum suppression over all detections of a batch at once.
+
+Detections from every image are passed in a single flat array together with
+the index of the image and class they belong to. Boxes only suppress other
+boxes of the same (image, class) group, so the result is the same as running
+NMS separately for every image and class, but without a python loop over the
+groups.
+
+The default implementation sorts the boxes by group and score, enumerates the
+candidate pairs inside each group with tensor ops (so it also runs on the
+GPU), and resolves the greedy suppression order with a short fixed-point
+iteration. When the number of pairs is too large for memory it falls back to
+the compiled `cpu_nms` kernel (or to processing the groups in chunks if the
+kernel is not built or the boxes are on the GPU).
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+import numpy as np
+import torch
+
+try:
+    from .nms.cpu_nms import cpu_nms
+except ImportError:
+    cpu_nms = None
+
+__all__ = ['batched_nms']
+
+
+def batched_nms(boxes, scores, batch_idxs=None, class_idxs=None, thresh=0.5,
+                max_per_image=None, bias=1, impl='auto', max_pairs=2 ** 24):
+    """
+    Non-maximum suppression for detections of multiple images and classes.
+
+    A box is suppressed if its overlap with a higher scoring kept box of the
+    same image and class is at least `thresh` (the convention of `cpu_nms`).
+
+    Args:
+        boxes (Tensor | ndarray): [N, 4] boxes in tlbr format
+        scores (Tensor | ndarray): [N] score of each box
+        batch_idxs (Tensor | ndarray): [N] index of the image each box belongs
+            to. Defaults to all zeros.
+        class_idxs (Tensor | ndarray): [N] class of each box. Defaults to all
+            zeros (i.e. class agnostic suppression).
+        thresh (float): overlap threshold
+        max_per_image (int): if specified only keep the top scoring boxes of
+            each image.
+        bias (int): 1 uses the inclusive pixel convention where a box has
+            area (x2 - x1 + 1) * (y2 - y1 + 1) (as in `cpu_nms`), 0 is for
+            continuous (e.g. normalized) coordinates.
+        impl (str): can be 'torch', 'cpu', or 'auto'
+        max_pairs (int): maximum number of candidate pairs to process at once.
+            When there are more, 'auto' uses the compiled kernel.
+
+    Returns:
+        Tensor | ndarray: indices of the kept boxes (of the same type as
+            `boxes`) sorted by image and then by descending score.
+
+    Example:
+        >>> boxes = torch.FloatTensor([
+        >>>     [0, 0, 100, 100], [10, 10, 100, 100], [0, 0, 100, 100],
+        >>>     [0, 0, 100, 100], [50, 50, 100, 100], [10, 10, 100, 100],
+        >>> ])
+        >>> scores = torch.FloatTensor([.9, .8, .7, .6, .5, .4])
+        >>> batch_idxs = torch.LongTensor([0, 0, 0, 1, 1, 1])
+        >>> class_idxs = torch.LongTensor([0, 0, 1, 0, 0, 0])
+        >>> keep = batched_nms(boxes, scores, batch_idxs, class_idxs, .5)
+        >>> print(keep.tolist())
+        [0, 2, 3, 4]
+        >>> keep = batched_nms(boxes, scores, batch_idxs, class_idxs, .5,
+        >>>                    max_per_image=1)
+        >>> print(keep.tolist())
+        [0, 3]
+
+    Example:
+        >>> # Compare with running NMS on each image and class separately
+        >>> from clab.models.yolo2.utils.batched_nms import _demodata, _nms_loop
+        >>> boxes, scores, batch_idxs, class_idxs = _demodata(2000, rng=0)
+        >>> keep = batched_nms(boxes, scores, batch_idxs, class_idxs, .4)
+        >>> expected = []
+        >>> for bx, cx in set(zip(batch_idxs, class_idxs)):
+        >>>     idxs = np.where((batch_idxs == bx) & (class_idxs == cx))[0]
+        >>>     expected.extend(idxs[_nms_loop(boxes[idxs], scores[idxs], .4)])
+        >>> assert sorted(keep.tolist()) == sorted(expected)
+        >>> # the compiled kernel gives the same result
+        >>> if cpu_nms is not None:
+        >>>     keep2 = batched_nms(boxes, scores, batch_idxs, class_idxs, .4,
+        >>>                         impl='cpu')
+        >>>     assert sorted(keep2.tolist()) == sorted(expected)
+    """
+    is_numpy = not torch.is_tensor(boxes)
+    boxes = torch.as_tensor(np.asarray(boxes) if is_numpy else boxes)
+    n = len(boxes)
+    device = boxes.device
+    scores = torch.as_tensor(scores, device=device).view(-1)
+    if batch_idxs is None:
+        batch_idxs = torch.zeros(n, dtype=torch.long, device=device)
+    if class_idxs is None:
+        class_idxs = torch.zeros(n, dtype=torch.long, device=device)
+    batch_idxs = torch.as_tensor(batch_idxs, device=device).long().view(-1)
+    class_idxs = torch.as_tensor(class_idxs, device=device).long().view(-1)
+
+    if n == 0:
+        keep = torch.empty(0, dtype=torch.long, device=device)
+    else:
+        n_classes = int(class_idxs.max()) + 1
+        groups = batch_idxs * n_classes + class_idxs
+
+        if impl == 'auto':
+            if cpu_nms is not None and bias == 1 and not boxes.is_cuda:
+                counts = torch.unique(groups, return_counts=True)[1]
+                n_pairs = int((counts * (counts - 1) // 2).sum())
+                impl = 'cpu' if n_pairs > max_pairs else 'torch'
+            else:
+                impl = 'torch'
+
+        if impl == 'torch':
+            keep = _nms_torch(boxes, scores, groups, thresh, bias, max_pairs)
+        elif impl == 'cpu':
+            keep = _nms_cpu(boxes, scores, groups, thresh, bias)
+        else:
+            raise KeyError(impl)
+
+        # Sort the kept boxes by image and then by descending score
+        keep = keep[torch.argsort(scores[keep], descending=True, stable=True)]
+        keep = keep[torch.argsort(batch_idxs[keep], stable=True)]
+
+        if max_per_image is not None and max_per_image > 0:
+            kept_bxs = batch_idxs[keep]
+            # rank of each box inside its image
+            first = torch.ones_like(kept_bxs, dtype=torch.bool)
+            first[1:] = kept_bxs[1:] != kept_bxs[:-1]
+            pos = torch.arange(len(keep), device=device)
+            starts = torch.cummax(torch.where(first, pos, torch.zeros_like(pos)),
+                                  dim=0)[0]
+            keep = keep[(pos - starts) < max_per_image]
+
+    if is_numpy:
+        keep = keep.cpu().numpy()
+    return keep
+
+
+def _sort_groups(scores, groups):
+    """
+    Orders boxes by group and then by descending score.
+
+    Returns:
+        tuple: the ordering and the number of boxes in each (sorted) group
+    """
+    order = torch.argsort(scores, descending=True, stable=True)
+    order = order[torch.argsort(groups[order], stable=True)]
+    counts = torch.unique_consecutive(groups[order], return_counts=True)[1]
+    return order, counts
+
+
+def _nms_torch(boxes, scores, groups, thresh, bias, max_pairs=2 ** 24):
+    """
+    Vectorized greedy NMS inside each group.
+
+    Whole groups are processed in chunks of at most `max_pairs` candidate
+    pairs (a single group may exceed this) to bound the memory use.
+
+    Returns the indices of the kept boxes (in no particular order).
+    """
+    order, counts = _sort_groups(scores, groups)
+    sboxes = boxes[order].float()
+
+    pairs = counts * (counts - 1) // 2
+    chunk_ids = (torch.cumsum(pairs, dim=0) - pairs) // max_pairs
+    if int(chunk_ids[-1]) == 0:
+        keep = _nms_sorted(sboxes, counts, thresh, bias)
+    else:
+        ends = torch.cumsum(counts, dim=0)
+        keep = []
+        for cid in torch.unique_consecutive(chunk_ids).tolist():
+            gxs = torch.nonzero(chunk_ids == cid).view(-1)
+            lo = int(ends[gxs[0]] - counts[gxs[0]])
+            hi = int(ends[gxs[-1]])
+            keep.append(_nms_sorted(sboxes[lo:hi], counts[gxs], thresh, bias))
+        keep = torch.cat(keep)
+    return order[keep]
+
+
+def _nms_sorted(sboxes, counts, thresh, bias):
+    """
+    Greedy NMS of boxes sorted by group and descending score, where `counts`
+    is the size of each consecutive group. Returns a keep mask.
+    """
+    n = len(sboxes)
+    device = sboxes.device
+
+    # Enumerate every pair (i, j) with i < j inside the same group
+    group_end = torch.repeat_interleave(torch.cumsum(counts, dim=0), counts)
+    arange = torch.arange(n, device=device)
+    n_after = group_end - arange - 1
+    ii = torch.repeat_interleave(arange, n_after)
+    run_start = torch.cumsum(n_after, dim=0) - n_after
+    jj = ii + 1 + (torch.arange(len(ii), device=device) - run_start[ii])
+
+    # Overlap of each pair
+    x1, y1, x2, y2 = sboxes.unbind(dim=1)
+    areas = (x2 - x1 + bias) * (y2 - y1 + bias)
+    iw = (torch.min(x2[ii], x2[jj]) - torch.max(x1[ii], x1[jj]) + bias).clamp(min=0)
+    ih = (torch.min(y2[ii], y2[jj]) - torch.max(y1[ii], y1[jj]) + bias).clamp(min=0)
+    inter = iw * ih
+    ovr = inter / (areas[ii] + areas[jj] - inter)
+    # compare in double precision like the compiled kernel
+    flags = ovr.double() >= thresh
+    ii = ii[flags]
+    jj = jj[flags]
+
+    # The greedy result is the unique solution of:
+    #     keep[j] = not any(keep[i] for each i < j that overlaps j)
+    # Iterating this from keep=all settles one level of the suppression chain
+    # at each step, so it converges in a few iterations.
+    keep = torch.ones(n, dtype=torch.bool, device=device)
+    while True:
+        suppressed = torch.zeros(n, dtype=torch.bool, device=device)
+        suppressed[jj[keep[ii]]] = True
+        new_keep = ~suppressed
+        if torch.equal(new_keep, keep):
+            break
+        keep = new_keep
+    return keep
+
+
+def _nms_cpu(boxes, scores, groups, thresh, bias):
+    """
+    Runs the compiled kernel on each group.
+
+    (Offsetting the groups apart and making a single call is not worth it
+    here because the kernel compares all pairs of its input.)
+    """
+    if cpu_nms is None:
+        raise RuntimeError('The compiled cpu_nms kernel is not available')
+    if bias != 1:
+        raise ValueError('cpu_nms only supports bias=1')
+    order, counts = _sort_groups(scores, groups)
+    order = order.cpu()
+    dets = torch.cat([boxes.float(), scores.float()[:, None]], dim=1)
+    dets = dets[order.to(boxes.device)].detach().cpu().numpy()
+    keep = []
+    start = 0
+    for count in counts.tolist():
+        stop = start + count
+        group_keep = cpu_nms(np.ascontiguousarray(dets[start:stop]), thresh)
+        keep.append(order[start:stop][torch.LongTensor(group_keep)])
+        start = stop
+    keep = torch.cat(keep)
+    return keep.to(boxes.device)
+
+
+def _nms_loop(boxes, scores, thresh, bias=1):
+    """
+    Python reference with the same semantics as the compiled `cpu_nms`.
+    """
+    boxes = np.asarray(boxes, dtype=np.float64)
+    scores = np.asarray(scores)
+    x1, y1, x2, y2 = boxes.T
+    areas = (x2 - x1 + bias) * (y2 - y1 + bias)
+    order = np.argsort(-scores, kind='stable')
+    suppressed = np.zeros(len(boxes), dtype=bool)
+    keep = []
+    for _i, i in enumerate(order):
+        if suppressed[i]:
+            continue
+        keep.append(i)
+        rest = order[_i + 1:]
+        iw = np.maximum(0, np.minimum(x2[i], x2[rest]) - np.maximum(x1[i], x1[rest]) + bias)
+        ih = np.maximum(0, np.minimum(y2[i], y2[rest]) - np.maximum(y1[i], y1[rest]) + bias)
+        inter = iw * ih
+        ovr = inter / (areas[i] + areas[rest] - inter)
+        suppressed[rest[ovr >= thresh]] = True
+    return np.array(keep, dtype=np.int64)
+
+
+def _demodata(n=1000, n_images=16, n_classes=5, rng=None):
+    """ random integer detections that overlap often """
+    rng = np.random.RandomState(rng)
+    xy = rng.randint(0, 200, (n, 2))
+    wh = rng.randint(10, 80, (n, 2))
+    boxes = np.hstack([xy, xy + wh]).astype(np.float32)
+    scores = rng.rand(n).astype(np.float32)
+    batch_idxs = rng.randint(0, n_images, n)
+    class_idxs = rng.randint(0, n_classes, n)
+    return boxes, scores, batch_idxs, class_idxs
+
+
+if __name__ == '__main__':
+    r"""
+    CommandLine:
+        python -m clab.models.yolo2.utils.batched_nms all
+    """
+    import xdoctest
+    xdoctest.doctest_module(__file__)
@@ -1,4 +1,11 @@
+import copy
+import os
+import sys
+import threading
+import six
 import torch
+from os.path import dirname, exists, relpath
+from six.moves import queue
 from clab import xpu_device
 
 
@@ -146,3 +153,214 @@ def _onnx_as_caffe2(fpath):
     # To run networks with more than one input, pass a tuple
     # rather than a single numpy ndarray.
     print(outputs[0])
+
+
+def state_to_host(state):
+    """
+    Copies every tensor of a (nested) state dict to host memory, so training
+    can continue to modify the originals while the copy is written.
+
+    Device tensors are copied into pinned memory with non-blocking transfers
+    and a single synchronize at the end.
+
+    Example:
+        >>> model = torch.nn.Linear(3, 2)
+        >>> state = state_to_host({'model': model.state_dict(), 'epoch': 3})
+        >>> model.weight.data.zero_()
+        >>> assert state['model']['weight'].abs().sum() > 0
+        >>> assert state['epoch'] == 3
+    """
+    is_async = []
+
+    def _copy(item):
+        if torch.is_tensor(item):
+            item = item.detach()
+            if item.is_cuda:
+                out = torch.empty(item.shape, dtype=item.dtype,
+                                  pin_memory=True)
+                out.copy_(item, non_blocking=True)
+                is_async.append(True)
+                return out
+            return item.clone()
+        elif isinstance(item, dict):
+            out = item.__class__((k, _copy(v)) for k, v in item.items())
+            if hasattr(item, '_metadata'):
+                # module state dicts keep version info here
+                out._metadata = copy.deepcopy(item._metadata)
+            return out
+        elif isinstance(item, (list, tuple)) and not hasattr(item, '_fields'):
+            return item.__class__(_copy(v) for v in item)
+        else:
+            return copy.deepcopy(item)
+
+    host_state = _copy(state)
+    if is_async:
+        torch.cuda.synchronize()
+    return host_state
+
+
+def atomic_save(obj, fpath):
+    """
+    Writes `torch.save(obj)` to a temporary file, fsyncs it, and renames it
+    to `fpath`, so readers see either the old file or the complete new one.
+
+    Example:
+        >>> import tempfile
+        >>> from os.path import join
+        >>> fpath = join(tempfile.mkdtemp(), 'state.pt')
+        >>> atomic_save({'a': torch.arange(3)}, fpath)
+        >>> assert torch.load(fpath)['a'].tolist() == [0, 1, 2]
+        >>> assert os.listdir(dirname(fpath)) == ['state.pt']
+    """
+    tmp_fpath = '{}.{}.tmp'.format(fpath, os.getpid())
+    try:
+        with open(tmp_fpath, 'wb') as file:
+            torch.save(obj, file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_fpath, fpath)
+    except Exception:
+        if exists(tmp_fpath):
+            os.remove(tmp_fpath)
+        raise
+    _fsync_dir(dirname(fpath))
+
+
+def link_file(fpath, link_fpath):
+    """
+    Atomically points `link_fpath` at `fpath` using a hard link, or a relative
+    symlink if the filesystem does not support hard links.
+
+    Example:
+        >>> import tempfile
+        >>> from os.path import join
+        >>> dpath = tempfile.mkdtemp()
+        >>> for epoch in [1, 2]:
+        >>>     fpath = join(dpath, 'epoch_{}.pt'.format(epoch))
+        >>>     atomic_save({'epoch': epoch}, fpath)
+        >>>     link_file(fpath, join(dpath, 'best.pt'))
+        >>> assert torch.load(join(dpath, 'best.pt'))['epoch'] == 2
+        >>> # deleting the original does not break a hard link
+        >>> os.remove(join(dpath, 'epoch_2.pt'))
+        >>> if not os.path.islink(join(dpath, 'best.pt')):
+        >>>     assert torch.load(join(dpath, 'best.pt'))['epoch'] == 2
+    """
+    tmp_fpath = '{}.{}.tmp'.format(link_fpath, os.getpid())
+    if os.path.lexists(tmp_fpath):
+        os.remove(tmp_fpath)
+    try:
+        os.link(fpath, tmp_fpath)
+    except (OSError, AttributeError):
+        os.symlink(relpath(fpath, dirname(link_fpath)), tmp_fpath)
+    os.replace(tmp_fpath, link_fpath)
+    _fsync_dir(dirname(link_fpath))
+
+
+def _fsync_dir(dpath):
+    # make the rename durable (not supported on windows)
+    if os.name == 'posix':
+        fd = os.open(dpath or '.', os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+class SnapshotWriter(object):
+    """
+    Writes snapshots with `atomic_save` in a background thread.
+
+    `save` copies the state to host memory (see `state_to_host`) and returns,
+    while pickling, writing, and fsyncing happen in the writer thread. At most
+    one snapshot waits behind the one being written, so `save` only blocks
+    when snapshots are requested faster than they can be written.
+
+    Args:
+        background (bool): if False snapshots are written in the calling thread
+
+    Example:
+        >>> import tempfile
+        >>> from os.path import join
+        >>> dpath = tempfile.mkdtemp()
+        >>> model = torch.nn.Linear(3, 2)
+        >>> writer = SnapshotWriter()
+        >>> for epoch in range(3):
+        >>>     writer.save({'epoch': epoch, 'model': model.state_dict()},
+        >>>                 join(dpath, '_epoch_{}.pt'.format(epoch)),
+        >>>                 link_fpath=join(dpath, 'best.pt'))
+        >>> writer.wait()
+        >>> assert torch.load(join(dpath, 'best.pt'))['epoch'] == 2
+        >>> assert sorted(os.listdir(dpath)) == [
+        >>>     '_epoch_0.pt', '_epoch_1.pt', '_epoch_2.pt', 'best.pt']
+        >>> writer.close()
+    """
+    def __init__(self, background=True):
+        self.background = background
+        self._queue = queue.Queue(maxsize=1)
+        self._thread = None
+        self._error = None
+
+    def save(self, state, fpath, link_fpath=None):
+        """
+        Args:
+            state (dict): the snapshot (tensors may be on any device)
+            fpath (str): where to write the snapshot
+            link_fpath (str): if specified, this path is linked to the
+                snapshot after it is written (e.g. best_snapshot.pt)
+        """
+        self._check_error()
+        job = (state_to_host(state), fpath, link_fpath)
+        if not self.background:
+            self._write(*job)
+            return
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._worker,
+                                            name='SnapshotWriter')
+            self._thread.daemon = True
+            self._thread.start()
+        self._queue.put(job)
+
+    def wait(self):
+        """ Blocks until every requested snapshot is on disk """
+        if self._thread is not None:
+            self._queue.join()
+        self._check_error()
+
+    def close(self):
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+        self._check_error()
+
+    def _write(self, state, fpath, link_fpath):
+        atomic_save(state, fpath)
+        if link_fpath is not None:
+            link_file(fpath, link_fpath)
+
+    def _worker(self):
+        while True:
+            job = self._queue.get()
+            try:
+                if job is None:
+                    return
+                if self._error is None:
+                    self._write(*job)
+            except Exception:
+                self._error = sys.exc_info()
+            finally:
+                self._queue.task_done()
+
+    def _check_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            six.reraise(*error)
+
+
+if __name__ == '__main__':
+    r"""
+    CommandLine:
+        python -m clab.nnio all
+    """
+    import xdoctest
+    xdoctest.doctest_module(__file__)
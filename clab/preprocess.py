@@ -4,8 +4,14 @@ REFACTOR
 """
 from __future__ import absolute_import, division, print_function
 import cv2
+import glob
+import json
+import multiprocessing
+import os
+import threading
 import ubelt as ub
-from os.path import join, expanduser, basename, splitext, abspath, exists  # NOQA
+from os.path import join, expanduser, basename, splitext, abspath, exists, split  # NOQA
+from six.moves import queue
 from PIL import Image
 from clab import inputs
 from clab.util import fnameutil  # NOQA
@@ -45,6 +51,9 @@ class Preprocessor(object):
             'overlap': .25,
             'keepbound': True,
         }
+        # number of processes and writer threads per process
+        prep.workers = multiprocessing.cpu_count()
+        prep.n_writers = 2
 
     def subdir(prep, *args, **kw):
         dpath = join(*((prep.datadir,) + args))
@@ -80,99 +89,96 @@ class Preprocessor(object):
 
         return out_dpaths
 
-    def _mode_new_input(prep, mode, input, clear=False, mult=1):
+    def _empty_input(prep, mode, input, clear=False):
         out_dpaths = prep._mode_paths(mode, input, clear=clear)
         new_input = inputs.Inputs()
         new_input.tag = mode
         if 'im' in out_dpaths:
             new_input.imdir = out_dpaths['im']
+            new_input.im_paths = []
         if 'gt' in out_dpaths:
             new_input.gtdir = out_dpaths['gt']
+            new_input.gt_paths = []
         if 'aux' in out_dpaths:
             new_input.auxdir = out_dpaths['aux']
+            new_input.aux_paths = {k: [] for k in input.aux_paths.keys()}
+        return new_input
 
-        if not clear:
-            try:
-                new_input.prepare_image_paths()
-            except AssertionError:  # hack
-                return prep._mode_new_input(mode, input, clear=True)
-
-            if len(new_input.paths) > 0:
-                n_loaded = min(map(len, new_input.paths.values()))
-                min_n_expected = len(input) * mult
-                print(' * n_loaded = {!r}'.format(n_loaded))
-                print(' * min_n_expected = {!r}'.format(min_n_expected))
-                # Short curcuit augmentation if we found stuff
-                if n_loaded >= min_n_expected:
-                    print('short circuit {}'.format(mode))
-                    return new_input, True
+    def _process_records(prep, mode, fullres, func, jobkw, clear=False,
+                         workers=None):
+        """
+        Runs `func` on each record of `fullres` in a process pool and
+        returns the Inputs of the written files.
 
-        if 'im' in out_dpaths:
-            new_input.im_paths = []
-        if 'gt' in out_dpaths:
-            new_input.gt_paths = []
-        if 'aux' in out_dpaths:
-            new_input.aux_paths = {k: [] for k in input.aux_paths.keys()}
-        return new_input, False
+        Completed records are appended to a manifest, so an interrupted run
+        resumes with the remaining records. Files are written under a
+        temporary name and renamed once complete, so a directory never
+        contains a partially written file.
+        """
+        new_input = prep._empty_input(mode, fullres, clear=clear)
+        out_dirs = {k: new_input.dirs[k] for k in new_input.paths.keys()}
+
+        manifest_fpath = join(prep.subdir('manifests'), mode + '.jsonl')
+        if clear and exists(manifest_fpath):
+            os.remove(manifest_fpath)
+        done = _read_manifest(manifest_fpath)
+
+        # Remove partial writes from an interrupted run
+        for dpath in out_dirs.values():
+            for fpath in glob.glob(join(dpath, _TMP_PREFIX + '*')):
+                os.remove(fpath)
+
+        records = list(fullres.iter_records())
+        keys = [basename(record['dump_fname']) for record in records]
+        jobs = [dict(record=record, key=key, out_dirs=out_dirs, **jobkw)
+                for key, record in zip(keys, records) if key not in done]
+        print('{}: {} / {} records are already done'.format(
+            mode, len(records) - len(jobs), len(records)))
+
+        if jobs:
+            if workers is None:
+                workers = prep.workers
+            with open(manifest_fpath, 'a') as file:
+                results = _imap_unordered(func, jobs, workers)
+                for key, fnames in ub.ProgIter(results, length=len(jobs),
+                                               label='make ' + mode):
+                    file.write(json.dumps({'key': key, 'fnames': fnames}) + '\n')
+                    file.flush()
+                    done[key] = fnames
+
+        # Paths are ordered by record and then by the order they were written
+        for key in keys:
+            for k, dpath in out_dirs.items():
+                new_input.paths[k].extend(join(dpath, fname)
+                                          for fname in done[key])
+        return new_input
+
+    def make_lowres(prep, fullres, clear=False, workers=None):
+        """
+        Resizes the fullres images to the network input shape.
 
-    def make_lowres(prep, fullres, clear=False):
+        Args:
+            fullres (Inputs): full resolution inputs
+            clear (bool): if True, ignore previous results
+            workers (int): number of processes (0 runs in the main process).
+                Defaults to `prep.workers`.
+        """
         # Define the output path for this preprocessing mode
         mode = 'lowres_' + '_'.join(list(map(str, prep.input_shape)))
-
-        lowres, flag = prep._mode_new_input(mode, fullres, clear=clear, mult=1)
-        if flag:
-            return lowres
-
-        target_dsize = tuple(prep.input_shape[::-1])
-
-        def _lowres_proc(tag, out_dpath, in_paths, out_names, interpolation):
-            """
-            pip install tifffile
-            """
-            _iter = zip(in_paths, out_names)
-            prog = ub.ProgIter(_iter, length=len(in_paths), label='lowres ' + tag)
-            for in_path, out_name in prog:
-                out_path = join(out_dpath, out_name)
-                if not exists(out_path):
-                    in_data = imutil.imread(in_path)
-                    out_data = cv2.resize(in_data, target_dsize,
-                                          interpolation=interpolation)
-                    imutil.imwrite(out_path, out_data)
-                yield out_path
-
-        out_names = fullres.dump_im_names
-
-        if fullres.im_paths:
-            out_dpath = lowres.dirs['im']
-            in_paths = fullres.paths['im']
-            interpolation = cv2.INTER_LANCZOS4
-            lowres.paths['im'] = list(_lowres_proc('im', out_dpath, in_paths,
-                                                   out_names, interpolation))
-
-        if fullres.gt_paths:
-            out_dpath = lowres.dirs['gt']
-            in_paths = fullres.paths['gt']
-            interpolation = cv2.INTER_NEAREST
-            lowres.paths['gt'] = list(_lowres_proc('gt', out_dpath, in_paths,
-                                                   out_names, interpolation))
-
-        if fullres.aux_paths:
-            for aux, in_paths in fullres.aux_paths.items():
-                out_dpath = lowres.dirs[aux]
-                in_paths = fullres.paths[aux]
-                # Unknown data is represented as a magic number -32767, so we
-                # shouldnt use fancy interpolation.
-                interpolation = cv2.INTER_NEAREST
-                lowres.paths[aux] = list(_lowres_proc(aux, out_dpath, in_paths,
-                                                      out_names,
-                                                      interpolation))
+        jobkw = dict(target_dsize=tuple(prep.input_shape[::-1]))
+        lowres = prep._process_records(mode, fullres, _lowres_record, jobkw,
+                                       clear=clear, workers=workers)
         return lowres
 
-    def make_parts(prep, fullres, scale=1, clear=False):
+    def make_parts(prep, fullres, scale=1, clear=False, workers=None):
         """
         Slices the fullres images into smaller parts that fit into the network
         but are at the original resolution (or higher).
 
+        Each record is read once and all of its parts are sliced in memory.
+        Records are distributed over `workers` processes and each process
+        writes its parts with a pool of writer threads.
+
         >>> from clab.tasks.urban_mapper_3d import *
         >>> task = UrbanMapper3D(root='~/remote/aretha/data/UrbanMapper3D', workdir='~/data/work/urban_mapper')
         >>> task.prepare_fullres_inputs()
@@ -182,51 +188,209 @@ class Preprocessor(object):
         >>> scale = 1
         >>> clear = False
         >>> lowres = prep.make_parts(fullres, scale)
+
+        Example:
+            >>> import tempfile
+            >>> dpath = tempfile.mkdtemp()
+            >>> fullres = _demo_fullres(dpath)
+            >>> prep = Preprocessor(join(dpath, 'data'))
+            >>> prep.input_shape = (32, 40)
+            >>> parts = prep.make_parts(fullres, workers=2)
+            >>> assert len(parts) == 2 * 9
+            >>> assert parts.im_paths[0].endswith('img0_part0000_000_000.png')
+            >>> assert imutil.imread(parts.gt_paths[3]).shape == (32, 40)
+            >>> # The second call resumes from the manifest
+            >>> parts2 = prep.make_parts(fullres, workers=0)
+            >>> assert parts2.paths.to_dict() == parts.paths.to_dict()
         """
         part_config = prep.part_config
         hashid = hashutil.hash_data(ub.repr2(part_config), hashlen=8)
         shapestr = '_'.join(list(map(str, prep.input_shape)))
         mode = 'part-scale{}-{}-{}'.format(scale, shapestr, hashid)
 
-        parts, flag = prep._mode_new_input(mode, fullres, clear=clear)
-        if flag:
-            return parts
+        jobkw = dict(scale=scale, input_shape=prep.input_shape,
+                     overlap=part_config['overlap'],
+                     keepbound=part_config['keepbound'],
+                     n_writers=prep.n_writers)
+        parts = prep._process_records(mode, fullres, _parts_record, jobkw,
+                                      clear=clear, workers=workers)
+        return parts
 
-        input_shape = prep.input_shape
-        overlap = part_config['overlap']
-        keepbound = part_config['keepbound']
+    def make_packed(prep, parts, force=False):
+        """
+        Packs chipped inputs (e.g. the result of `make_parts`) into memory
+        mapped arrays. Set the result as the `chips` attribute of a dataset
+        to read chips without decoding files.
 
-        records = list(fullres.iter_records())
-        for record in ub.ProgIter(records, label='make ' + mode):
-            dump_fname = basename(record['dump_fname'])
-
-            im_shape = np.array(Image.open(record['im']).size[::-1])
-            im_shape = tuple(np.floor(im_shape * scale).astype(np.int))
-
-            # Consolodate all channels that belong to this record
-            in_paths = record.get('aux').copy()
-            for k in ['im', 'gt']:
-                if k in record:
-                    in_paths[k] = record[k]
-
-            # Read the images for this record and resize if necessary
-            in_images = {k: imutil.imread(v) for k, v in in_paths.items()}  # 9% of the time
-            if scale != 1.0:
-                for k in in_images.keys():
-                    interp = cv2.INTER_LANCZOS4 if k == 'im' else cv2.INTER_NEAREST
-                    in_images[k] = imutil.imscale(in_images[k], scale, interp)[0]
-
-            sl_gen = imutil.image_slices(im_shape, input_shape, overlap, keepbound)
-            for idx, rc_slice in enumerate(sl_gen):
-                rsl, csl = rc_slice
-                suffix = '_part{:0=4d}_{:0=3d}_{:0=3d}'.format(idx, rsl.start,
-                                                               csl.start)
-                fname = ub.augpath(dump_fname, suffix=suffix)
-
-                for k, in_data in in_images.items():
-                    out_data = in_data[rc_slice]
-                    out_fpath = join(parts.dirs[k], fname)
-                    imutil.imwrite(out_fpath, out_data)  # 84% of the time
-                    parts.paths[k].append(out_fpath)
+        Returns:
+            clab.data.chipstore.ChipStore
+        """
+        from clab.data.chipstore import ChipStore
+        dpath = prep.subdir('packed', parts.tag)
+        return ChipStore.from_inputs(parts, dpath, force=force)
 
-        return parts
+
+_TMP_PREFIX = '.tmp-'
+
+
+def _read_manifest(fpath):
+    """
+    Reads the completed records of a manifest. A truncated last line from an
+    interrupted write is ignored.
+    """
+    done = {}
+    if exists(fpath):
+        with open(fpath, 'rb+') as file:
+            text = file.read().decode('utf8')
+            if not text.endswith('\n'):
+                # drop the partial line so new entries start on their own line
+                file.truncate(len(text[:text.rfind('\n') + 1].encode('utf8')))
+        for line in text.splitlines():
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            done[entry['key']] = entry['fnames']
+    return done
+
+
+def _imap_unordered(func, jobs, workers):
+    if workers == 0:
+        for job in jobs:
+            yield func(job)
+    else:
+        pool = multiprocessing.Pool(min(workers, len(jobs)))
+        try:
+            for result in pool.imap_unordered(func, jobs):
+                yield result
+        finally:
+            pool.terminate()
+            pool.join()
+
+
+def _atomic_imwrite(fpath, data):
+    dpath, fname = split(fpath)
+    # write under a hidden name with the same extension, so the format is
+    # the same and directory globs do not see incomplete files.
+    tmp_fpath = join(dpath, _TMP_PREFIX + fname)
+    imutil.imwrite(tmp_fpath, data)
+    os.rename(tmp_fpath, fpath)
+
+
+def _write_all(items, n_writers=2):
+    """
+    Writes (fpath, data) items with a pool of threads. The queue is bounded so
+    the producer does not get too far ahead of the writers.
+    """
+    items_queue = queue.Queue(maxsize=2 * n_writers)
+    errors = []
+
+    def _worker():
+        while True:
+            item = items_queue.get()
+            if item is None:
+                break
+            if not errors:
+                try:
+                    _atomic_imwrite(*item)
+                except Exception as ex:
+                    errors.append(ex)
+
+    threads = [threading.Thread(target=_worker) for _ in range(n_writers)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    try:
+        for item in items:
+            items_queue.put(item)
+            if errors:
+                break
+    finally:
+        for _ in threads:
+            items_queue.put(None)
+        for thread in threads:
+            thread.join()
+    if errors:
+        raise errors[0]
+
+
+def _record_in_paths(record):
+    # Consolodate all channels that belong to this record
+    in_paths = dict(record.get('aux') or {})
+    for k in ['im', 'gt']:
+        if k in record:
+            in_paths[k] = record[k]
+    return in_paths
+
+
+def _parts_record(job):
+    """ Reads a record once and writes all of its parts """
+    record, out_dirs = job['record'], job['out_dirs']
+    scale = job['scale']
+    dump_fname = basename(record['dump_fname'])
+
+    im_shape = np.array(Image.open(record['im']).size[::-1])
+    im_shape = tuple(np.floor(im_shape * scale).astype(np.int))
+
+    # Read the images for this record and resize if necessary
+    in_paths = _record_in_paths(record)
+    in_images = {k: imutil.imread(v) for k, v in in_paths.items()}
+    if scale != 1.0:
+        for k in in_images.keys():
+            interp = cv2.INTER_LANCZOS4 if k == 'im' else cv2.INTER_NEAREST
+            in_images[k] = imutil.imscale(in_images[k], scale, interp)[0]
+
+    slices = list(imutil.image_slices(im_shape, job['input_shape'],
+                                      job['overlap'], job['keepbound']))
+    fnames = []
+    for idx, (rsl, csl) in enumerate(slices):
+        suffix = '_part{:0=4d}_{:0=3d}_{:0=3d}'.format(idx, rsl.start,
+                                                       csl.start)
+        fnames.append(ub.augpath(dump_fname, suffix=suffix))
+
+    def _items():
+        for fname, rc_slice in zip(fnames, slices):
+            for k, in_data in in_images.items():
+                yield join(out_dirs[k], fname), in_data[rc_slice]
+
+    _write_all(_items(), n_writers=job['n_writers'])
+    return job['key'], fnames
+
+
+def _lowres_record(job):
+    """ Resizes each channel of a record """
+    record, out_dirs = job['record'], job['out_dirs']
+    dump_fname = basename(record['dump_fname'])
+
+    def _items():
+        for k, in_path in _record_in_paths(record).items():
+            # Unknown data in aux channels is represented as a magic number
+            # -32767, so we shouldnt use fancy interpolation.
+            interp = cv2.INTER_LANCZOS4 if k == 'im' else cv2.INTER_NEAREST
+            in_data = imutil.imread(in_path)
+            out_data = cv2.resize(in_data, job['target_dsize'],
+                                  interpolation=interp)
+            yield join(out_dirs[k], dump_fname), out_data
+
+    _write_all(_items(), n_writers=1)
+    return job['key'], [dump_fname]
+
+
+def _demo_fullres(dpath, n=2, shape=(64, 100)):
+    """ Writes a small dataset of random images with an aux channel """
+    rng = np.random.RandomState(0)
+    paths = {'im': [], 'gt': [], 'dsm': []}
+    for i in range(n):
+        for k, dtype in [('im', np.uint8), ('gt', np.uint8), ('dsm', np.uint8)]:
+            shape_ = shape + (3,) if k == 'im' else shape
+            data = rng.randint(0, 4 if k == 'gt' else 255, shape_).astype(dtype)
+            fpath = join(ub.ensuredir((dpath, 'fullres', k)), 'img{}.png'.format(i))
+            imutil.imwrite(fpath, data)
+            paths[k].append(fpath)
+    fullres = inputs.Inputs()
+    fullres.tag = 'fullres'
+    fullres.im_paths = paths['im']
+    fullres.gt_paths = paths['gt']
+    fullres.aux_paths = {'dsm': paths['dsm']}
+    fullres.make_dumpsafe_names()
+    return fullres
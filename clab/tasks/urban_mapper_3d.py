@@ -13,6 +13,7 @@ from clab.util import colorutil
 from clab.util import fnameutil  # NOQA
 from clab import inputs
 from clab import preprocess
+from clab import stitching
 from clab import getLogger
 import parse
 
@@ -374,107 +375,6 @@ class UrbanMapper3D(SemanticSegmentationTask):
         if len(part_paths) == 0:
             return []
 
-        def stitch_tiles(rc_locs, tiles):
-            """
-            Recombine parts back into an entire image
-            (TODO: blending / averaging to remove boundry effects)
-            """
-            shapes = [t.shape[0:2] for t in tiles]
-            n_channels = 1 if len(tiles[0].shape) == 2 else tiles[0].shape[2]
-            bboxes = np.array([
-                (r, c, r + h, c + w)
-                for ((r, c), (h, w)) in zip(rc_locs, shapes)
-            ])
-            stiched_shape = tuple(bboxes.T[2:4].max(axis=1))
-            if n_channels > 1:
-                stiched_shape = stiched_shape + (n_channels,)
-            stiched = np.zeros(stiched_shape)
-            for bbox, tile in zip(bboxes, tiles):
-                r1, c1, r2, c2 = bbox
-                stiched[r1:r2, c1:c2] = tile
-            return stiched
-
-        def stitch_tiles_ave(rc_locs, tiles, weighted=False):
-            """
-            Recombine parts back into an entire image
-
-            Example:
-                >>> rc_locs = [(0, 0), (0, 5), (0, 10)]
-                >>> tiles = [np.ones((1, 7, 3)) + i for i in range(len(rc_locs))]
-                >>> tiles = [np.ones((1, 7)) + i for i in range(len(rc_locs))]
-            """
-            shapes = [t.shape[0:2] for t in tiles]
-            n_channels = 1 if len(tiles[0].shape) == 2 else tiles[0].shape[2]
-            bboxes = np.array([
-                (r, c, r + h, c + w)
-                for ((r, c), (h, w)) in zip(rc_locs, shapes)
-            ])
-            stiched_wh = tuple(bboxes.T[2:4].max(axis=1))
-            stiched_shape = stiched_wh
-            if n_channels > 1:
-                stiched_shape = stiched_wh + (n_channels,)
-            sums = np.zeros(stiched_shape)
-            nums = np.zeros(stiched_wh)
-
-            if weighted:
-                # assume all shapes are the same
-                h, w = shapes[0]
-                weight = np.ones((h, w) )
-                # Weight borders less than center
-                # should really use receptive fields for this calculation
-                # but this should be fine.
-                weight[:h // 4]  = .25
-                weight[-h // 4:] = .25
-                weight[:w // 4]  = .25
-                weight[-w // 4:] = .25
-                weight3c = weight
-                if n_channels > 1:
-                    weight3c = weight[:, :, None]
-            else:
-                weight3c = weight = 1
-
-            # Assume we are not in log-space here, so the weighted average
-            # formula does not need any exponentiation.
-            for bbox, tile in zip(bboxes, tiles):
-                r1, c1, r2, c2 = bbox
-                sums[r1:r2, c1:c2] += (tile * weight3c)
-                nums[r1:r2, c1:c2] += weight
-
-            if len(sums.shape) == 2:
-                stiched = sums / nums
-            else:
-                stiched = sums / nums[:, :, None]
-            return stiched
-
-        def stitch_tiles_vote(rc_locs, tiles):
-            """
-            Recombine parts back into an entire image
-            (TODO: blending / averaging to remove boundry effects)
-            """
-            shapes = [t.shape[0:2] for t in tiles]
-            n_channels = 1 if len(tiles[0].shape) == 2 else tiles[0].shape[2]
-            assert n_channels == 1
-            bboxes = np.array([
-                (r, c, r + h, c + w)
-                for ((r, c), (h, w)) in zip(rc_locs, shapes)
-            ])
-            stiched_shape = tuple(bboxes.T[2:4].max(axis=1))
-            n_classes = len(task.classnames)
-            votes = np.zeros((n_classes,) + stiched_shape)
-            for bbox, tile in zip(bboxes, tiles):
-                r1, c1, r2, c2 = bbox
-                for i in range(n_classes):
-                    votes[i, r1:r2, c1:c2][tile == i] += 1
-            stiched = votes.argmax(axis=0)
-            return stiched
-
-        def _extract_part_grid(paths):
-            # hack to use filenames to extract upper left locations of tiles in
-            # the larger image.
-            rc_locs = [[int(x) for x in basename(p).split('.')[0].split('_')[-2:]]
-                       for p in paths]
-            return rc_locs
-
         ext = splitext(part_paths[0])[1]
         is_image = ext not in ['.npy', '.h5']
 
@@ -494,17 +394,9 @@ class UrbanMapper3D(SemanticSegmentationTask):
             # try:
             # except OSError:
             # Find their relative positions and restitch them
-            rc_locs = _extract_part_grid(paths)
-            if blend == 'vote':
-                stiched = stitch_tiles_vote(rc_locs, tiles)
-            elif blend == 'ave':
-                stiched = stitch_tiles_ave(rc_locs, tiles, weighted=False)
-            elif blend == 'avew':
-                stiched = stitch_tiles_ave(rc_locs, tiles, weighted=True)
-            elif blend is None:
-                stiched = stitch_tiles(rc_locs, tiles)
-            else:
-                raise KeyError(blend)
+            rc_locs = stitching.extract_part_grid(paths)
+            stiched = stitching.stitch_tiles(rc_locs, tiles, blend=blend,
+                                             n_classes=len(task.classnames))
 
             # Write them to disk.
             if is_image:
@@ -520,22 +412,13 @@ class UrbanMapper3D(SemanticSegmentationTask):
     def instance_label(task, pred, k=15, n_iters=1, dist_thresh=5, watershed=False):
         """
         Do some postprocessing to label instances instead of classes
+        (see `clab.live.instance_labeling.InstanceLabeler.instance_label`)
         """
-        mask = pred
-
-        # noise removal
-        if k > 1 and n_iters > 0:
-            kernel = np.ones((k, k), np.uint8)
-            mask = cv2.morphologyEx(mask, cv2.MORPH_OPEN, kernel,
-                                    iterations=n_iters)
-
-        if watershed:
-            from clab.live import filters
-            mask = filters.watershed_filter(mask, dist_thresh=dist_thresh)
-
-        mask = mask.astype(np.uint8)
-        n_ccs, cc_labels = cv2.connectedComponents(mask, connectivity=4)
-        return cc_labels
+        from clab.live import instance_labeling
+        labeler = instance_labeling.default_labeler()
+        return labeler.instance_label(pred, k=k, n_iters=n_iters,
+                                      dist_thresh=dist_thresh,
+                                      watershed=watershed)
 
 
 def script_overlay_aux():
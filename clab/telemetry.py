@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+"""
+An asynchronous channel for training metrics and logged scalars.
+
+Metric hooks usually return device tensors (e.g. the loss), and converting
+them to python numbers forces the host to wait for the device. The
+:class:`Telemetry` object only stores the (detached) tensors on the hot path.
+A background thread drains them in batches, copies each metric to the host
+with a single stacked transfer, updates the registered moving averages, and
+writes logged scalars to the sinks (e.g. a `tensorboard_logger.Logger` or a
+:class:`FileSink`).
+
+Readers of the averages see the values of every record drained so far.
+:func:`Telemetry.flush` waits until all pending records are drained, which is
+only needed when exact values are required (e.g. at the end of an epoch).
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+import json
+import math
+import sys
+import threading
+import warnings
+import six
+import torch
+import ubelt as ub
+from six.moves import queue
+
+__all__ = ['Telemetry', 'FileSink']
+
+
+# Kinds of queued items
+_RECORD, _VALUE, _STOP = 'record', 'value', 'stop'
+
+
+class FileSink(object):
+    """
+    Appends logged scalars to a json-lines file.
+
+    Example:
+        >>> import tempfile
+        >>> from os.path import join
+        >>> fpath = join(tempfile.mkdtemp(), 'telemetry.jsonl')
+        >>> sink = FileSink(fpath)
+        >>> sink.log_value('train epoch loss', 0.5, 3)
+        >>> sink.close()
+        >>> print(open(fpath).read().strip())
+        {"key": "train epoch loss", "value": 0.5, "step": 3}
+    """
+    def __init__(self, fpath):
+        self.fpath = fpath
+        self._file = open(fpath, 'a')
+
+    def log_value(self, key, value, step):
+        self._file.write(json.dumps(ub.odict([
+            ('key', key), ('value', value), ('step', step)])) + '\n')
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+class Telemetry(object):
+    """
+    Collects metric dictionaries and scalars without blocking the caller.
+
+    Args:
+        sinks (list): objects with a `log_value(key, value, step)` method
+        background (bool): if False every call is processed immediately in the
+            calling thread (useful for debugging)
+        drain_size (int): maximum number of items processed per batch
+        warn (callable): called with a message when a non-finite metric is
+            replaced by 0 (defaults to `warnings.warn`)
+
+    Example:
+        >>> telemetry = Telemetry()
+        >>> from clab import util
+        >>> telemetry.set_average('train', util.CumMovingAve())
+        >>> for i in range(10):
+        >>>     telemetry.record(['train'], {'loss': torch.FloatTensor([i]).sum()})
+        >>> telemetry.flush()
+        >>> print(telemetry.average('train'))
+        {'loss': 4.5}
+        >>> telemetry.close()
+
+    Example:
+        >>> # non-finite values are counted as 0
+        >>> from clab import util
+        >>> messages = []
+        >>> telemetry = Telemetry(background=False, warn=messages.append)
+        >>> telemetry.set_average('vali', util.CumMovingAve())
+        >>> telemetry.record(['vali'], {'loss': torch.tensor(float('inf'))})
+        >>> telemetry.record(['vali'], {'loss': 3})
+        >>> print(telemetry.average('vali'))
+        {'loss': 1.5}
+        >>> assert len(messages) == 1
+    """
+    def __init__(self, sinks=None, background=True, drain_size=64, warn=None):
+        self.sinks = list(sinks or [])
+        self.background = background
+        self.drain_size = drain_size
+        self.warn = warnings.warn if warn is None else warn
+        self._averages = {}
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._thread = None
+        self._error = None
+
+    def set_average(self, name, ave):
+        """
+        Registers (or replaces) a `clab.util.MovingAve` that records are
+        accumulated into. Pending records are drained first.
+        """
+        self.flush()
+        with self._lock:
+            self._averages[name] = ave
+
+    def average(self, name):
+        """
+        Returns:
+            dict: the current values of an average (without waiting for
+                pending records)
+        """
+        self._check_error()
+        with self._lock:
+            return dict(self._averages[name].average())
+
+    def record(self, names, metrics_dict):
+        """
+        Adds a dictionary of scalars (python numbers or 1-element tensors) to
+        each of the named averages.
+        """
+        metrics_dict = {k: v.detach() if torch.is_tensor(v) else v
+                        for k, v in metrics_dict.items()}
+        self._submit((_RECORD, tuple(names), metrics_dict))
+
+    def log_value(self, key, value, step):
+        """ Writes a scalar (or 1-element tensor) to the sinks """
+        if torch.is_tensor(value):
+            value = value.detach()
+        self._submit((_VALUE, key, value, step))
+
+    def flush(self):
+        """ Waits until every pending item is processed """
+        if self._thread is not None:
+            self._queue.join()
+        self._check_error()
+        for sink in self.sinks:
+            if hasattr(sink, 'flush'):
+                sink.flush()
+
+    def close(self):
+        """ Processes pending items and stops the background thread """
+        if self._thread is not None:
+            self._queue.put((_STOP,))
+            self._thread.join()
+            self._thread = None
+        self._check_error()
+
+    def _submit(self, item):
+        self._check_error()
+        if not self.background:
+            self._process([item])
+            return
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._worker,
+                                            name='Telemetry')
+            self._thread.daemon = True
+            self._thread.start()
+        self._queue.put(item)
+
+    def _check_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            six.reraise(*error)
+
+    def _worker(self):
+        stop = False
+        while not stop:
+            items = [self._queue.get()]
+            # Take everything that is already waiting (up to drain_size)
+            while len(items) < self.drain_size:
+                try:
+                    items.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = any(item[0] == _STOP for item in items)
+            try:
+                if self._error is None:
+                    self._process([item for item in items if item[0] != _STOP])
+            except Exception:
+                self._error = sys.exc_info()
+            finally:
+                for _ in items:
+                    self._queue.task_done()
+
+    def _process(self, items):
+        records = [item for item in items if item[0] == _RECORD]
+        rows = self._to_host([item[2] for item in records])
+        with self._lock:
+            for (_, names, _), row in zip(records, rows):
+                for name in names:
+                    self._averages[name].update(row)
+        for item in items:
+            if item[0] == _VALUE:
+                _, key, value, step = item
+                value = float(value)
+                for sink in self.sinks:
+                    sink.log_value(key, value, step)
+
+    def _to_host(self, dicts):
+        """
+        Converts the values of many metric dictionaries to floats, with one
+        device transfer per metric and device.
+        """
+        rows = [{} for _ in dicts]
+        keys = ub.oset(k for d in dicts for k in d.keys())
+        for key in keys:
+            idxs = [i for i, d in enumerate(dicts) if key in d]
+            groups = ub.group_items(
+                idxs, [getattr(dicts[i][key], 'device', None) for i in idxs])
+            for device, group in groups.items():
+                values = [dicts[i][key] for i in group]
+                if device is not None:
+                    values = torch.stack([v.float().view(-1)[0]
+                                          for v in values]).tolist()
+                for i, v in zip(group, values):
+                    v = float(v) if v is not None else 0.0
+                    if not math.isfinite(v):
+                        self.warn('WARNING: received a non-finite {}, setting '
+                                  'it to 0'.format(key))
+                        v = 0.0
+                    rows[i][key] = v
+        return rows
+
+
+if __name__ == '__main__':
+    r"""
+    CommandLine:
+        python -m clab.telemetry all
+    """
+    import xdoctest
+    xdoctest.doctest_module(__file__)
@@ -3,6 +3,8 @@ import numpy as np
 from PIL import Image
 import six
 import cv2
+import torch
+import torch.nn.functional as F
 from clab.augment import augment_common
 from clab.util import imutil
 from clab import util
@@ -378,6 +380,7 @@ class AffineWarp(object):
             'cv2': self.make_cv2_warper,
             'pil': self.make_pil_warper,
             'ski': self.make_skimage_warper,
+            'torch': self.make_torch_warper,
         }[backend](shape, matrix, interp, border_mode, clip, mode)
 
     def make_skimage_warper(self, shape, matrix, interp, border_mode, clip, mode):
@@ -454,8 +457,140 @@ class AffineWarp(object):
                 return imaug
         return _cv2_warper
 
+    def make_torch_warper(self, shape, matrix, interp, border_mode, clip, mode):
+        matrices = np.asarray(matrix)[None]
+
+        def _torch_warper(img):
+            data = img[:, :, None] if img.ndim == 2 else img
+            data = torch.from_numpy(np.ascontiguousarray(data.transpose(2, 0, 1)))
+            imaug = warp_affine_batch(data[None], matrices, interp=interp,
+                                      border_mode=border_mode, clip=clip)
+            imaug = imaug[0].numpy().transpose(1, 2, 0)
+            return imaug.reshape(img.shape)
+        return _torch_warper
+
+
+def around_mat3x3_batch(x, y, params):
+    """
+    Builds the affine matrices of many parameter tuples at once.
+
+    Args:
+        x (float): center x location
+        y (float): center y location
+        params (ndarray): [N, 6] stack of (sx, sy, theta, shear, tx, ty)
+            tuples (e.g. from `RandomWarpAffine.random_params`)
+
+    Returns:
+        ndarray: [N, 3, 3] matrices, the same as `AffineWarp.around_mat3x3`
+
+    Example:
+        >>> rng = np.random.RandomState(0)
+        >>> params = rng.rand(5, 6)
+        >>> mats = around_mat3x3_batch(10, 20, params)
+        >>> for p, mat in zip(params, mats):
+        >>>     assert np.allclose(mat, AffineWarp().around_mat3x3(10, 20, *p))
+    """
+    params = np.asarray(params, dtype=np.float64).reshape(-1, 6)
+    # the elementwise math of affine_around_mat2x3 broadcasts over the params
+    aff = np.array(augment_common.affine_around_mat2x3(x, y, *params.T))
+    mats = np.zeros((len(params), 3, 3))
+    mats[:, 0:2, :] = aff.transpose(2, 0, 1)
+    mats[:, 2, 2] = 1
+    return mats
+
+
+def warp_affine_batch(data, matrices, interp='nearest', border_mode='constant',
+                      clip=None):
+    """
+    Warps a batch of images with one `affine_grid` / `grid_sample` call.
+
+    Args:
+        data (Tensor): [B, C, H, W] images. All channels of an image are warped
+            with the same matrix, so aux channels (and labels) can be stacked
+            into one call.
+        matrices (ndarray | Tensor): [B, 3, 3] transforms from input to output
+            pixel coordinates (e.g. from `around_mat3x3_batch`)
+        interp (str): nearest, linear, or cubic
+        border_mode (str): constant (zeros) or reflect
+        clip (bool): clip to the range of each input image (and the border
+            value). Defaults to True for cubic interpolation.
+
+    Returns:
+        Tensor: warped images with the same dtype and device as `data`
+
+    Example:
+        >>> # Compare to the skimage backend
+        >>> rng = np.random.RandomState(0)
+        >>> img = cv2.resize(rng.rand(8, 8, 3), (48, 32)).astype(np.float32)
+        >>> matrix = AffineWarp().around_mat3x3(24, 16, sx=1.1, theta=.3, tx=2)
+        >>> data = torch.from_numpy(img.transpose(2, 0, 1)[None])
+        >>> for interp in ['nearest', 'linear', 'cubic']:
+        >>>     out = warp_affine_batch(data, matrix[None], interp=interp)
+        >>>     out = out[0].numpy().transpose(1, 2, 0)
+        >>>     ref = AffineWarp().warp(img, shape=img.shape, matrix=matrix,
+        >>>                             backend='ski', interp=interp)
+        >>>     # ignore the outer pixels where border handling differs
+        >>>     err = np.abs(out - ref)[2:-2, 2:-2].mean()
+        >>>     assert err < .02, (interp, err)
+    """
+    B, C, H, W = data.shape
+    dtype = data.dtype
+    work = data if data.is_floating_point() else data.float()
+
+    # Map output pixels to input pixels in the normalized coordinates of
+    # affine_grid (with align_corners=False, pixel i is at (2i + 1) / W - 1)
+    matrices = torch.as_tensor(np.asarray(matrices), dtype=torch.float64)
+    norm = torch.DoubleTensor([[2 / W, 0, 1 / W - 1],
+                               [0, 2 / H, 1 / H - 1],
+                               [0, 0, 1]])
+    theta = norm.matmul(torch.inverse(matrices)).matmul(torch.inverse(norm))
+    theta = theta[:, 0:2].to(device=work.device, dtype=work.dtype)
+
+    grid = F.affine_grid(theta, (B, C, H, W), align_corners=False)
+    mode = {'nearest': 'nearest', 'linear': 'bilinear', 'cubic': 'bicubic'}[interp]
+    padding_mode = {'constant': 'zeros', 'reflect': 'reflection'}[border_mode]
+    out = F.grid_sample(work, grid, mode=mode, padding_mode=padding_mode,
+                        align_corners=False)
+
+    if clip is None:
+        clip = interp == 'cubic'
+    if clip:
+        flat = work.reshape(B, -1)
+        lo, hi = flat.min(dim=1)[0], flat.max(dim=1)[0]
+        if border_mode == 'constant':
+            lo, hi = lo.clamp(max=0), hi.clamp(min=0)
+        out = torch.max(torch.min(out, hi.view(B, 1, 1, 1)), lo.view(B, 1, 1, 1))
+    if out.dtype != dtype:
+        out = out.round().to(dtype)
+    return out
+
 
 class RandomWarpAffine(object):
+    """
+    Random affine augmentation.
+
+    The 'skimage', 'pil', and 'cv2' backends warp one image at a time. The
+    'torch' backend uses `warp_affine_batch`, which warps all channels that
+    share an interpolation mode in a single call, and `batch_sseg_warp` can
+    augment entire collated batches on the device.
+
+    Example:
+        >>> rng = np.random.RandomState(0)
+        >>> im = (rng.rand(32, 32, 3) * 255).astype(np.uint8)
+        >>> aux = [rng.rand(32, 32, 2).astype(np.float32)]
+        >>> gt = rng.randint(0, 4, (32, 32)).astype(np.uint8)
+        >>> self = RandomWarpAffine(0, backend='torch')
+        >>> im2, aux2, gt2 = self.sseg_warp(im, aux, gt)
+        >>> assert im2.dtype == im.dtype and im2.shape == im.shape
+        >>> assert aux2[0].shape == aux[0].shape and gt2.shape == gt.shape
+        >>> assert set(np.unique(gt2)) <= set(range(4))
+        >>> # the same augmentation for a collated batch on the xpu
+        >>> ims = torch.rand(4, 3, 32, 32)
+        >>> auxs = torch.rand(4, 2, 32, 32)
+        >>> gts = torch.randint(0, 4, (4, 32, 32))
+        >>> ims2, auxs2, gts2 = self.batch_sseg_warp(ims, auxs, gts)
+        >>> assert ims2.shape == ims.shape and gts2.dtype == gts.dtype
+    """
     def __init__(self, rng=None, backend='skimage', **kw):
         self.rng = util.ensure_rng(rng)
         self.augkw = augment_common.PERTERB_AUG_KW.copy()
@@ -621,19 +756,123 @@ class RandomWarpAffine(object):
         imaug = _warp(img)
         return imaug
 
+    def batch_params(self, n):
+        """
+        Returns:
+            ndarray: [n, 6] stack of `random_params` tuples
+        """
+        return np.array([self.random_params() for _ in range(n)])
+
     def sseg_warp(self, im, aux_channels, gt, border_mode='constant'):
         """
         Specialized warping for semantic segmentation problems
+
+        Example:
+            >>> from clab.transforms import *
+            >>> rng = np.random.RandomState(0)
+            >>> im = rng.rand(32, 32, 3).astype(np.float32)
+            >>> aux = (rng.rand(32, 32) * 200).astype(np.float32)
+            >>> gt = rng.randint(0, 5, size=(32, 32)).astype(np.uint8)
+            >>> self = RandomWarpAffine(np.random.RandomState(1), backend='pil')
+            >>> im_aug, (aux_aug,), gt_aug = self.sseg_warp(im, [aux], gt)
+            >>> params = RandomWarpAffine(np.random.RandomState(1)).random_params()
+            >>> assert np.all(im_aug == self.warp(im, params, interp='cubic'))
+            >>> assert np.all(aux_aug == self.warp(aux, params))
+            >>> assert np.all(gt_aug == self.warp(gt, params))
+            >>> assert aux_aug.max() > 1 and gt_aug.dtype == np.uint8
         """
         params = self.random_params()
-        im_aug = self.warp(im, params, interp='cubic', border_mode=border_mode)
-        aux_channels_aug = [
-            self.warp(aux, params, interp='nearest', border_mode=border_mode)
-            for aux in aux_channels
-        ]
-        gt_aug = self.warp(gt, params, interp='nearest', border_mode=border_mode)
+        if self.backend == 'torch':
+            return self._torch_sseg_warp(im, aux_channels, gt, params,
+                                         border_mode)
+        # Only the matrix is shared. Each warper is built from the array it
+        # warps because backends like pil choose conversions based on shape.
+        x, y = im.shape[1] / 2, im.shape[0] / 2
+        affwarp = AffineWarp()
+        matrix = affwarp.around_mat3x3(x, y, *params)
+
+        def _warp(data, interp):
+            _warper = affwarp.make_warper(shape=data.shape, matrix=matrix,
+                                          interp=interp, backend=self.backend,
+                                          border_mode=border_mode)
+            return _warper(data)
+
+        im_aug = _warp(im, 'cubic')
+        aux_channels_aug = [_warp(aux, 'nearest') for aux in aux_channels]
+        gt_aug = None if gt is None else _warp(gt, 'nearest')
+        return im_aug, aux_channels_aug, gt_aug
+
+    def _torch_sseg_warp(self, im, aux_channels, gt, params, border_mode):
+        """ warps a single sample as a batch of one """
+        def _chw(data):
+            data = data[:, :, None] if data.ndim == 2 else data
+            return torch.from_numpy(np.ascontiguousarray(
+                data.transpose(2, 0, 1)))[None]
+
+        def _hwc(data, ndim):
+            data = data[0].numpy().transpose(1, 2, 0)
+            return data[:, :, 0] if ndim == 2 else data
+
+        ims = _chw(im)
+        auxs = None
+        if aux_channels:
+            auxs = torch.cat([_chw(aux).float() for aux in aux_channels], dim=1)
+        gts = None if gt is None else _chw(gt)[:, 0]
+        ims, auxs, gts = self.batch_sseg_warp(ims, auxs, gts, [params],
+                                              border_mode=border_mode)
+        im_aug = _hwc(ims, im.ndim)
+        aux_channels_aug = []
+        start = 0
+        for aux in aux_channels:
+            n = 1 if aux.ndim == 2 else aux.shape[2]
+            aux_aug = _hwc(auxs[:, start:start + n], aux.ndim)
+            aux_channels_aug.append(aux_aug.astype(aux.dtype))
+            start += n
+        gt_aug = None if gt is None else gts[0].numpy()
         return im_aug, aux_channels_aug, gt_aug
 
+    def batch_sseg_warp(self, ims, auxs=None, gts=None, params=None,
+                        border_mode='constant'):
+        """
+        Warps a collated batch (e.g. on the xpu after loading).
+
+        The images are warped with cubic interpolation in one call. The aux
+        channels and labels are stacked and warped with nearest interpolation
+        in a second call, so the cost does not grow with the number of aux
+        channels.
+
+        Args:
+            ims (Tensor): [B, C, H, W] images
+            auxs (Tensor): [B, A, H, W] aux channels (or None)
+            gts (Tensor): [B, H, W] labels (or None)
+            params (ndarray): [B, 6] affine params. Randomly chosen if None.
+
+        Returns:
+            Tuple[Tensor, Tensor, Tensor]: warped ims, auxs, and gts
+        """
+        B, _, H, W = ims.shape
+        if params is None:
+            params = self.batch_params(B)
+        matrices = around_mat3x3_batch(W / 2, H / 2, params)
+        ims_aug = warp_affine_batch(ims, matrices, interp='cubic',
+                                    border_mode=border_mode)
+        nearest = []
+        if auxs is not None:
+            nearest.append(auxs.float())
+        if gts is not None:
+            # labels are exact in float32 up to 2 ** 24
+            nearest.append(gts[:, None].float())
+        auxs_aug = gts_aug = None
+        if nearest:
+            stacked = warp_affine_batch(torch.cat(nearest, dim=1), matrices,
+                                        interp='nearest',
+                                        border_mode=border_mode)
+            if auxs is not None:
+                auxs_aug = stacked[:, 0:auxs.shape[1]].to(auxs.dtype)
+            if gts is not None:
+                gts_aug = stacked[:, -1].to(gts.dtype)
+        return ims_aug, auxs_aug, gts_aug
+
 
 # class RandomIntensity(object):
 #     def __init__(self, rng):
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+"""
+Lazy loading of package submodules (PEP 562).
+
+Package ``__init__`` files use :func:`lazy_import` to build a module-level
+``__getattr__``, so their submodules (and the names exported from them) are
+only imported on first access. Both ``clab.util.imread`` and
+``from clab.util import imread`` keep working, but ``import clab`` no longer
+pays for matplotlib, networkx, torch, etc. until they are used.
+
+Set the environment variable ``CLAB_EAGER_IMPORT=1`` to import everything up
+front (e.g. to find import errors).
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+import importlib
+import json
+import os
+import subprocess
+import sys
+
+__all__ = ['lazy_import']
+
+
+def lazy_import(module_name, submodules, submod_attrs, extra_attrs=None):
+    """
+    Builds the lazy ``__getattr__`` and ``__dir__`` of a package.
+
+    Args:
+        module_name (str): name of the package (i.e. ``__name__``)
+        submodules (List[str]): submodules loaded on first access
+        submod_attrs (Dict[str, List[str]]): maps a submodule to the names it
+            exports at the package level
+        extra_attrs (Dict[str, Tuple[str, str]]): maps an exported name to a
+            (submodule, attribute) pair if they differ
+
+    Returns:
+        Tuple[callable, callable, List[str]]: ``__getattr__``, ``__dir__``,
+            and ``__all__`` for the package
+
+    Example:
+        >>> getattr_, dir_, all_ = lazy_import(
+        >>>     'clab.util', ['util_alg'], {'util_alg': ['mincost_assignment']})
+        >>> assert 'mincost_assignment' in all_
+        >>> func = getattr_('mincost_assignment')
+        >>> assert func is sys.modules['clab.util.util_alg'].mincost_assignment
+        >>> import pytest
+        >>> with pytest.raises(AttributeError):
+        >>>     getattr_('not_an_attribute')
+    """
+    extra_attrs = dict(extra_attrs or {})
+    name_to_submod = {}
+    for submod, attrs in submod_attrs.items():
+        for attr in attrs:
+            name_to_submod[attr] = (submod, attr)
+    name_to_submod.update(extra_attrs)
+    all_ = sorted(set(submodules) | set(name_to_submod))
+
+    def __getattr__(name):
+        if name in submodules:
+            attr = importlib.import_module('{}.{}'.format(module_name, name))
+        elif name in name_to_submod:
+            submod, submod_attr = name_to_submod[name]
+            module = importlib.import_module('{}.{}'.format(module_name, submod))
+            attr = getattr(module, submod_attr)
+        else:
+            raise AttributeError('module {!r} has no attribute {!r}'.format(
+                module_name, name))
+        # Cache the attribute, so __getattr__ is only called once per name
+        package = sys.modules.get(module_name)
+        if package is not None:
+            setattr(package, name, attr)
+        return attr
+
+    def __dir__():
+        return all_
+
+    if os.environ.get('CLAB_EAGER_IMPORT', ''):
+        for name in all_:
+            __getattr__(name)
+
+    return __getattr__, __dir__, all_
+
+
+def import_time(modname='clab', n=5):
+    """
+    Measures the time to import a module in fresh interpreters.
+
+    Args:
+        modname (str): module to import
+        n (int): number of interpreters to start
+
+    Returns:
+        Tuple[float, List[str]]: the fastest import time in seconds and the
+            top-level packages it imported
+    """
+    code = ';'.join([
+        'import sys, time, json',
+        'before = set(sys.modules)',
+        'start = time.perf_counter()',
+        'import {}'.format(modname),
+        'elapsed = time.perf_counter() - start',
+        'print(elapsed)',
+        'print(json.dumps(sorted({m.split(".")[0] for m in set(sys.modules) - before})))',
+    ])
+    env = os.environ.copy()
+    env.pop('CLAB_EAGER_IMPORT', None)
+    times = []
+    for _ in range(n):
+        out = subprocess.check_output([sys.executable, '-c', code], env=env)
+        line1, line2 = out.decode('utf8').strip().splitlines()[-2:]
+        times.append(float(line1))
+    return min(times), json.loads(line2)
+
+
+def benchmark_import_time(modname='clab', budget=0.5, n=5):
+    """
+    Regression benchmark for the startup cost of ``import clab``, which every
+    CLI invocation and spawned DataLoader worker pays.
+
+    The default budget is generous compared to a lazy import, but well below
+    the cost of importing torch and matplotlib up front.
+
+    CommandLine:
+        python -m clab.util.lazy_loader benchmark_import_time --bench
+
+    Example:
+        >>> # xdoc: +REQUIRES(--bench)
+        >>> benchmark_import_time()
+    """
+    seconds, packages = import_time(modname, n=n)
+    print('import {} takes {:.3f}s'.format(modname, seconds))
+    heavy = {'torch', 'matplotlib', 'networkx', 'pandas', 'cv2', 'scipy'}
+    eager = sorted(heavy.intersection(packages))
+    if eager:
+        raise AssertionError('import {} loads {}'.format(modname, eager))
+    if seconds > budget:
+        raise AssertionError('import {} takes {:.3f}s, over the {}s '
+                             'budget'.format(modname, seconds, budget))
+    return seconds
+
+
+if __name__ == '__main__':
+    r"""
+    CommandLine:
+        python -m clab.util.lazy_loader all
+    """
+    import xdoctest
+    xdoctest.doctest_module(__file__)
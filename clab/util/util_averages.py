@@ -1,9 +1,13 @@
 import collections
-import pandas as pd
 import ubelt as ub
 import numpy as np
 
 
+def _isnull(v):
+    # much cheaper than pd.isnull for scalars (NaN is the only x != x)
+    return v is None or v != v
+
+
 class MovingAve(ub.NiceRepr):
     def average(self):
         raise NotImplementedError()
@@ -48,7 +52,7 @@ class CumMovingAve(MovingAve):
     def update(self, other):
         self.n += 1
         for k, v in other.items():
-            if pd.isnull(v):
+            if _isnull(v):
                 v = 0
             if k not in self.totals:
                 self.totals[k] = 0
@@ -83,7 +87,7 @@ class WindowedMovingAve(MovingAve):
 
     def update(self, other):
         for k, v in other.items():
-            if pd.isnull(v):
+            if _isnull(v):
                 v = 0
             if k not in self.totals:
                 self.history[k] = collections.deque()
@@ -140,7 +144,7 @@ class ExpMovingAve(MovingAve):
     def update(self, other):
         alpha = self.alpha
         for k, v in other.items():
-            if pd.isnull(v):
+            if _isnull(v):
                 v = 0
             if k not in self.values:
                 self.values[k] = v
@@ -154,9 +158,17 @@ class RunningStats(object):
     Dynamically records per-element array statistics and can summarized them
     per-element, across channels, or globally.
 
+    Internally this keeps the count, mean, and sum of squared deviations
+    (M2) of each element, which are updated with Welford's method. Stats
+    accumulated over disjoint sets of data can be combined with `merge`, so
+    they can be computed in parallel.
+
     SeeAlso:
         InternalRunningStats
 
+    References:
+        https://en.wikipedia.org/wiki/Algorithms_for_calculating_variance#Parallel_algorithm
+
     Example:
         >>> run = RunningStats()
         >>> ch1 = np.array([[0, 1], [3, 4]])
@@ -171,13 +183,31 @@ class RunningStats(object):
         >>> print(ub.repr2(ub.map_vals(lambda x: np.array(x).tolist(), run.simple()), nobr=1, si=True, nl=1))
         >>> # Per-pixel averages
         >>> print(ub.repr2(ub.map_vals(lambda x: np.array(x).tolist(), run.detail()), nobr=1, si=True, nl=1))
+
+    Example:
+        >>> # Merging partial stats is the same as accumulating all the data
+        >>> rng = np.random.RandomState(0)
+        >>> imgs = rng.rand(7, 3, 4, 2) * 100
+        >>> full, part1, part2 = RunningStats(), RunningStats(), RunningStats()
+        >>> for img in imgs:
+        >>>     full.update(img)
+        >>> for img in imgs[:3]:
+        >>>     part1.update(img)
+        >>> for img in imgs[3:]:
+        >>>     part2.update(img)
+        >>> merged = part1.merge(part2)
+        >>> for axis in [None, (0, 1)]:
+        >>>     a, b = full.simple(axis=axis), merged.simple(axis=axis)
+        >>>     for key in a.keys():
+        >>>         assert np.allclose(a[key], b[key]), key
+        >>> assert np.allclose(merged.detail()['std'], imgs.std(axis=0, ddof=1))
         """
 
     def __init__(run):
         run.raw_max = -np.inf
         run.raw_min = np.inf
-        run.raw_total = 0
-        run.raw_squares = 0
+        run.raw_mean = 0
+        run.raw_m2 = 0
         run.n = 0
 
     def update(run, img):
@@ -185,55 +215,83 @@ class RunningStats(object):
         # Update stats across images
         run.raw_max = np.maximum(run.raw_max, img)
         run.raw_min = np.minimum(run.raw_min, img)
-        run.raw_total += img
-        run.raw_squares += img ** 2
+        img = np.asarray(img, dtype=np.float64)
+        delta = img - run.raw_mean
+        run.raw_mean = run.raw_mean + delta / run.n
+        run.raw_m2 = run.raw_m2 + delta * (img - run.raw_mean)
+
+    def merge(run, other):
+        """
+        Combines the stats of another RunningStats object (accumulated over a
+        different set of data) into this one.
 
-    def _sumsq_std(run, total, squares, n):
+        Returns:
+            RunningStats: run
+        """
+        if other.n == 0:
+            return run
+        n = run.n + other.n
+        delta = other.raw_mean - run.raw_mean
+        run.raw_mean = run.raw_mean + delta * (other.n / n)
+        run.raw_m2 = (run.raw_m2 + other.raw_m2 +
+                      delta ** 2 * (run.n * other.n / n))
+        run.raw_max = np.maximum(run.raw_max, other.raw_max)
+        run.raw_min = np.minimum(run.raw_min, other.raw_min)
+        run.n = n
+        return run
+
+    @property
+    def raw_total(run):
+        return run.raw_mean * run.n
+
+    @property
+    def raw_squares(run):
+        return run.raw_m2 + run.raw_mean ** 2 * run.n
+
+    def _m2_std(run, m2, n):
         """
-        Sum of squares method to compute standard deviation
+        Sample standard deviation from the sum of squared deviations
         """
-        numer = (n * squares - total ** 2)
-        denom = (n * (n - 1))
-        std = np.sqrt(numer / denom)
+        std = np.sqrt(m2 / (n - 1))
         return std
 
     def simple(run, axis=None):
         assert run.n > 0, 'no stats exist'
-        maxi    = run.raw_max.max(axis=axis, keepdims=True)
-        mini    = run.raw_min.min(axis=axis, keepdims=True)
-        total   = run.raw_total.sum(axis=axis, keepdims=True)
-        squares = run.raw_squares.sum(axis=axis, keepdims=True)
-        if not hasattr(run.raw_total, 'shape'):
-            n = run.n
-        elif axis is None:
-            n = run.n * np.prod(run.raw_total.shape)
+        raw_mean = np.asarray(run.raw_mean)
+        raw_m2 = np.asarray(run.raw_m2)
+        maxi = np.asarray(run.raw_max).max(axis=axis, keepdims=True)
+        mini = np.asarray(run.raw_min).min(axis=axis, keepdims=True)
+        if axis is None:
+            k = raw_mean.size
         else:
-            n = run.n * np.prod(np.take(run.raw_total.shape, axis))
+            k = np.prod(np.take(raw_mean.shape, axis))
+        n = run.n * k
+        # Combine the per-element stats of the summarized elements
+        mean = raw_mean.mean(axis=axis, keepdims=True)
+        m2 = (raw_m2.sum(axis=axis, keepdims=True) +
+              run.n * ((raw_mean - mean) ** 2).sum(axis=axis, keepdims=True))
+        total = mean * n
         info = ub.odict([
             ('n', n),
             ('max', maxi),
             ('min', mini),
             ('total', total),
-            ('squares', squares),
-            ('mean', total / n),
-            ('std', run._sumsq_std(total, squares, n)),
+            ('squares', m2 + mean * total),
+            ('mean', mean),
+            ('std', run._m2_std(m2, n)),
         ])
         return info
 
     def detail(run):
-        total = run.raw_total
-        squares = run.raw_squares
-        maxi = run.raw_max
-        mini = run.raw_min
         n = run.n
         info = ub.odict([
             ('n', n),
-            ('max', maxi),
-            ('min', mini),
-            ('total', total),
-            ('squares', squares),
-            ('mean', total / n),
-            ('std', run._sumsq_std(total, squares, n)),
+            ('max', run.raw_max),
+            ('min', run.raw_min),
+            ('total', run.raw_total),
+            ('squares', run.raw_squares),
+            ('mean', run.raw_mean),
+            ('std', run._m2_std(run.raw_m2, n)),
         ])
         return info
 
@@ -330,6 +388,39 @@ class InternalRunningStats():
             stat = func(img, axis=axis)
             run.update(stat)
 
+    def merge(irun, other):
+        """
+        Combines the stats of another InternalRunningStats object
+        (accumulated over a different set of images) into this one.
+
+        The internal statistics (e.g. the median and MAD) are computed exactly
+        within each image, and only their averages are taken across images,
+        so merging is exact.
+
+        Returns:
+            InternalRunningStats: irun
+
+        Example:
+            >>> rng = np.random.RandomState(0)
+            >>> imgs = rng.rand(5, 3, 4, 2)
+            >>> full, part1, part2 = [InternalRunningStats(axis=(0, 1))
+            >>>                       for _ in range(3)]
+            >>> for img in imgs:
+            >>>     full.update(img)
+            >>> for img in imgs[:2]:
+            >>>     part1.update(img)
+            >>> for img in imgs[2:]:
+            >>>     part2.update(img)
+            >>> a, b = full.info(), part1.merge(part2).info()
+            >>> for key in a.keys():
+            >>>     for k2 in a[key].keys():
+            >>>         assert np.allclose(a[key][k2], b[key][k2])
+        """
+        assert irun.axis == other.axis
+        for key, (run, _) in irun.runs.items():
+            run.merge(other.runs[key][0])
+        return irun
+
     def info(irun):
         return {
             key: run.detail() for key, (run, _) in irun.runs.items()
@@ -6,7 +6,9 @@ Creates a common API for dynamically running on CPU, GPU, or many GPUs
 from __future__ import absolute_import, division, print_function
 import ubelt as ub
 import warnings
+import os
 import torch
+import torch.distributed as dist
 import six
 
 
@@ -35,8 +37,11 @@ class XPU(ub.NiceRepr):
     Args:
         item (None, int, or list): None for cpu, an int for a gpu, or a list of
             ints for multiple gpus.
-    TODO:
-        distributed processing
+
+    Notes:
+        For multi-process training use `spawn_distributed`. Within each
+        process `XPU.cast('distributed')` gives the device for that rank, and
+        `mount` wraps models in `DistributedDataParallel`.
 
     CommandLine:
         python -m clab.xpu_device XPU
@@ -165,6 +170,8 @@ class XPU(ub.NiceRepr):
                 return XPU.from_auto(**kwargs)
             elif item == 'argv':
                 return XPU.from_argv(**kwargs)
+            elif item == 'distributed':
+                return XPU.from_distributed(**kwargs)
             if item == 'cpu' or item is None:
                 return XPU(None)
             elif item == 'cpu' or item is None:
@@ -198,6 +205,23 @@ class XPU(ub.NiceRepr):
         xpu = XPU(gpu_num)
         return xpu
 
+    @classmethod
+    def from_distributed(XPU):
+        """
+        Determines the device for the current process in a distributed group.
+        Processes using the gloo backend run on the CPU, otherwise each rank
+        is assigned a GPU in round-robin order.
+
+        Example:
+            >>> xpu = XPU.from_distributed()
+            >>> if not is_distributed():
+            >>>     assert not xpu.is_gpu()
+        """
+        if not is_distributed() or dist.get_backend() == 'gloo':
+            return XPU(None)
+        n_available = torch.cuda.device_count()
+        return XPU(get_rank() % n_available)
+
     @classmethod
     def from_argv(XPU, **kwargs):
         """
@@ -271,15 +295,27 @@ class XPU(ub.NiceRepr):
 
         Unlike move this function does NOT work in place.
 
+        If a distributed process group is initialized, the model is wrapped
+        in `DistributedDataParallel`, which all-reduces gradients across
+        processes during the backward pass.
+
         Example:
             >>> model = torch.nn.Conv2d(1, 1, 1)
             >>> xpu = XPU()
+            >>> mounted = xpu.mount(model)
+            >>> assert mounted.module is model
         """
-        if isinstance(model, (torch.nn.DataParallel, DataSerial)):
+        wrappers = (torch.nn.DataParallel, DataSerial,
+                    torch.nn.parallel.DistributedDataParallel)
+        if isinstance(model, wrappers):
             # raise ValueError('Model is already in parallel mode.')
             model = model.module
         model = xpu.move(model)
-        if xpu.devices:
+        if is_distributed():
+            device_ids = [xpu.main_device] if xpu.is_gpu() else None
+            model = torch.nn.parallel.DistributedDataParallel(
+                model, device_ids=device_ids)
+        elif xpu.devices:
             model = torch.nn.DataParallel(model, device_ids=xpu.devices,
                                           output_device=xpu.main_device)
         else:
@@ -379,7 +415,7 @@ class XPU(ub.NiceRepr):
             fpath (str or file): path to torch data file or file-like object
 
         Example:
-            >>> fpath = 'foo.pt'
+            >>> fpath = os.path.join(ub.ensure_app_cache_dir('clab'), 'foo.pt')
             >>> cpu = XPU(None)
             >>> data = torch.FloatTensor([0])
             >>> torch.save(data, fpath)
@@ -420,6 +456,80 @@ class XPU(ub.NiceRepr):
         sys.modules['clab.torch.metrics'] = metrics
 
 
+def is_distributed():
+    """ True if this process belongs to an initialized process group """
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    """ Rank of this process in the distributed group (0 if not distributed) """
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    """ Number of processes in the distributed group (1 if not distributed) """
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process():
+    """ Only the main process should write snapshots and logs """
+    return get_rank() == 0
+
+
+def spawn_distributed(func, world_size, args=(), backend=None,
+                      master_addr='127.0.0.1', master_port=29500):
+    """
+    Runs `func(rank, world_size, *args)` in `world_size` processes, each of
+    which is a member of an initialized process group.
+
+    Args:
+        func (callable): entry point. Must be picklable (i.e. module level).
+        world_size (int): number of processes to start.
+        args (tuple): extra arguments passed to func.
+        backend (str): torch.distributed backend. Defaults to nccl if there is
+            a GPU for each process and gloo (CPU) otherwise.
+        master_addr (str): address of the rank 0 process
+        master_port (int): port of the rank 0 process
+
+    Notes:
+        On the CPU the machine's cores are divided evenly between processes,
+        so each process runs its ops on its own worker group of threads.
+
+    CommandLine:
+        python -m clab.xpu_device spawn_distributed
+
+    Example:
+        >>> # xdoc: +SKIP
+        >>> def main(rank, world_size):
+        >>>     harn = setup_harness(xpu=XPU.cast('distributed'))
+        >>>     harn.run()
+        >>> spawn_distributed(main, world_size=4)
+    """
+    if backend is None:
+        if torch.cuda.is_available() and torch.cuda.device_count() >= world_size:
+            backend = 'nccl'
+        else:
+            backend = 'gloo'
+    os.environ.setdefault('MASTER_ADDR', master_addr)
+    os.environ.setdefault('MASTER_PORT', str(master_port))
+    import torch.multiprocessing as mp
+    mp.spawn(_distributed_worker, args=(func, world_size, backend, args),
+             nprocs=world_size, join=True)
+
+
+def _distributed_worker(rank, func, world_size, backend, args):
+    """ Process entry point used by `spawn_distributed` """
+    dist.init_process_group(backend, rank=rank, world_size=world_size)
+    if backend == 'gloo':
+        import psutil
+        n_cpus = psutil.cpu_count(logical=False) or 1
+        torch.set_num_threads(max(1, n_cpus // world_size))
+    try:
+        func(rank, world_size, *args)
+    finally:
+        dist.destroy_process_group()
+
+
 def find_unused_gpu(min_memory=0):
     """
     Finds GPU with the lowest memory usage by parsing output of nvidia-smi
@@ -528,7 +638,7 @@ try:
     class XPUUnitTests(object):
         @pytest.mark.skipif(torch.cuda.is_available())
         def test_load():
-            fpath = 'foo.pt'
+            fpath = os.path.join(ub.ensure_app_cache_dir('clab'), 'foo.pt')
             cpu = XPU(None)
             gpu = XPU(0)
             gpu_data = gpu.move(torch.FloatTensor([10]))
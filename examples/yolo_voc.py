@@ -25,12 +25,12 @@ import torch
 import cv2
 import ubelt as ub
 import numpy as np
-import pandas as pd
 import imgaug as ia
 import imgaug.augmenters as iaa
 from clab.models.yolo2.utils import yolo_utils as yolo_utils
 from clab.models.yolo2 import multiscale_batch_sampler
 from clab.data import voc
+from clab.data import shmcache
 from clab import util
 from clab import hyperparams
 from clab import xpu_device
@@ -95,6 +95,13 @@ class YoloVOCDataset(voc.VOCDataset):
                                   dtype=np.float)
         self.num_anchors = len(self.anchors)
         self.augmenter = None
+        # Set to a shmcache.SharedArrayCache to share decoded images between
+        # loader workers
+        self.image_cache = None
+        # If True, items are resized to `base_wh` and the label includes the
+        # target size of the batch, so the harness can resize the entire
+        # batch on the xpu (see `multiscale_batch_sampler.resize_batch`).
+        self.device_resize = False
 
         if split == 'train':
             # From YOLO-V1 paper:
@@ -195,6 +202,10 @@ class YoloVOCDataset(voc.VOCDataset):
         else:
             inp_size = self.base_size
 
+        target_size = torch.LongTensor([int(inp_size[0]), int(inp_size[1])])
+        if self.device_resize:
+            inp_size = self.base_wh
+
         # load the raw data from VOC
         image = self._load_image(index)
         annot = self._load_annotation(index)
@@ -245,16 +256,14 @@ class YoloVOCDataset(voc.VOCDataset):
         index = torch.LongTensor([index])
         gt_weights = torch.FloatTensor(gt_weights)
         label = (boxes, gt_classes, orig_size, index, gt_weights)
+        if self.device_resize:
+            label = label + (target_size,)
         return chw01, label
 
-    @ub.memoize_method
+    @shmcache.cached_method('image_cache')
     def _load_image(self, index):
         return super(YoloVOCDataset, self)._load_image(index)
 
-    @ub.memoize_method
-    def _load_annotation(self, index):
-        return super(YoloVOCDataset, self)._load_annotation(index)
-
 
 def make_loaders(datasets, batch_size=16, workers=0):
     """
@@ -356,6 +365,20 @@ def setup_harness(workers=None):
     else:
         raise KeyError(data_choice)
 
+    if ub.argflag('--device_resize'):
+        # Workers only resize to the base size, each batch is rescaled to its
+        # training scale on the xpu
+        for dset in datasets.values():
+            dset.device_resize = True
+
+    # Decoded images are cached in shared memory within a fixed budget
+    cache_mb = int(ub.argval('--image_cache_mb', default=2048))
+    if cache_mb > 0:
+        for dset in datasets.values():
+            dset.image_cache = shmcache.SharedArrayCache(
+                max_bytes=cache_mb * 2 ** 20 // len(datasets),
+                slot_bytes=500 * 500 * 3)  # largest VOC image
+
     nice = ub.argval('--nice', default=None)
 
     pretrained_fpath = darknet.initial_weights()
@@ -512,17 +535,34 @@ def setup_harness(workers=None):
                               inp_size=inp_size, epoch=harn.epoch)
         return outputs, loss
 
+    @harn.set_batch_transform
+    def batch_transform(harn, inputs, labels):
+        """
+        Resizes batches of `device_resize` datasets, which carry the target
+        size of the batch as an extra label, to that size on the xpu.
+        """
+        if len(labels) == 6:
+            target_size = labels[5][0].tolist()
+            images, boxes = multiscale_batch_sampler.resize_batch(
+                inputs[0], labels[0], target_size)
+            inputs = [images] + list(inputs[1:])
+            labels = [boxes] + list(labels[1:5])
+        return inputs, labels
+
     @harn.add_batch_metric_hook
     def custom_metrics(harn, output, labels):
+        # Detached device tensors, read on the host by the telemetry thread
         metrics_dict = ub.odict()
         criterion = harn.criterion
-        metrics_dict['L_bbox'] = float(criterion.bbox_loss.data.cpu().numpy())
-        metrics_dict['L_iou'] = float(criterion.iou_loss.data.cpu().numpy())
-        metrics_dict['L_cls'] = float(criterion.cls_loss.data.cpu().numpy())
+        metrics_dict['L_bbox'] = criterion.bbox_loss.detach()
+        metrics_dict['L_iou'] = criterion.iou_loss.detach()
+        metrics_dict['L_cls'] = criterion.cls_loss.detach()
         return metrics_dict
 
     # Set as a harness attribute instead of using a closure
-    harn.batch_confusions = []
+    harn.det_accum = voc.DetectionAccumulator(
+        num_classes=datasets['train'].num_classes,
+        ovthresh=postproc_params['ovthresh'])
 
     @harn.add_iter_callback
     def on_batch(harn, tag, loader, bx, inputs, labels, outputs, loss):
@@ -561,15 +601,11 @@ def setup_harness(workers=None):
         batch_true_boxes, batch_true_cls_inds = labels[0:2]
         batch_orig_sz, batch_img_inds = labels[2:4]
 
-        y_batch = []
-        for bx, index in enumerate(batch_img_inds.data.cpu().numpy().ravel()):
-            pred_boxes  = batch_pred_boxes[bx]
-            pred_scores = batch_pred_scores[bx]
-            pred_cxs    = batch_pred_cls_inds[bx]
-
+        harn.det_accum.ovthresh = ovthresh
+        batch_true_boxes_ = []
+        for bx in range(len(batch_img_inds)):
             # Group groundtruth boxes by class
             true_boxes_ = batch_true_boxes[bx].data.cpu().numpy()
-            true_cxs = batch_true_cls_inds[bx].data.cpu().numpy()
             true_weights = gt_weights[bx].data.cpu().numpy()
 
             # Unnormalize the true bboxes back to orig coords
@@ -579,26 +615,29 @@ def setup_harness(workers=None):
                 true_boxes = np.hstack([true_boxes_, true_weights[:, None]])
                 true_boxes[:, 0:4:2] *= sx
                 true_boxes[:, 1:4:2] *= sy
+            else:
+                true_boxes = np.empty((0, 5))
+            batch_true_boxes_.append(true_boxes)
 
-            y = voc.EvaluateVOC.image_confusions(true_boxes, true_cxs,
-                                                 pred_boxes, pred_scores,
-                                                 pred_cxs, ovthresh=ovthresh)
-            y['gx'] = index
-            y_batch.append(y)
-
-        harn.batch_confusions.extend(y_batch)
+        batch_true_cxs = [cxs.data.cpu().numpy() for cxs in batch_true_cls_inds]
+        harn.det_accum.add_batch(batch_true_boxes_, batch_true_cxs,
+                                 batch_pred_boxes, batch_pred_scores,
+                                 batch_pred_cls_inds)
 
     @harn.add_epoch_callback
     def on_epoch(harn, tag, loader):
-        y = pd.concat(harn.batch_confusions)
-        num_classes = len(loader.dataset.label_names)
-
-        mean_ap, ap_list = voc.EvaluateVOC.compute_map(y, num_classes)
+        mean_ap, ap_list = harn.det_accum.compute_map()
 
         harn.log_value(tag + ' epoch mAP', mean_ap, harn.epoch)
         # max_ap = np.nanmax(ap_list)
         # harn.log_value(tag + ' epoch max-AP', max_ap, harn.epoch)
-        harn.batch_confusions.clear()
+        harn.det_accum.reset()
+
+        image_cache = loader.dataset.image_cache
+        if image_cache is not None:
+            harn.log_value(tag + ' epoch image cache hit rate',
+                           image_cache.stats()['hit_rate'], harn.epoch)
+            image_cache.reset_stats()
 
     return harn
 
@@ -26,7 +26,6 @@ import torch
 import cv2
 import ubelt as ub
 import numpy as np
-import pandas as pd
 import imgaug as ia
 import imgaug.augmenters as iaa
 from clab.models.yolo2.utils import yolo_utils as yolo_utils
@@ -302,10 +301,6 @@ class YoloVOCDataset(voc.VOCDataset):
     def _load_image(self, index):
         return super(YoloVOCDataset, self)._load_image(index)
 
-    @ub.memoize_method
-    def _load_annotation(self, index):
-        return super(YoloVOCDataset, self)._load_annotation(index)
-
 
 def make_loaders(datasets, batch_size=16, workers=0):
     """
@@ -575,15 +570,18 @@ def setup_harness(workers=None):
     @harn.add_batch_metric_hook
     @profiler.profile
     def custom_metrics(harn, output, labels):
+        # Detached device tensors, read on the host by the telemetry thread
         metrics_dict = ub.odict()
         criterion = harn.criterion
-        metrics_dict['L_bbox'] = float(criterion.loss_coord.data.cpu().numpy())
-        metrics_dict['L_iou'] = float(criterion.loss_conf.data.cpu().numpy())
-        metrics_dict['L_cls'] = float(criterion.loss_cls.data.cpu().numpy())
+        metrics_dict['L_bbox'] = criterion.loss_coord.detach()
+        metrics_dict['L_iou'] = criterion.loss_conf.detach()
+        metrics_dict['L_cls'] = criterion.loss_cls.detach()
         return metrics_dict
 
     # Set as a harness attribute instead of using a closure
-    harn.batch_confusions = []
+    harn.det_accum = voc.DetectionAccumulator(
+        num_classes=datasets['train'].num_classes,
+        ovthresh=postproc_params['ovthresh'])
 
     @harn.add_iter_callback
     @profiler.profile
@@ -668,12 +666,10 @@ def setup_harness(workers=None):
 
         batch_img_inds = batch_index
 
-        y_batch = []
-        for bx, index in enumerate(batch_img_inds.data.cpu().numpy().ravel()):
-            pred_boxes = batch_pred_boxes[bx]
-            pred_scores = batch_pred_scores[bx]
-            pred_cxs = batch_pred_cls_inds[bx]
-
+        harn.det_accum.ovthresh = ovthresh
+        batch_true_boxes_ = []
+        batch_true_cxs = []
+        for bx in range(len(batch_img_inds)):
             # Group groundtruth boxes by class
             true_boxes_ = batch_true_boxes[bx].data.cpu().numpy()
             true_cxs = batch_true_cls_inds[bx].data.cpu().numpy()
@@ -686,28 +682,23 @@ def setup_harness(workers=None):
                     orig_size).asformat('tlbr').data
                 true_boxes = np.hstack([true_boxes, true_weights[:, None]])
             else:
-                true_boxes = true_boxes_.reshape(-1, 4)
+                true_boxes = np.empty((0, 5))
+            batch_true_boxes_.append(true_boxes)
+            batch_true_cxs.append(true_cxs)
 
-            y = voc.EvaluateVOC.image_confusions(true_boxes, true_cxs,
-                                                 pred_boxes, pred_scores,
-                                                 pred_cxs, ovthresh=ovthresh)
-            y['gx'] = index
-            y_batch.append(y)
-
-        harn.batch_confusions.extend(y_batch)
+        harn.det_accum.add_batch(batch_true_boxes_, batch_true_cxs,
+                                 batch_pred_boxes, batch_pred_scores,
+                                 batch_pred_cls_inds)
 
     @harn.add_epoch_callback
     @profiler.profile
     def on_epoch(harn, tag, loader):
-        y = pd.concat(harn.batch_confusions)
-        num_classes = len(loader.dataset.label_names)
-
-        mean_ap, ap_list = voc.EvaluateVOC.compute_map(y, num_classes)
+        mean_ap, ap_list = harn.det_accum.compute_map()
 
         harn.log_value(tag + ' epoch mAP', mean_ap, harn.epoch)
         max_ap = np.nanmax(ap_list)
         harn.log_value(tag + ' epoch max-AP', max_ap, harn.epoch)
-        harn.batch_confusions.clear()
+        harn.det_accum.reset()
 
     return harn
 